@@ -0,0 +1,94 @@
+# app/cache_dashboard.py
+"""
+Caché de respuestas de /dashboard/principal por (alcance, filtros).
+
+Cada proceso guarda las respuestas en memoria; lo que las hace válidas entre
+varios workers de uvicorn es la tabla `versiones_datos`: un contador por
+negocio que se incrementa (en la misma transacción) cada vez que cambian sus
+detalles, vía crud.sumar_resumen_mensual / crud.refrescar_resumen_mensual.
+Una respuesta cacheada sirve mientras la versión con que se calculó siga
+siendo la actual:
+  - un negocio -> versión de ese negocio
+  - superadmin (todos) -> suma de todas las versiones
+El costo de un acierto es una lectura por PK en vez de la agregación.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app import models
+
+# respuestas guardadas por proceso (LRU); 0 desactiva el caché
+DASHBOARD_CACHE_MAX = int(os.getenv("DASHBOARD_CACHE_MAX", "512"))
+
+_lock = threading.Lock()
+_entradas = OrderedDict()   # clave -> (version, respuesta)
+_stats = {"aciertos": 0, "fallos": 0}
+
+
+def invalidar(db: Session, negocio_ids: Optional[Iterable[int]] = None) -> None:
+    """
+    Sube la versión de estos negocios (0 = facturas sin negocio); sin ids, la de
+    todos. No hace commit: la invalidación se ve junto con el cambio que la causa.
+    """
+    V = models.VersionDatos
+    if negocio_ids is None:
+        ids = {i for (i,) in db.query(models.NombreNegocio.id)} | {0}
+    else:
+        ids = {int(i or 0) for i in negocio_ids}
+    if not ids:
+        return
+    stmt = pg_insert(V).values([{"negocio_id": i, "version": 1} for i in sorted(ids)])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[V.negocio_id], set_={"version": V.version + 1}
+    )
+    db.execute(stmt)
+
+
+def version_actual(db: Session, negocio_id: Optional[int]) -> int:
+    V = models.VersionDatos
+    if negocio_id:
+        return db.query(V.version).filter(V.negocio_id == negocio_id).scalar() or 0
+    return db.query(func.coalesce(func.sum(V.version), 0)).scalar() or 0
+
+
+def obtener(db: Session, negocio_id: Optional[int], filtros: tuple, calcular: Callable[[], dict]) -> dict:
+    """Respuesta cacheada para (negocio_id, *filtros), o la calcula y la guarda."""
+    if DASHBOARD_CACHE_MAX <= 0:
+        return calcular()
+
+    clave = (negocio_id or None,) + tuple(filtros)
+    # la versión se lee antes de calcular: si algo cambia mientras tanto, la
+    # respuesta queda guardada con la versión vieja y la próxima vez no sirve
+    version = int(version_actual(db, negocio_id))
+    with _lock:
+        guardada = _entradas.get(clave)
+        if guardada is not None and guardada[0] == version:
+            _entradas.move_to_end(clave)
+            _stats["aciertos"] += 1
+            return guardada[1]
+        _stats["fallos"] += 1
+
+    respuesta = calcular()
+    with _lock:
+        _entradas[clave] = (version, respuesta)
+        _entradas.move_to_end(clave)
+        while len(_entradas) > DASHBOARD_CACHE_MAX:
+            _entradas.popitem(last=False)
+    return respuesta
+
+
+def estadisticas() -> dict:
+    with _lock:
+        return {
+            "aciertos": _stats["aciertos"],
+            "fallos": _stats["fallos"],
+            "entradas": len(_entradas),
+            "max_entradas": DASHBOARD_CACHE_MAX,
+            "pid": os.getpid(),
+        }
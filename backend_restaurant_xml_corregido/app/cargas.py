@@ -0,0 +1,111 @@
+# app/cargas.py
+"""
+Registro de cargas por hash: si llega un archivo idéntico (mismo SHA-256) a
+uno ya procesado, se devuelve el resultado guardado sin parsear ni consultar
+documento por documento. Con forzar=True los endpoints se saltan el registro.
+Cada carga guarda además los (proveedor, folio) que traía (cargas_facturas),
+para que eliminar una factura olvide solo los archivos que la contenían.
+"""
+import hashlib
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import or_, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app import models
+
+_BLOQUE = 1024 * 1024
+_FILAS_INSERT = 5000
+
+
+def hash_archivo(fileobj) -> (str, int):
+    """SHA-256 y tamaño de un archivo leído por bloques; lo deja rebobinado."""
+    h = hashlib.sha256()
+    tamano = 0
+    for bloque in iter(lambda: fileobj.read(_BLOQUE), b""):
+        h.update(bloque)
+        tamano += len(bloque)
+    fileobj.seek(0)
+    return h.hexdigest(), tamano
+
+
+def hash_bytes(contenido: bytes) -> str:
+    return hashlib.sha256(contenido).hexdigest()
+
+
+def buscar(db: Session, sha256: str) -> Optional[models.CargaArchivo]:
+    return db.query(models.CargaArchivo).filter(models.CargaArchivo.sha256 == sha256).first()
+
+
+def registrar(
+    db: Session,
+    sha256: str,
+    nombre_archivo: Optional[str],
+    tamano: Optional[int],
+    resultado: dict,
+    usuario_id: Optional[int],
+    facturas: Optional[Iterable[Tuple[int, str]]] = None,
+) -> None:
+    """
+    Guarda (o actualiza, si se forzó la recarga) el resultado de la carga, con los
+    (proveedor_id, folio) de los documentos que traía el archivo
+    (ingesta.ingerir_facturas(claves_por_origen=...)). No hace commit.
+    """
+    valores = {
+        "sha256": sha256,
+        "nombre_archivo": nombre_archivo,
+        "tamano": tamano,
+        "facturas_nuevas": resultado.get("facturas_nuevas", 0),
+        "facturas_duplicadas": resultado.get("facturas_duplicadas", 0),
+        "usuario_id": usuario_id,
+        "creada_en": datetime.utcnow(),
+    }
+    stmt = pg_insert(models.CargaArchivo).values(**valores)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.CargaArchivo.sha256],
+        set_={k: stmt.excluded[k] for k in valores if k != "sha256"},
+    ).returning(models.CargaArchivo.id)
+    carga_id = db.execute(stmt).scalar()
+
+    CF = models.CargaFactura
+    db.query(CF).filter(CF.carga_id == carga_id).delete(synchronize_session=False)
+    filas = ({"carga_id": carga_id, "proveedor_id": p, "folio": f} for p, f in (facturas or ()))
+    while True:
+        bloque = list(islice(filas, _FILAS_INSERT))
+        if not bloque:
+            break
+        db.execute(pg_insert(CF).on_conflict_do_nothing(), bloque)
+
+
+def invalidar(db: Session, facturas: Iterable[Tuple[int, str]]) -> None:
+    """
+    Olvida las cargas que traían alguna de estas facturas (proveedor_id, folio),
+    para que volver a subir esos archivos las reinserte. Las cargas sin documentos
+    registrados (anteriores a cargas_facturas) también se olvidan: no sabemos qué traían.
+    """
+    facturas = list(facturas)
+    if not facturas:
+        return
+    CA, CF = models.CargaArchivo, models.CargaFactura
+    con_factura = db.query(CF.carga_id).filter(tuple_(CF.proveedor_id, CF.folio).in_(facturas))
+    sin_documentos = ~db.query(CF.carga_id).filter(CF.carga_id == CA.id).exists()
+    db.query(CA).filter(or_(CA.id.in_(con_factura), sin_documentos)).delete(synchronize_session=False)
+
+
+def respuesta_previa(carga: models.CargaArchivo) -> dict:
+    total = (carga.facturas_nuevas or 0) + (carga.facturas_duplicadas or 0)
+    return {
+        "mensaje": "El archivo XML ya había sido cargado. No se registraron nuevas facturas.",
+        "facturas_nuevas": 0,
+        "facturas_duplicadas": total,
+        "carga_previa": {
+            "fecha": carga.creada_en,
+            "usuario_id": carga.usuario_id,
+            "nombre_archivo": carga.nombre_archivo,
+            "facturas_nuevas": carga.facturas_nuevas,
+            "facturas_duplicadas": carga.facturas_duplicadas,
+        },
+    }
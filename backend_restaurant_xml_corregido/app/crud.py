@@ -1,8 +1,8 @@
 # app/crud.py
 from __future__ import annotations
 
-from datetime import datetime, date
-from typing import Optional, Dict, Any
+from datetime import datetime, date, timedelta
+from typing import Optional, Dict, Any, Iterable, Iterator, List, Tuple
 
 import re
 import unicodedata
@@ -10,11 +10,12 @@ import string
 import hashlib
 
 from fastapi import HTTPException
-from sqlalchemy import func, desc
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func, desc, text, case, update, tuple_, cast, Date
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session, joinedload, aliased
 
-from app import models
+from app import models, paginacion, cache_dashboard
+from app.rut import normalizar_rut
 
 
 # ---------------------
@@ -30,33 +31,11 @@ def obtener_todas_las_facturas(db: Session, limit: int = 100, offset: int = 0):
         .all()
     )
 
-def obtener_cod_admin_y_maestro(db: Session, codigo_producto: str) -> Tuple[Optional[int], Optional[models.CodigoAdminMaestro]]:
-    """
-    Busca un producto por código y si tiene cod_admin_id devuelve:
-    (cod_admin_id, objeto CodigoAdminMaestro). Si no, (None, None).
-    """
-    producto_existente = (
-        db.query(models.Producto)
-        .filter(models.Producto.codigo == codigo_producto)
-        .order_by(models.Producto.id.desc())  # por si hay varios
-        .first()
-    )
-    if producto_existente and producto_existente.cod_admin_id:
-        cod_admin = (
-            db.query(models.CodigoAdminMaestro)
-            .filter(models.CodigoAdminMaestro.id == producto_existente.cod_admin_id)
-            .first()
-        )
-        return producto_existente.cod_admin_id, cod_admin
-
-    return None, None
-
 def buscar_facturas_por_rut_proveedor(db: Session, rut: str):
-    rut = (rut or "").replace(".", "").strip().lower()
     return (
         db.query(models.Factura)
         .join(models.Proveedor)
-        .filter(func.replace(func.lower(models.Proveedor.rut), ".", "") == rut)
+        .filter(models.Proveedor.rut_norm == normalizar_rut(rut))
         .all()
     )
 
@@ -69,7 +48,13 @@ def asignar_negocio_a_factura(db: Session, factura_id: int, negocio_id: int):
     factura = db.query(models.Factura).get(factura_id)
     if not factura:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
+    claves = claves_resumen(db, factura_ids=[factura_id])
     factura.negocio_id = negocio_id
+    db.query(models.UltimoDetalle).filter(models.UltimoDetalle.factura_id == factura_id).update(
+        {"negocio_id": negocio_id}, synchronize_session=False
+    )
+    db.flush()
+    refrescar_resumen_mensual(db, claves + claves_resumen(db, factura_ids=[factura_id]))
     db.commit()
     db.refresh(factura)
     return factura
@@ -79,93 +64,98 @@ def asignar_negocio_a_factura(db: Session, factura_id: int, negocio_id: int):
 # NEGOCIOS
 # ---------------------
 
-def _rut_norm_basic(rut: Optional[str]) -> Optional[str]:
-    if not rut:
-        return None
-    s = re.sub(r"\.", "", rut).strip()
-    s = s.replace("K", "k")
-    m = re.match(r"^(\d+)-([0-9k])$", s)
-    if m:
-        return f"{m.group(1)}-{m.group(2)}"
-    m2 = re.match(r"^(\d+)([0-9k])$", s)
-    if m2:
-        return f"{m2.group(1)}-{m2.group(2)}"
-    s = re.sub(r"[^0-9k]", "", s)
-    return f"{s[:-1]}-{s[-1]}" if len(s) >= 2 else (s or None)
-
-
 def obtener_negocios(db: Session):
     return db.query(models.NombreNegocio).order_by(models.NombreNegocio.id.asc()).all()
 
 
-def upsert_negocio_by_receptor(
+def cambios_negocio(actual, receptor: dict) -> Dict[str, str]:
+    """Campos del receptor que rellenan datos faltantes del negocio (sin pisar los existentes)."""
+    cambios = {}
+    for campo in ("razon_social", "correo", "direccion"):
+        valor = (receptor.get(campo) or "").strip() or None
+        if valor and not getattr(actual, campo):
+            cambios[campo] = valor
+    return cambios
+
+
+_CAMPOS_NEGOCIO = ("razon_social", "correo", "direccion")
+
+
+def upsert_negocios_lote(
     db: Session,
-    receptor: dict,
-    negocio_hint: Optional[str] = None,
-) -> Optional[models.NombreNegocio]:
+    receptores: Iterable[Tuple[dict, Optional[str]]],
+) -> Dict[str, Dict[str, Any]]:
     """
-    Upsert por rut_receptor (normalizado). Si ya existe:
-    - rellena campos faltantes (razon_social/correo/direccion) sin pisar datos.
+    Upsert por rut_receptor (normalizado) de muchos (receptor, negocio_hint) a la vez.
+    Devuelve rut_receptor -> {"id", "razon_social", "correo", "direccion"}.
+
+    - existentes por rut: 1 SELECT; solo se rellenan campos vacíos, con la regla de
+      cambios_negocio (UPDATE si hay cambios)
+    - nuevos: si hay un negocio manual sin rut con el mismo nombre se le asigna el rut;
+      si el nombre ya lo usa otro RUT se le agrega el RUT al nombre (nombre es único)
+    - el INSERT es ON CONFLICT (rut_receptor): una carga concurrente que ya lo creó
+      no rompe la transacción, solo rellena campos faltantes
     """
-    if not receptor:
-        return None
-
-    rut = _rut_norm_basic(receptor.get("rut"))
-    if not rut:
-        return None
+    N = models.NombreNegocio
+    datos = {}  # rut -> fila; el primer valor no vacío de cada campo gana
+    for receptor, negocio_hint in receptores:
+        receptor = receptor or {}
+        rut = normalizar_rut(receptor.get("rut"))
+        if not rut:
+            continue
+        campos = {c: (receptor.get(c) or "").strip() or None for c in _CAMPOS_NEGOCIO}
+        if rut in datos:
+            for c, v in campos.items():
+                datos[rut][c] = datos[rut][c] or v
+            continue
+        nombre = (receptor.get("razon_social") or negocio_hint or rut or "Negocio sin nombre").strip()
+        datos[rut] = {"rut_receptor": rut, "nombre": nombre, **campos}
+    if not datos:
+        return {}
+
+    resultado = {}
+    for neg_id, rut, *valores in db.query(N.id, N.rut_receptor, N.razon_social, N.correo, N.direccion).filter(
+        N.rut_receptor.in_(datos)
+    ):
+        actual = dict(zip(_CAMPOS_NEGOCIO, valores))
+        cambios = {c: datos[rut][c] for c in _CAMPOS_NEGOCIO if datos[rut][c] and not actual[c]}
+        if cambios:
+            db.query(N).filter(N.id == neg_id).update(cambios, synchronize_session=False)
+            actual.update(cambios)
+        resultado[rut] = {"id": neg_id, **actual}
+
+    nuevos = [datos[rut] for rut in sorted(datos) if rut not in resultado]
+    if not nuevos:
+        return resultado
+
+    # nombres ya usados (negocios manuales sin rut o de otro RUT)
+    ocupados = {
+        nombre_l: (neg_id, rut)
+        for neg_id, nombre_l, rut in db.query(N.id, func.lower(N.nombre), N.rut_receptor).filter(
+            func.lower(N.nombre).in_({f["nombre"].lower() for f in nuevos})
+        )
+    }
+    usados = set()
+    for fila in nuevos:
+        nombre_l = fila["nombre"].lower()
+        previo = ocupados.get(nombre_l)
+        if previo and previo[1] is None and nombre_l not in usados:
+            # negocio creado a mano con ese nombre: toma el rut y el upsert de abajo rellena el resto
+            db.query(N).filter(N.id == previo[0], N.rut_receptor.is_(None)).update(
+                {"rut_receptor": fila["rut_receptor"]}, synchronize_session=False
+            )
+        elif previo or nombre_l in usados:
+            fila["nombre"] = f"{fila['nombre']} ({fila['rut_receptor']})"
+        usados.add(nombre_l)
 
-    existente = (
-        db.query(models.NombreNegocio)
-        .filter(models.NombreNegocio.rut_receptor == rut)
-        .first()
-    )
-    if existente:
-        changed = False
-        rs = (receptor.get("razon_social") or "").strip() or None
-        co = (receptor.get("correo") or "").strip() or None
-        di = (receptor.get("direccion") or "").strip() or None
-
-        if not existente.razon_social and rs:
-            existente.razon_social = rs
-            changed = True
-        if not existente.correo and co:
-            existente.correo = co
-            changed = True
-        if not existente.direccion and di:
-            existente.direccion = di
-            changed = True
-
-        if changed:
-            db.add(existente)
-            db.flush()
-        return existente
-
-    nombre = (receptor.get("razon_social") or negocio_hint or rut or "Negocio sin nombre").strip()
-
-    por_nombre = (
-        db.query(models.NombreNegocio)
-        .filter(func.lower(models.NombreNegocio.nombre) == nombre.lower())
-        .first()
-    )
-    if por_nombre and not por_nombre.rut_receptor:
-        por_nombre.rut_receptor = rut
-        por_nombre.razon_social = por_nombre.razon_social or (receptor.get("razon_social") or "").strip() or None
-        por_nombre.correo = por_nombre.correo or (receptor.get("correo") or "").strip() or None
-        por_nombre.direccion = por_nombre.direccion or (receptor.get("direccion") or "").strip() or None
-        db.add(por_nombre)
-        db.flush()
-        return por_nombre
-
-    nuevo = models.NombreNegocio(
-        nombre=nombre,
-        rut_receptor=rut,
-        razon_social=(receptor.get("razon_social") or "").strip() or None,
-        correo=(receptor.get("correo") or "").strip() or None,
-        direccion=(receptor.get("direccion") or "").strip() or None,
-    )
-    db.add(nuevo)
-    db.flush()
-    return nuevo
+    stmt = pg_insert(N).values(nuevos)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[N.rut_receptor],
+        set_={c: func.coalesce(func.nullif(N.__table__.c[c], ""), stmt.excluded[c]) for c in _CAMPOS_NEGOCIO},
+    ).returning(N.rut_receptor, N.id, N.razon_social, N.correo, N.direccion)
+    for rut, neg_id, *valores in db.execute(stmt):
+        resultado[rut] = {"id": neg_id, **dict(zip(_CAMPOS_NEGOCIO, valores))}
+    return resultado
 
 
 def crear_negocio_manual(db: Session, data) -> models.NombreNegocio:
@@ -173,7 +163,7 @@ def crear_negocio_manual(db: Session, data) -> models.NombreNegocio:
     data: NombreNegocioCreate (Pydantic). Lo tipamos genérico para evitar imports circulares.
     Acepta: nombre, rut (opcional), razon_social, correo, direccion.
     """
-    rut_n = _rut_norm_basic(getattr(data, "rut", None)) if getattr(data, "rut", None) else None
+    rut_n = normalizar_rut(getattr(data, "rut", None))
 
     if rut_n:
         existe = (
@@ -209,7 +199,7 @@ def crear_negocio_manual(db: Session, data) -> models.NombreNegocio:
 # PRODUCTOS (listado / filtros)
 # ---------------------
 
-def obtener_productos_filtrados(
+def _consulta_productos(
     db: Session,
     nombre: Optional[str] = None,
     cod_admin_id: Optional[int] = None,
@@ -218,37 +208,52 @@ def obtener_productos_filtrados(
     fecha_fin: Optional[date] = None,
     codigo: Optional[str] = None,
     folio: Optional[str] = None,
-    limit: int = 25,
-    offset: int = 0,
     negocio_id: Optional[int] = None,
     negocio_nombre: Optional[str] = None,
+    solo_ids: bool = False,
 ):
+    """
+    Consulta filtrada (sin orden ni paginación) del listado de productos; devuelve
+    (query, subq). Con solo_ids selecciona únicamente (Producto.id, fecha_emision),
+    sin leer el detalle ni cargar relaciones.
+    """
     Detalle = aliased(models.DetalleFactura)
-    Factura = aliased(models.Factura)
     Negocio = aliased(models.NombreNegocio)
+    U = models.UltimoDetalle
+
+    if solo_ids:
+        subq = db.query(
+            U.producto_id.label("producto_id"),
+            U.fecha_emision.label("fecha_emision"),
+            U.folio.label("folio"),
+            U.negocio_id.label("negocio_id"),
+        ).subquery()
+        query = (
+            db.query(models.Producto.id, subq.c.fecha_emision)
+            .outerjoin(subq, models.Producto.id == subq.c.producto_id)
+        )
+        if negocio_nombre:
+            query = query.outerjoin(Negocio, Negocio.id == subq.c.negocio_id)
+        return _filtrar_productos(
+            query, subq, Negocio, nombre, cod_admin_id, categoria_id,
+            fecha_inicio, fecha_fin, codigo, folio, negocio_id, negocio_nombre,
+        )
 
-    # subquery: toma el ÚLTIMO detalle por producto (por fecha/id)
+    # ÚLTIMO detalle por producto (por fecha/id): sale de la proyección ultimo_detalle
     subq = (
         db.query(
-            Detalle.producto_id.label("producto_id"),
+            U.producto_id.label("producto_id"),
             Detalle.precio_unitario.label("precio_unitario"),
             Detalle.cantidad.label("cant_det"),
             Detalle.iva.label("iva"),
             Detalle.otros_impuestos.label("otros_impuestos"),
             Detalle.total.label("total_neto"),
             Detalle.otros.label("otros_det"),
-            Factura.fecha_emision.label("fecha_emision"),
-            Factura.folio.label("folio"),
-            Factura.negocio_id.label("negocio_id"),
-        )
-        .join(Factura, Factura.id == Detalle.factura_id)
-        .filter(Factura.fecha_emision.isnot(None))
-        .order_by(
-            Detalle.producto_id,
-            desc(Factura.fecha_emision),
-            desc(Detalle.id),
+            U.fecha_emision.label("fecha_emision"),
+            U.folio.label("folio"),
+            U.negocio_id.label("negocio_id"),
         )
-        .distinct(Detalle.producto_id)
+        .join(Detalle, Detalle.id == U.detalle_id)
         .subquery()
     )
 
@@ -278,12 +283,18 @@ def obtener_productos_filtrados(
             models.Producto.cod_admin_id == models.CodigoAdminMaestro.id,
         )
     )
+    return _filtrar_productos(
+        query, subq, Negocio, nombre, cod_admin_id, categoria_id,
+        fecha_inicio, fecha_fin, codigo, folio, negocio_id, negocio_nombre,
+    )
 
+
+def _filtrar_productos(
+    query, subq, Negocio, nombre, cod_admin_id, categoria_id,
+    fecha_inicio, fecha_fin, codigo, folio, negocio_id, negocio_nombre,
+):
     if nombre:
-        like = f"%{nombre}%"
-        query = query.filter(
-            func.coalesce(models.CodigoAdminMaestro.nombre_producto, models.Producto.nombre).ilike(like)
-        )
+        query = query.filter(models.Producto.nombre_busqueda.like(f"%{texto_busqueda(nombre)}%"))
     if codigo:
         query = query.filter(models.Producto.codigo.ilike(f"%{codigo}%"))
     if folio:
@@ -308,20 +319,16 @@ def obtener_productos_filtrados(
     elif ff:
         query = query.filter(subq.c.fecha_emision <= ff)
 
-    total = query.order_by(None).with_entities(func.count(models.Producto.id)).scalar() or 0
+    return query, subq
 
-    resultados = (
-        query.order_by(
-            subq.c.fecha_emision.desc().nullslast(),
-            models.Producto.id.desc(),
-        )
-        .offset(offset)
-        .limit(limit)
-        .all()
-    )
 
-    items = []
-    for (
+def _orden_productos(subq):
+    return (subq.c.fecha_emision.desc().nullslast(), models.Producto.id.desc())
+
+
+def _item_producto(fila) -> Dict[str, Any]:
+    """Dict del listado para una fila de _consulta_productos."""
+    (
         producto,
         precio_unitario,
         cant_det,
@@ -333,159 +340,281 @@ def obtener_productos_filtrados(
         folio_val,
         negocio_id_val,
         negocio_nombre_val,
-    ) in resultados:
-        cantidad = float(cant_det or 0.0)
-        neto = float(total_neto_subq or 0.0)
-
-        um = 1.0
-        porcentaje_adicional = 0.0
-        if producto.cod_admin:
-            try:
-                um = float(producto.cod_admin.um or 1.0)
-            except Exception:
-                um = 1.0
-            porcentaje_adicional = float(producto.cod_admin.porcentaje_adicional or 0.0)
-
-        imp_adicional = neto * porcentaje_adicional
-        otros = float(otros_subq or 0.0)
-        total_costo = neto + imp_adicional + otros
-        denom = (cantidad * um) if (cantidad and um) else 0.0
-        costo_unitario = (total_costo / denom) if denom else 0.0
-
-        ca = producto.cod_admin
-        cod_admin_dict = None
-        if ca:
-            cod_admin_dict = {
-                "id": ca.id,
-                "cod_admin": ca.cod_admin,
-                "nombre_producto": ca.nombre_producto,
-                "um": um,
-                "familia": ca.familia,
-                "area": ca.area,
-                "porcentaje_adicional": porcentaje_adicional,
-            }
-
-        cat = producto.categoria
-        categoria_dict = {"id": cat.id, "nombre": cat.nombre} if cat else None
-
-        cl = producto.cod_lec
-        cod_lec_dict = None
-        cod_lectura_val = None
-        if cl:
-            cod_lec_dict = {
-                "id": cl.id,
-                "valor": cl.valor,
-                "nombre_norm": cl.nombre_norm,
-                "codigo_origen": cl.codigo_origen,
-                "rut_proveedor": cl.rut_proveedor,
-                "cod_admin_id": cl.cod_admin_id,
-            }
-            cod_lectura_val = cl.valor
-
-        items.append({
-            "id": producto.id,
-            "nombre": producto.nombre,
-            "nombre_maestro": (ca.nombre_producto if ca else None),
-            "codigo": producto.codigo,
-            "unidad": producto.unidad,
-            "cantidad": cantidad,
-            "proveedor_id": producto.proveedor_id,
-            "categoria_id": producto.categoria_id,
-            "cod_admin_id": producto.cod_admin_id,
-            "cod_admin": cod_admin_dict,
-            "cod_lec": cod_lec_dict,
-            "cod_lectura": cod_lectura_val,
-            "precio_unitario": float(precio_unitario or 0.0),
-            "iva": float(iva or 0.0),
-            "otros_impuestos": float(otros_impuestos or 0.0),
-            "total_neto": neto,
+    ) = fila
+    cantidad = float(cant_det or 0.0)
+    neto = float(total_neto_subq or 0.0)
+
+    um = 1.0
+    porcentaje_adicional = 0.0
+    if producto.cod_admin:
+        try:
+            um = float(producto.cod_admin.um or 1.0)
+        except Exception:
+            um = 1.0
+        porcentaje_adicional = float(producto.cod_admin.porcentaje_adicional or 0.0)
+
+    imp_adicional = neto * porcentaje_adicional
+    otros = float(otros_subq or 0.0)
+    total_costo = neto + imp_adicional + otros
+    denom = (cantidad * um) if (cantidad and um) else 0.0
+    costo_unitario = (total_costo / denom) if denom else 0.0
+
+    ca = producto.cod_admin
+    cod_admin_dict = None
+    if ca:
+        cod_admin_dict = {
+            "id": ca.id,
+            "cod_admin": ca.cod_admin,
+            "nombre_producto": ca.nombre_producto,
+            "um": um,
+            "familia": ca.familia,
+            "area": ca.area,
             "porcentaje_adicional": porcentaje_adicional,
-            "imp_adicional": imp_adicional,
-            "otros": otros,
-            "categoria": categoria_dict,
-            "folio": folio_val,
-            "fecha_emision": fecha_emision,
-            "total_costo": total_costo,
-            "costo_unitario": costo_unitario,
-            "negocio_id": int(negocio_id_val) if negocio_id_val is not None else None,
-            "negocio_nombre": negocio_nombre_val,
-        })
+        }
 
-    return {"items": items, "total": total}
+    cat = producto.categoria
+    categoria_dict = {"id": cat.id, "nombre": cat.nombre} if cat else None
+
+    cl = producto.cod_lec
+    cod_lec_dict = None
+    cod_lectura_val = None
+    if cl:
+        cod_lec_dict = {
+            "id": cl.id,
+            "valor": cl.valor,
+            "nombre_norm": cl.nombre_norm,
+            "codigo_origen": cl.codigo_origen,
+            "rut_proveedor": cl.rut_proveedor,
+            "cod_admin_id": cl.cod_admin_id,
+        }
+        cod_lectura_val = cl.valor
+
+    return {
+        "id": producto.id,
+        "nombre": producto.nombre,
+        "nombre_maestro": (ca.nombre_producto if ca else None),
+        "codigo": producto.codigo,
+        "unidad": producto.unidad,
+        "cantidad": cantidad,
+        "proveedor_id": producto.proveedor_id,
+        "categoria_id": producto.categoria_id,
+        "cod_admin_id": producto.cod_admin_id,
+        "cod_admin": cod_admin_dict,
+        "cod_lec": cod_lec_dict,
+        "cod_lectura": cod_lectura_val,
+        "precio_unitario": float(precio_unitario or 0.0),
+        "iva": float(iva or 0.0),
+        "otros_impuestos": float(otros_impuestos or 0.0),
+        "total_neto": neto,
+        "porcentaje_adicional": porcentaje_adicional,
+        "imp_adicional": imp_adicional,
+        "otros": otros,
+        "categoria": categoria_dict,
+        "folio": folio_val,
+        "fecha_emision": fecha_emision,
+        "total_costo": total_costo,
+        "costo_unitario": costo_unitario,
+        "negocio_id": int(negocio_id_val) if negocio_id_val is not None else None,
+        "negocio_nombre": negocio_nombre_val,
+    }
+
+
+def obtener_productos_filtrados(
+    db: Session,
+    nombre: Optional[str] = None,
+    cod_admin_id: Optional[int] = None,
+    categoria_id: Optional[int] = None,
+    fecha_inicio: Optional[date] = None,
+    fecha_fin: Optional[date] = None,
+    codigo: Optional[str] = None,
+    folio: Optional[str] = None,
+    limit: int = 25,
+    offset: int = 0,
+    negocio_id: Optional[int] = None,
+    negocio_nombre: Optional[str] = None,
+    cursor: Optional[str] = None,
+    total_modo: str = "exacto",
+):
+    """
+    Productos con su último detalle, ordenados por fecha_emision DESC, id DESC.
+    Pagina por `cursor` (keyset, ver app/paginacion.py) o, si no viene, por offset.
+    """
+    query, subq = _consulta_productos(
+        db, nombre=nombre, cod_admin_id=cod_admin_id, categoria_id=categoria_id,
+        fecha_inicio=fecha_inicio, fecha_fin=fecha_fin, codigo=codigo, folio=folio,
+        negocio_id=negocio_id, negocio_nombre=negocio_nombre,
+    )
+    total = paginacion.contar(query, total_modo, models.Producto.id)
+
+    if cursor:
+        query = query.filter(paginacion.despues_de(subq.c.fecha_emision, models.Producto.id, cursor))
+        offset = 0
+    resultados, next_cursor, has_more = paginacion.paginar(
+        query,
+        _orden_productos(subq),
+        limit,
+        lambda fila: (fila.fecha_emision, fila[0].id),
+        offset=offset,
+    )
+
+    items = [_item_producto(fila) for fila in resultados]
+    return {"items": items, "total": total, "next_cursor": next_cursor, "has_more": has_more}
+
+
+def obtener_ids_productos_filtrados(
+    db: Session,
+    max_ids: int = 5000,
+    total_modo: str = "exacto",
+    vecino_de: Optional[int] = None,
+    **filtros,
+) -> Dict[str, Any]:
+    """
+    Ids del listado de productos (mismos filtros y orden que obtener_productos_filtrados)
+    sin cargar los productos. Con vecino_de devuelve solo el anterior / siguiente de
+    ese producto en la lista y su posición (1-based; None si no pasa los filtros o
+    si total_modo es "ninguno", porque también hay que contar).
+    """
+    query, subq = _consulta_productos(db, solo_ids=True, **filtros)
+    total = paginacion.contar(query, total_modo, models.Producto.id)
+
+    if vecino_de is None:
+        ids = [pid for pid, _ in query.order_by(*_orden_productos(subq)).limit(max_ids)]
+        return {"ids": ids, "total": total}
+
+    fila = query.filter(models.Producto.id == vecino_de).first()
+    if fila is not None:
+        fecha = fila.fecha_emision
+    else:
+        if not db.query(models.Producto.id).filter(models.Producto.id == vecino_de).first():
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        fecha = db.query(models.UltimoDetalle.fecha_emision).filter(
+            models.UltimoDetalle.producto_id == vecino_de
+        ).scalar()
+
+    fecha_col, id_col = subq.c.fecha_emision, models.Producto.id
+    antes = query.filter(paginacion.antes_de_fila(fecha_col, id_col, fecha, vecino_de))
+    siguiente = (
+        query.filter(paginacion.despues_de_fila(fecha_col, id_col, fecha, vecino_de))
+        .order_by(*_orden_productos(subq)).first()
+    )
+    anterior = antes.order_by(fecha_col.asc().nullsfirst(), id_col.asc()).first()
+    posicion = None
+    if fila is not None and total_modo != "ninguno":
+        posicion = antes.order_by(None).with_entities(func.count(id_col)).scalar() + 1
+    return {
+        "id": vecino_de,
+        "prev": anterior[0] if anterior else None,
+        "next": siguiente[0] if siguiente else None,
+        "posicion": posicion,
+        "total": total,
+    }
+
+
+def iterar_productos_filtrados(db: Session, tamano_bloque: int = 1000, **filtros) -> Iterator[Dict[str, Any]]:
+    """
+    Mismo listado que obtener_productos_filtrados, completo y sin paginar, leído
+    con un cursor del servidor (yield_per): en memoria hay un bloque a la vez.
+    Para exportaciones.
+    """
+    query, subq = _consulta_productos(db, **filtros)
+    filas = (
+        query.order_by(*_orden_productos(subq))
+        .yield_per(tamano_bloque)
+    )
+    for fila in filas:
+        yield _item_producto(fila)
 
 
 def buscar_producto_por_nombre(db: Session, nombre: str):
-    like = f"%{nombre}%"
     return (
         db.query(models.Producto)
-        .outerjoin(models.CodigoAdminMaestro, models.Producto.cod_admin_id == models.CodigoAdminMaestro.id)
-        .filter(func.coalesce(models.CodigoAdminMaestro.nombre_producto, models.Producto.nombre).ilike(like))
+        .filter(models.Producto.nombre_busqueda.like(f"%{texto_busqueda(nombre)}%"))
         .all()
     )
 
 
-def obtener_producto_por_id(db: Session, producto_id: int) -> Optional[Dict[str, Any]]:
-    producto = (
-        db.query(models.Producto)
+def obtener_ficha_producto(db: Session, producto_id: int) -> Dict[str, Any]:
+    """
+    Producto (con proveedor, categoría y cod_admin) y el desglose de costo de su
+    último detalle, en una sola consulta: el último detalle sale de ultimo_detalle
+    en vez de buscarlo en todo el historial (solo los productos cuyas facturas no
+    traen fecha, que no están en ultimo_detalle, lo buscan en el historial).
+    Forma de schemas.ProductoConPrecio.
+    """
+    U = models.UltimoDetalle
+    D = models.DetalleFactura
+    fila = (
+        db.query(models.Producto, D, U.folio)
+        .outerjoin(U, U.producto_id == models.Producto.id)
+        .outerjoin(D, D.id == U.detalle_id)
         .options(
             joinedload(models.Producto.proveedor),
             joinedload(models.Producto.categoria),
             joinedload(models.Producto.cod_admin),
-            joinedload(models.Producto.cod_lec),
         )
         .filter(models.Producto.id == producto_id)
         .first()
     )
-    if not producto:
-        return None
-
-    cod_lec = producto.cod_lec
-    cod_lectura_val = cod_lec.valor if cod_lec else None
-
-    cod_admin = producto.cod_admin
-    cod_admin_dict = None
-    if cod_admin:
-        um_val = cod_admin.um
-        try:
-            um_val = float(um_val) if um_val is not None else None
-        except Exception:
-            um_val = None
-
-        cod_admin_dict = {
-            "id": cod_admin.id,
-            "cod_admin": cod_admin.cod_admin,
-            "nombre_producto": cod_admin.nombre_producto,
-            "familia": cod_admin.familia,
-            "area": cod_admin.area,
-            "um": um_val,
-            "porcentaje_adicional": float(cod_admin.porcentaje_adicional or 0.0),
-        }
-
-    categoria = producto.categoria
-    categoria_dict = {"id": categoria.id, "nombre": categoria.nombre} if categoria else None
+    if not fila:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    producto, detalle, folio = fila
+    if detalle is None:
+        # ultimo_detalle solo considera facturas con fecha de emisión: si todas las
+        # del producto vienen sin fecha, el último es el de mayor id en el historial
+        fila = (
+            db.query(D, models.Factura.folio)
+            .join(models.Factura, models.Factura.id == D.factura_id)
+            .filter(D.producto_id == producto_id)
+            .order_by(D.id.desc())
+            .first()
+        )
+        if fila:
+            detalle, folio = fila
 
-    return {
+    porcentaje_adicional = producto.cod_admin.porcentaje_adicional if producto.cod_admin else 0.0
+    base = {
         "id": producto.id,
         "nombre": producto.nombre,
         "codigo": producto.codigo,
         "unidad": producto.unidad,
-        "cantidad": producto.cantidad,
+        "proveedor": producto.proveedor,
         "proveedor_id": producto.proveedor_id,
         "categoria_id": producto.categoria_id,
         "cod_admin_id": producto.cod_admin_id,
-        "cod_admin": cod_admin_dict,
-        "categoria": categoria_dict,
-        "cod_lec": (
-            {
-                "id": cod_lec.id,
-                "valor": cod_lec.valor,
-                "nombre_norm": cod_lec.nombre_norm,
-                "codigo_origen": cod_lec.codigo_origen,
-                "rut_proveedor": cod_lec.rut_proveedor,
-                "cod_admin_id": cod_lec.cod_admin_id,
-            } if cod_lec else None
-        ),
-        "cod_lectura": cod_lectura_val,
+        "porcentaje_adicional": porcentaje_adicional,
+        "categoria": producto.categoria,
+        "cod_admin": producto.cod_admin,
+    }
+    if not detalle:
+        return {
+            **base, "cantidad": 0, "precio_unitario": 0, "iva": 0, "otros_impuestos": 0,
+            "total": 0, "imp_adicional": 0, "total_neto": 0, "costo_unitario": 0,
+            "total_costo": 0, "otros": 0,
+        }
+
+    total_costo = detalle.total + detalle.imp_adicional + (detalle.otros or 0)
+    um_factor = 1.0
+    if producto.cod_admin and producto.cod_admin.um:
+        try:
+            um_factor = float(producto.cod_admin.um)
+        except Exception:
+            um_factor = 1.0
+    denom = (detalle.cantidad or 0) * um_factor
+    costo_unitario = (total_costo / denom) if denom else 0
+
+    return {
+        **base,
+        "cantidad": detalle.cantidad,
+        "precio_unitario": detalle.precio_unitario,
+        "iva": detalle.iva,
+        "otros_impuestos": detalle.otros_impuestos,
+        "total": detalle.total,
+        "imp_adicional": detalle.imp_adicional,
+        "total_neto": detalle.total,
+        "costo_unitario": costo_unitario,
+        "total_costo": total_costo,
+        "otros": detalle.otros,
+        "folio": folio,
     }
 
 
@@ -525,54 +654,88 @@ def obtener_historial_precios(db: Session, producto_id: int):
     )
 
 
-def recalcular_imp_adicional_detalles_producto(db: Session, producto_id: int):
-    producto = (
-        db.query(models.Producto)
-        .options(joinedload(models.Producto.cod_admin))
-        .filter(models.Producto.id == producto_id)
-        .first()
-    )
-    if not producto:
-        raise HTTPException(status_code=404, detail="Producto no encontrado")
-
-    porcentaje = float(producto.cod_admin.porcentaje_adicional or 0.0) if producto.cod_admin else 0.0
-
-    um = 1.0
-    if producto.cod_admin and producto.cod_admin.um is not None:
-        try:
-            um = float(producto.cod_admin.um)
-        except Exception:
-            um = 1.0
+def recalcular_detalles(
+    db: Session,
+    producto_ids: Optional[Iterable[int]] = None,
+    cod_admin_ids: Optional[Iterable[int]] = None,
+) -> int:
+    """
+    Recalcula total / imp_adicional / total_costo / costo_unitario de los detalles
+    en un solo UPDATE ... FROM, con la misma fórmula de la ingesta:
+      neto = precio_unitario * cantidad * (-1 si nota de crédito)
+      imp_adicional = neto * cod_admin.porcentaje_adicional
+      total_costo = neto + imp_adicional + otros
+      costo_unitario = total_costo / (cantidad * um)   (um vacío o 0 -> 1)
+    Filtra por productos y/o por cod_admin de los productos (sin filtros: todos).
+    No hace commit. Devuelve cuántos detalles se actualizaron.
+    """
+    D = models.DetalleFactura
+    F = models.Factura
+    P = models.Producto
+    CA = models.CodigoAdminMaestro
 
-    detalles = (
-        db.query(models.DetalleFactura)
-        .options(joinedload(models.DetalleFactura.factura))
-        .filter(models.DetalleFactura.producto_id == producto_id)
-        .all()
+    base = (
+        db.query(
+            D.id.label("id"),
+            case((F.es_nota_credito.is_(True), -1.0), else_=1.0).label("signo"),
+            func.coalesce(CA.porcentaje_adicional, 0.0).label("porcentaje"),
+            func.coalesce(func.nullif(CA.um, 0), 1.0).label("um"),
+        )
+        .join(P, P.id == D.producto_id)
+        .outerjoin(F, F.id == D.factura_id)
+        .outerjoin(CA, CA.id == P.cod_admin_id)
     )
+    if producto_ids is not None:
+        base = base.filter(P.id.in_(list(producto_ids)))
+    if cod_admin_ids is not None:
+        base = base.filter(P.cod_admin_id.in_(list(cod_admin_ids)))
+    s = base.subquery()
+
+    neto = func.coalesce(D.precio_unitario, 0.0) * func.coalesce(D.cantidad, 0.0) * s.c.signo
+    total_costo = neto + neto * s.c.porcentaje + func.coalesce(D.otros, 0)
+    denom = func.coalesce(D.cantidad, 0.0) * s.c.um
+
+    stmt = (
+        update(D)
+        .where(D.id == s.c.id)
+        .values(
+            total=neto,
+            imp_adicional=neto * s.c.porcentaje,
+            total_costo=total_costo,
+            costo_unitario=case((denom != 0, total_costo / denom), else_=0.0),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    actualizados = db.execute(stmt).rowcount
+    if producto_ids is None and cod_admin_ids is None:
+        refrescar_resumen_mensual(db)
+    else:
+        refrescar_resumen_mensual(db, claves_resumen(db, producto_ids=producto_ids, cod_admin_ids=cod_admin_ids))
+    return actualizados
 
-    for d in detalles:
-        sign = -1 if (d.factura and getattr(d.factura, "es_nota_credito", False)) else 1
-        neto = float(d.precio_unitario or 0.0) * float(d.cantidad or 0.0) * sign
-        imp_ad = neto * porcentaje
-        otros = float(d.otros or 0.0)
-
-        d.total = neto
-        d.imp_adicional = imp_ad
-        d.total_costo = neto + imp_ad + otros
 
-        denom = float(d.cantidad or 0.0) * float(um or 1.0)
-        d.costo_unitario = (d.total_costo / denom) if denom else 0.0
+def recalcular_imp_adicional_detalles_producto(db: Session, producto_id: int):
+    existe = db.query(models.Producto.id).filter(models.Producto.id == producto_id).first()
+    if not existe:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
 
+    recalcular_detalles(db, producto_ids=[producto_id])
     db.commit()
 
 
 def actualizar_otros_en_ultimo_detalle(db: Session, producto_id: int, otros: int):
+    D = models.DetalleFactura
+    # el mismo "último" que muestran el listado y la ficha (ultimo_detalle); sin
+    # fila ahí (facturas sin fecha) se toma el de mayor id del historial
     detalle = (
-        db.query(models.DetalleFactura)
-        .join(models.Factura, models.Factura.id == models.DetalleFactura.factura_id)
-        .filter(models.DetalleFactura.producto_id == producto_id)
-        .order_by(models.Factura.fecha_emision.desc(), models.DetalleFactura.id.desc())
+        db.query(D)
+        .join(models.UltimoDetalle, models.UltimoDetalle.detalle_id == D.id)
+        .filter(models.UltimoDetalle.producto_id == producto_id)
+        .first()
+    ) or (
+        db.query(D)
+        .filter(D.producto_id == producto_id)
+        .order_by(D.id.desc())
         .first()
     )
     if not detalle:
@@ -601,12 +764,17 @@ def actualizar_otros_en_ultimo_detalle(db: Session, producto_id: int, otros: int
     denom = float(detalle.cantidad or 0.0) * float(um or 1.0)
     detalle.costo_unitario = (detalle.total_costo / denom) if denom else 0.0
 
+    db.flush()
+    refrescar_resumen_mensual(db, claves_resumen(db, factura_ids=[detalle.factura_id]))
     db.commit()
     db.refresh(detalle)
     return detalle
 
 
-def actualizar_porcentaje_adicional(db: Session, producto_id: int, nuevo_porcentaje: float):
+def actualizar_porcentaje_adicional(
+    db: Session, producto_id: int, nuevo_porcentaje: float
+) -> Tuple[models.Producto, bool]:
+    """Cambia el porcentaje del cod_admin del producto. Devuelve (producto, cambió)."""
     producto = db.query(models.Producto).filter_by(id=producto_id).first()
     if producto is None:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
@@ -617,18 +785,52 @@ def actualizar_porcentaje_adicional(db: Session, producto_id: int, nuevo_porcent
             detail="El producto no tiene código admin asignado. Asigna un código admin antes de editar el porcentaje."
         )
 
-    cod = db.query(models.CodigoAdminMaestro).get(producto.cod_admin_id)
+    _, cambio = actualizar_cod_admin_maestro(db, producto.cod_admin_id, porcentaje_adicional=nuevo_porcentaje)
+    if not cambio:
+        return producto, False
+
+    # este producto se recalcula al tiro; el resto de los que comparten cod_admin
+    # queda para la tarea "recalculo_cod_admin" (tareas.encolar_recalculo_cod_admin)
+    recalcular_imp_adicional_detalles_producto(db, producto_id)
+    db.refresh(producto)
+    return producto, True
+
+
+def actualizar_cod_admin_maestro(
+    db: Session,
+    cod_admin_id: int,
+    porcentaje_adicional: Optional[float] = None,
+    um: Optional[float] = None,
+    nombre_producto: Optional[str] = None,
+) -> Tuple[models.CodigoAdminMaestro, bool]:
+    """
+    Cambia porcentaje_adicional, um y/o nombre_producto de un cod_admin. Devuelve
+    (cod_admin, cambió): si cambió porcentaje o um, los detalles de todos sus
+    productos quedan desactualizados y hay que recalcularlos
+    (recalcular_detalles(cod_admin_ids=[...]), o la tarea). El nombre solo toca
+    el nombre_busqueda de sus productos, que se refresca aquí mismo.
+    """
+    cod = db.query(models.CodigoAdminMaestro).get(cod_admin_id)
     if not cod:
         raise HTTPException(status_code=404, detail="Código admin no encontrado")
 
-    porc = max(0.0, min(1.0, float(nuevo_porcentaje or 0.0)))
-    cod.porcentaje_adicional = porc
+    cambio = False
+    if porcentaje_adicional is not None:
+        porc = max(0.0, min(1.0, float(porcentaje_adicional or 0.0)))
+        cambio = cambio or porc != (cod.porcentaje_adicional or 0.0)
+        cod.porcentaje_adicional = porc
+    if um is not None:
+        cambio = cambio or float(um) != cod.um
+        cod.um = float(um)
+    if nombre_producto is not None and nombre_producto != cod.nombre_producto:
+        cod.nombre_producto = nombre_producto
+        db.flush()
+        refrescar_nombre_busqueda(db, cod_admin_ids=[cod.id])
+
     db.add(cod)
     db.commit()
-
-    recalcular_imp_adicional_detalles_producto(db, producto_id)
-    db.refresh(producto)
-    return producto
+    db.refresh(cod)
+    return cod, cambio
 
 
 def actualizar_producto(db: Session, producto_id: int, datos):
@@ -652,24 +854,30 @@ def actualizar_producto(db: Session, producto_id: int, datos):
         setattr(producto, attr, value)
 
     db.add(producto)
-    db.commit()
-    db.refresh(producto)
+    db.flush()
 
     if cod_admin_id_cambiado:
-        recalcular_imp_adicional_detalles_producto(db, producto_id)
-
+        ids = [producto.id]
         # Si comparte cod_lec, heredar cod_admin a "hermanos"
         if producto.cod_lec_id:
-            hermanos = db.query(models.Producto).filter(
-                models.Producto.cod_lec_id == producto.cod_lec_id,
-                models.Producto.id != producto.id
-            ).all()
-            for h in hermanos:
-                h.cod_admin_id = producto.cod_admin_id
-                db.add(h)
-                recalcular_imp_adicional_detalles_producto(db, h.id)
-            db.commit()
+            hermanos = (
+                update(models.Producto)
+                .where(
+                    models.Producto.cod_lec_id == producto.cod_lec_id,
+                    models.Producto.id != producto.id,
+                )
+                .values(cod_admin_id=producto.cod_admin_id)
+                .returning(models.Producto.id)
+                .execution_options(synchronize_session=False)
+            )
+            ids += list(db.execute(hermanos).scalars())
+        recalcular_detalles(db, producto_ids=ids)
+        refrescar_nombre_busqueda(db, producto_ids=ids)
+    elif "nombre" in datos.dict(exclude_unset=True):
+        refrescar_nombre_busqueda(db, producto_ids=[producto.id])
 
+    db.commit()
+    db.refresh(producto)
     return producto
 
 
@@ -694,19 +902,42 @@ def _strip_accents(s: str) -> str:
     return "".join(ch for ch in unicodedata.normalize("NFD", s) if unicodedata.category(ch) != "Mn")
 
 
-def _normalize_rut_full(rut: str) -> str:
-    if not rut:
-        return ""
-    s = rut.strip().upper().replace(".", "")
-    s = re.sub(r"\s+", "", s)
-    m = re.match(r"^(\d+)-([0-9K])$", s)
-    if m:
-        return f"{m.group(1)}-{m.group(2)}"
-    m2 = re.match(r"^(\d+)([0-9K])$", s)
-    if m2:
-        return f"{m2.group(1)}-{m2.group(2)}"
-    cuerpo = re.sub(r"\D", "", s)
-    return cuerpo
+def texto_busqueda(s: Optional[str]) -> str:
+    """Forma con la que se guarda y se busca Producto.nombre_busqueda."""
+    return _strip_accents((s or "").strip()).lower()
+
+
+def refrescar_nombre_busqueda(
+    db: Session,
+    producto_ids: Optional[Iterable[int]] = None,
+    cod_admin_ids: Optional[Iterable[int]] = None,
+) -> int:
+    """
+    Recalcula Producto.nombre_busqueda (nombre visible normalizado) de los productos
+    dados, de los de esos cod_admin, o de todos. Solo escribe los que cambiaron; no
+    hace commit. Devuelve cuántos actualizó.
+    """
+    P, C = models.Producto, models.CodigoAdminMaestro
+    q = (
+        db.query(P.id, P.nombre_busqueda, func.coalesce(C.nombre_producto, P.nombre))
+        .outerjoin(C, C.id == P.cod_admin_id)
+    )
+    if producto_ids is not None:
+        producto_ids = list(producto_ids)
+        if not producto_ids:
+            return 0
+        q = q.filter(P.id.in_(producto_ids))
+    if cod_admin_ids is not None:
+        q = q.filter(P.cod_admin_id.in_(list(cod_admin_ids)))
+
+    cambios = []
+    for pid, actual, nombre in q:
+        nuevo = texto_busqueda(nombre)
+        if nuevo != actual:
+            cambios.append({"id": pid, "nombre_busqueda": nuevo})
+    if cambios:
+        db.execute(update(P), cambios)
+    return len(cambios)
 
 
 def _first_word_normalized(nombre: str) -> str:
@@ -734,7 +965,7 @@ def _name_fingerprint(nombre: str) -> str:
 
 
 def build_cod_lec(rut_proveedor: str, nombre_producto: str, codigo_producto: Optional[str]) -> str:
-    rut = _normalize_rut_full(rut_proveedor) or "RUTDESCONOCIDO"
+    rut = normalizar_rut(rut_proveedor) or "RUTDESCONOCIDO"
     nombre_key = _normalize_name_for_key(nombre_producto)
 
     cod_norm = _normalize_codigo(codigo_producto)
@@ -745,28 +976,47 @@ def build_cod_lec(rut_proveedor: str, nombre_producto: str, codigo_producto: Opt
     return f"{rut}_{nombre_key}_NC_{fp}"
 
 
-def _ensure_unique_cod_lec(
+def _fila_cod_lec(rut_proveedor: str, nombre_producto: str, codigo_producto: Optional[str]) -> Dict[str, Any]:
+    return {
+        "valor": build_cod_lec(rut_proveedor, nombre_producto, codigo_producto),
+        "nombre_norm": _first_word_normalized(nombre_producto),
+        "codigo_origen": codigo_producto,
+        "rut_proveedor": normalizar_rut(rut_proveedor),
+    }
+
+
+def upsert_cod_lec_lote(
     db: Session,
-    base_valor: str,
-    nombre_norm: str,
-    codigo_origen: Optional[str],
-    rut_norm: str,
-):
-    i = 1
-    while True:
-        candidate = f"{base_valor}-{i:02d}"
-        exists = db.query(models.CodigoLectura).filter(models.CodigoLectura.valor == candidate).first()
-        if not exists:
-            cod_lec = models.CodigoLectura(
-                valor=candidate,
-                nombre_norm=nombre_norm,
-                codigo_origen=codigo_origen,
-                rut_proveedor=rut_norm,
-            )
-            db.add(cod_lec)
-            db.flush()
-            return cod_lec
-        i += 1
+    items: Iterable[Tuple[str, str, Optional[str]]],
+) -> Dict[str, Tuple[int, Optional[int]]]:
+    """
+    Upsert en bloque de cod_lec para muchos (rut_proveedor, nombre_producto, codigo_producto).
+    Devuelve valor -> (id, cod_admin_id). Un INSERT ... ON CONFLICT (valor) DO NOTHING
+    RETURNING para los nuevos y un SELECT para los que ya existían (o que otra carga
+    concurrente insertó primero): nunca aborta la transacción por duplicado.
+    """
+    filas = {}
+    for rut_proveedor, nombre_producto, codigo_producto in items:
+        fila = _fila_cod_lec(rut_proveedor, nombre_producto, codigo_producto)
+        filas.setdefault(fila["valor"], fila)
+    if not filas:
+        return {}
+
+    C = models.CodigoLectura
+    # orden fijo por valor: dos cargas con claves en común bloquean en el mismo orden
+    stmt = (
+        pg_insert(C)
+        .values([filas[v] for v in sorted(filas)])
+        .on_conflict_do_nothing(index_elements=[C.valor])
+        .returning(C.valor, C.id, C.cod_admin_id)
+    )
+    resultado = {valor: (cl_id, ca_id) for valor, cl_id, ca_id in db.execute(stmt)}
+
+    faltan = filas.keys() - resultado.keys()
+    if faltan:
+        for valor, cl_id, ca_id in db.query(C.valor, C.id, C.cod_admin_id).filter(C.valor.in_(faltan)):
+            resultado[valor] = (cl_id, ca_id)
+    return resultado
 
 
 def upsert_cod_lec(db: Session, rut_proveedor: str, nombre_producto: str, codigo_producto: Optional[str]):
@@ -775,64 +1025,39 @@ def upsert_cod_lec(db: Session, rut_proveedor: str, nombre_producto: str, codigo
     if cod_lec:
         return cod_lec
 
-    nombre_norm = _first_word_normalized(nombre_producto)
-    rut_norm = _normalize_rut_full(rut_proveedor)
-
-    try:
-        cod_lec = models.CodigoLectura(
-            valor=valor,
-            nombre_norm=nombre_norm,
-            codigo_origen=codigo_producto,
-            rut_proveedor=rut_norm,
-        )
-        db.add(cod_lec)
-        db.flush()
-        return cod_lec
-    except IntegrityError:
-        db.rollback()
-        return _ensure_unique_cod_lec(db, valor, nombre_norm, codigo_producto, rut_norm)
-
-
-def _codigo_normalizado(codigo_raw: Optional[str]) -> Optional[str]:
-    if not codigo_raw:
-        return None
-    c = str(codigo_raw).strip()
-    if not c:
-        return None
-    if c.upper() == "N/A":
-        return None
-    return c
+    db.execute(
+        pg_insert(models.CodigoLectura)
+        .values(**_fila_cod_lec(rut_proveedor, nombre_producto, codigo_producto))
+        .on_conflict_do_nothing(index_elements=[models.CodigoLectura.valor])
+    )
+    return db.query(models.CodigoLectura).filter_by(valor=valor).one()
 
 
-def crear_producto_con_cod_lec(
-    db: Session,
-    proveedor: models.Proveedor,
+def datos_producto(
+    proveedor_id: int,
     nombre: str,
-    codigo: Optional[str],
+    codigo_norm: Optional[str],
     unidad: str,
     cantidad: float,
+    cod_lec_id: int,
+    cod_lec_cod_admin_id: Optional[int],
     cod_admin_id_heredado: Optional[int],
-):
-    codigo_norm = _codigo_normalizado(codigo)
-    cod_lec = upsert_cod_lec(db, proveedor.rut, nombre, codigo_norm)
-
+) -> Dict[str, Any]:
+    """Columnas del Producto con el cod_lec ya resuelto (sin tocar la BD)."""
     # preferencia: cod_lec.cod_admin_id > heredado > None
-    cod_admin_final = cod_lec.cod_admin_id if getattr(cod_lec, "cod_admin_id", None) else None
+    cod_admin_final = cod_lec_cod_admin_id or None
     if cod_admin_final is None and codigo_norm is not None and cod_admin_id_heredado:
         cod_admin_final = cod_admin_id_heredado
 
-    producto = models.Producto(
-        nombre=nombre,
-        codigo=codigo_norm,
-        unidad=unidad,
-        cantidad=cantidad,
-        proveedor_id=proveedor.id,
-        cod_lec_id=cod_lec.id,
-        cod_admin_id=cod_admin_final,
-    )
-    db.add(producto)
-    db.flush()
-    return producto
+    return {
+        "nombre": nombre,
+        "codigo": codigo_norm,
+        "unidad": unidad,
+        "cantidad": cantidad,
+        "proveedor_id": proveedor_id,
+        "cod_lec_id": cod_lec_id,
+        "cod_admin_id": cod_admin_final,
+    }
 
 
 def asignar_cod_lec_a_cod_admin(db: Session, cod_lec_valor: str, cod_admin_id: int):
@@ -844,16 +1069,137 @@ def asignar_cod_lec_a_cod_admin(db: Session, cod_lec_valor: str, cod_admin_id: i
     db.add(cod_lec)
     db.flush()
 
-    productos = db.query(models.Producto).filter(models.Producto.cod_lec_id == cod_lec.id).all()
-    for p in productos:
-        if p.cod_admin_id != cod_admin_id:
-            p.cod_admin_id = cod_admin_id
-            db.add(p)
-            recalcular_imp_adicional_detalles_producto(db, p.id)
+    cambiados = db.execute(
+        update(models.Producto)
+        .where(
+            models.Producto.cod_lec_id == cod_lec.id,
+            models.Producto.cod_admin_id.is_distinct_from(cod_admin_id),
+        )
+        .values(cod_admin_id=cod_admin_id)
+        .returning(models.Producto.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    if cambiados:
+        recalcular_detalles(db, producto_ids=cambiados)
+        refrescar_nombre_busqueda(db, producto_ids=cambiados)
 
     return cod_lec
 
 
+def compactar_productos_duplicados(db: Session) -> Dict[str, int]:
+    """
+    Fusiona los Producto repetidos por (proveedor_id, cod_lec_id, negocio_id) que
+    dejó la ingesta antigua (uno por línea de factura). El canónico es el que tiene
+    cod_admin y, entre esos, el de mayor id; sus detalles absorben los del resto,
+    hereda la categoría si no tenía y los duplicados se borran.
+    No se tocan los productos sin negocio ni los grupos cuyos cod_admin (no nulos)
+    no coinciden: esos se cuentan en "grupos_omitidos" para revisarlos a mano.
+    Los detalles movidos se recalculan con el cod_admin del canónico.
+    Set-based y no hace commit.
+    """
+    omitidos = db.execute(text("""
+        SELECT count(*) FROM (
+            SELECT 1 FROM productos
+            WHERE cod_lec_id IS NOT NULL AND negocio_id IS NOT NULL
+            GROUP BY proveedor_id, cod_lec_id, negocio_id
+            HAVING count(DISTINCT cod_admin_id) > 1
+        ) g
+    """)).scalar()
+    db.execute(text("""
+        CREATE TEMP TABLE _mapa_productos ON COMMIT DROP AS
+        SELECT id AS producto_id, canonico_id, categoria_id
+        FROM (
+            SELECT id, categoria_id,
+                   first_value(id) OVER (
+                       PARTITION BY proveedor_id, cod_lec_id, negocio_id
+                       ORDER BY (cod_admin_id IS NULL), id DESC
+                   ) AS canonico_id,
+                   min(cod_admin_id) OVER grupo IS DISTINCT FROM max(cod_admin_id) OVER grupo AS conflicto
+            FROM productos
+            WHERE cod_lec_id IS NOT NULL AND negocio_id IS NOT NULL
+            WINDOW grupo AS (PARTITION BY proveedor_id, cod_lec_id, negocio_id)
+        ) t
+        WHERE id <> canonico_id AND NOT conflicto
+    """))
+    detalles = db.execute(text("""
+        UPDATE detalle_factura d SET producto_id = m.canonico_id
+        FROM _mapa_productos m
+        WHERE d.producto_id = m.producto_id
+    """)).rowcount
+    db.execute(text("""
+        UPDATE productos p SET categoria_id = c.categoria_id
+        FROM (
+            SELECT DISTINCT ON (canonico_id) canonico_id, categoria_id
+            FROM _mapa_productos
+            WHERE categoria_id IS NOT NULL
+            ORDER BY canonico_id, producto_id DESC
+        ) c
+        WHERE p.id = c.canonico_id AND p.categoria_id IS NULL
+    """))
+    canonicos = db.execute(text("SELECT DISTINCT canonico_id FROM _mapa_productos")).scalars().all()
+    eliminados = db.execute(text("""
+        DELETE FROM productos p USING _mapa_productos m WHERE p.id = m.producto_id
+    """)).rowcount
+    db.execute(text("DROP TABLE _mapa_productos"))
+    refrescar_ultimo_detalle(db, canonicos)
+    if canonicos:
+        # los detalles de duplicados sin cod_admin pasan al del canónico (también refresca el resumen)
+        recalcular_detalles(db, producto_ids=canonicos)
+    return {
+        "productos_eliminados": eliminados,
+        "detalles_reasignados": detalles,
+        "grupos_omitidos": omitidos,
+    }
+
+
+# ---------------------
+# ULTIMO DETALLE (proyección por producto)
+# ---------------------
+
+def _select_ultimo_detalle(db: Session):
+    D, F = models.DetalleFactura, models.Factura
+    return (
+        db.query(D.producto_id, D.id, D.factura_id, F.fecha_emision, F.folio, F.negocio_id)
+        .join(F, F.id == D.factura_id)
+        .filter(D.producto_id.isnot(None), F.fecha_emision.isnot(None))
+        .order_by(D.producto_id, desc(F.fecha_emision), desc(D.id))
+        .distinct(D.producto_id)
+    )
+
+
+_COLUMNAS_ULTIMO = ["producto_id", "detalle_id", "factura_id", "fecha_emision", "folio", "negocio_id"]
+
+
+def avanzar_ultimo_detalle(db: Session, factura_ids: Iterable[int]) -> None:
+    """
+    Incremental (ingesta): con los detalles de estas facturas nuevas, mueve el
+    último detalle de cada producto solo si el nuevo es posterior.
+    """
+    factura_ids = list(factura_ids)
+    if not factura_ids:
+        return
+    U = models.UltimoDetalle
+    candidatos = _select_ultimo_detalle(db).filter(models.DetalleFactura.factura_id.in_(factura_ids))
+    stmt = pg_insert(U).from_select(_COLUMNAS_ULTIMO, candidatos.statement)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[U.producto_id],
+        set_={c: stmt.excluded[c] for c in _COLUMNAS_ULTIMO if c != "producto_id"},
+        where=tuple_(stmt.excluded.fecha_emision, stmt.excluded.detalle_id) > tuple_(U.fecha_emision, U.detalle_id),
+    )
+    db.execute(stmt)
+
+
+def refrescar_ultimo_detalle(db: Session, producto_ids: Iterable[int]) -> None:
+    """Recalcula desde cero la fila de estos productos (tras borrar o mover detalles)."""
+    producto_ids = list(producto_ids)
+    if not producto_ids:
+        return
+    U = models.UltimoDetalle
+    db.query(U).filter(U.producto_id.in_(producto_ids)).delete(synchronize_session=False)
+    filas = _select_ultimo_detalle(db).filter(models.DetalleFactura.producto_id.in_(producto_ids))
+    db.execute(pg_insert(U).from_select(_COLUMNAS_ULTIMO, filas.statement))
+
+
 # ---------------------
 # USUARIOS (roles/permisos en tu BD; auth real viene desde Supabase JWT)
 # ---------------------
@@ -948,3 +1294,191 @@ def actualizar_usuario(db: Session, usuario_id: int, datos) -> models.Usuario:
     db.commit()
     db.refresh(usuario)
     return usuario
+
+
+# ---------------------
+# RESUMEN MENSUAL (dashboard)
+# ---------------------
+
+def _select_resumen(db: Session):
+    """GROUP BY de detalle_factura con las columnas de ResumenMensual, y la expresión de la clave (negocio, mes, proveedor)."""
+    D, F, P = models.DetalleFactura, models.Factura, models.Producto
+    negocio = func.coalesce(F.negocio_id, 0)
+    mes = cast(func.date_trunc("month", F.fecha_emision), Date)
+    cod_admin = func.coalesce(P.cod_admin_id, 0)
+    q = (
+        db.query(
+            negocio.label("negocio_id"),
+            mes.label("mes"),
+            P.proveedor_id.label("proveedor_id"),
+            cod_admin.label("cod_admin_id"),
+            func.count(D.id).label("detalles"),
+            func.coalesce(func.sum(D.costo_unitario), 0.0).label("suma_costo_unitario"),
+            func.count(D.costo_unitario).label("con_costo_unitario"),
+            func.coalesce(func.sum(D.total_costo), 0.0).label("suma_total_costo"),
+        )
+        .join(F, F.id == D.factura_id)
+        .join(P, P.id == D.producto_id)
+        .filter(F.fecha_emision.isnot(None), P.proveedor_id.isnot(None))
+    )
+    return q, (negocio, mes, P.proveedor_id, cod_admin)
+
+
+_COLUMNAS_RESUMEN = [
+    "negocio_id", "mes", "proveedor_id", "cod_admin_id",
+    "detalles", "suma_costo_unitario", "con_costo_unitario", "suma_total_costo",
+]
+
+
+def claves_resumen(
+    db: Session,
+    producto_ids: Optional[Iterable[int]] = None,
+    cod_admin_ids: Optional[Iterable[int]] = None,
+    factura_ids: Optional[Iterable[int]] = None,
+) -> List[tuple]:
+    """(negocio_id, mes, proveedor_id) del resumen que tocan esos detalles."""
+    D, P = models.DetalleFactura, models.Producto
+    q, (negocio, mes, proveedor, _) = _select_resumen(db)
+    q = q.with_entities(negocio, mes, proveedor).distinct()
+    if producto_ids is not None:
+        q = q.filter(D.producto_id.in_(list(producto_ids)))
+    if cod_admin_ids is not None:
+        q = q.filter(P.cod_admin_id.in_(list(cod_admin_ids)))
+    if factura_ids is not None:
+        q = q.filter(D.factura_id.in_(list(factura_ids)))
+    return [tuple(c) for c in q]
+
+
+def refrescar_resumen_mensual(db: Session, claves: Optional[Iterable[tuple]] = None) -> None:
+    """
+    Recalcula desde detalle_factura las porciones (negocio_id, mes, proveedor_id)
+    dadas (sin claves: todo el resumen). Las claves se sacan con claves_resumen;
+    cuando el cambio mueve detalles de porción (borrar factura, cambiar negocio)
+    hay que pasar también las de antes del cambio. No hace commit.
+    """
+    R = models.ResumenMensual
+    q, (negocio, mes, proveedor, cod_admin) = _select_resumen(db)
+    borrar = db.query(R)
+    if claves is not None:
+        claves = list(set(claves))
+        if not claves:
+            return
+        borrar = borrar.filter(tuple_(R.negocio_id, R.mes, R.proveedor_id).in_(claves))
+        q = q.filter(tuple_(negocio, mes, proveedor).in_(claves))
+    borrar.delete(synchronize_session=False)
+    q = q.group_by(negocio, mes, proveedor, cod_admin)
+    db.execute(pg_insert(R).from_select(_COLUMNAS_RESUMEN, q.statement))
+    cache_dashboard.invalidar(db, None if claves is None else {c[0] for c in claves})
+
+
+def sumar_resumen_mensual(db: Session, factura_ids: Iterable[int]) -> None:
+    """Incremental (ingesta): suma al resumen los detalles de estas facturas nuevas."""
+    factura_ids = list(factura_ids)
+    if not factura_ids:
+        return
+    R = models.ResumenMensual
+    q, clave = _select_resumen(db)
+    q = q.filter(models.DetalleFactura.factura_id.in_(factura_ids)).group_by(*clave)
+    stmt = pg_insert(R).from_select(_COLUMNAS_RESUMEN, q.statement)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[R.negocio_id, R.mes, R.proveedor_id, R.cod_admin_id],
+        set_={
+            c: getattr(R, c) + stmt.excluded[c]
+            for c in ("detalles", "suma_costo_unitario", "con_costo_unitario", "suma_total_costo")
+        },
+    ).returning(R.negocio_id)
+    cache_dashboard.invalidar(db, set(db.execute(stmt).scalars()))
+
+
+def _es_inicio_de_mes(d: Optional[date]) -> bool:
+    return d is None or d.day == 1
+
+
+def _es_fin_de_mes(d: Optional[date]) -> bool:
+    return d is None or (d + timedelta(days=1)).day == 1
+
+
+def datos_dashboard(
+    db: Session,
+    negocio_id: Optional[int] = None,
+    fecha_inicio: Optional[date] = None,
+    fecha_fin: Optional[date] = None,
+    cod_admin_id: Optional[int] = None,
+    codigo_producto: Optional[str] = None,
+) -> Dict[str, list]:
+    """
+    Las tres series del dashboard en una sola consulta agrupada por (mes, proveedor).
+    Si los filtros lo permiten (fechas en meses completos, sin filtro por código)
+    se lee resumen_mensual; si no, la misma agregación sale de detalle_factura.
+    """
+    if not codigo_producto and _es_inicio_de_mes(fecha_inicio) and _es_fin_de_mes(fecha_fin):
+        R = models.ResumenMensual
+        q = (
+            db.query(
+                R.mes,
+                models.Proveedor.nombre,
+                func.sum(R.suma_costo_unitario),
+                func.sum(R.con_costo_unitario),
+                func.sum(R.suma_total_costo),
+            )
+            .join(models.Proveedor, models.Proveedor.id == R.proveedor_id)
+        )
+        mes, fecha, filtro_cod_admin = R.mes, R.mes, R.cod_admin_id
+        if negocio_id:
+            q = q.filter(R.negocio_id == negocio_id)
+    else:
+        D, F, P = models.DetalleFactura, models.Factura, models.Producto
+        mes = func.date_trunc("month", F.fecha_emision)
+        q = (
+            db.query(
+                mes,
+                models.Proveedor.nombre,
+                func.sum(D.costo_unitario),
+                func.count(D.costo_unitario),
+                func.sum(D.total_costo),
+            )
+            .join(F, F.id == D.factura_id)
+            .join(P, P.id == D.producto_id)
+            .join(models.Proveedor, models.Proveedor.id == P.proveedor_id)
+            .filter(F.fecha_emision.isnot(None))
+        )
+        fecha, filtro_cod_admin = F.fecha_emision, P.cod_admin_id
+        if negocio_id:
+            q = q.filter(F.negocio_id == negocio_id)
+        if codigo_producto:
+            q = q.filter(P.codigo.ilike(f"%{codigo_producto}%"))
+
+    if fecha_inicio and fecha_fin:
+        q = q.filter(fecha.between(fecha_inicio, fecha_fin))
+    elif fecha_inicio:
+        q = q.filter(fecha >= fecha_inicio)
+    elif fecha_fin:
+        q = q.filter(fecha <= fecha_fin)
+    if cod_admin_id:
+        q = q.filter(filtro_cod_admin == cod_admin_id)
+
+    filas = q.group_by(mes, models.Proveedor.nombre).order_by(models.Proveedor.nombre, mes).all()
+
+    meses = {}        # mes -> [suma_cu, con_cu, suma_total]
+    proveedores = {}  # nombre -> [suma_cu, con_cu]  (en el orden de la BD)
+    for m, proveedor, suma_cu, con_cu, suma_total in filas:
+        acc = meses.setdefault(m, [0.0, 0, 0.0])
+        acc[0] += float(suma_cu or 0.0)
+        acc[1] += int(con_cu or 0)
+        acc[2] += float(suma_total or 0.0)
+        accp = proveedores.setdefault(proveedor, [0.0, 0])
+        accp[0] += float(suma_cu or 0.0)
+        accp[1] += int(con_cu or 0)
+
+    def mes_to_str(m):
+        return (m.strftime("%Y-%m") if hasattr(m, "strftime") else str(m)[:7])
+
+    def promedio(suma, n):
+        return (suma / n) if n else 0.0
+
+    orden = sorted(meses)
+    return {
+        "historial_precios": [{"mes": mes_to_str(m), "costo_promedio": promedio(*meses[m][:2])} for m in orden],
+        "facturas_mensuales": [{"mes": mes_to_str(m), "total": meses[m][2]} for m in orden],
+        "promedios_proveedor": [{"proveedor": p, "costo_promedio": promedio(*v)} for p, v in proveedores.items()],
+    }
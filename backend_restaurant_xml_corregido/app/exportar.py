@@ -0,0 +1,199 @@
+# app/exportar.py
+"""
+Exportaciones a archivo sin armar todo en memoria.
+
+Las filas llegan como iterador (p.ej. crud.iterar_productos_filtrados, que lee
+con yield_per) y se escriben a un archivo temporal en el formato pedido, que
+después se envía por bloques:
+  xlsx    -> Workbook write_only de openpyxl (no guarda las celdas, las vuelca)
+  csv     -> UTF-8, separador coma
+  ndjson  -> un objeto JSON por línea
+  parquet -> columnar, escrito por grupos de PARQUET_FILAS_GRUPO filas (requiere pyarrow)
+
+Cada exportación declara sus columnas como (encabezado, tipo) con tipo en
+TIPOS; el tipo solo lo usa parquet, y en los formatos para máquinas los ""
+que se usan de relleno en Excel salen como vacío / null.
+"""
+import csv
+import inspect
+import io
+import json
+import os
+import tempfile
+from datetime import date, datetime
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Query, Request, params
+from fastapi.responses import StreamingResponse
+from openpyxl import Workbook
+
+FORMATOS = ("xlsx", "csv", "ndjson", "parquet")
+TIPOS = ("int", "float", "str", "bool", "date")
+PARQUET_FILAS_GRUPO = int(os.getenv("PARQUET_FILAS_GRUPO", "50000"))
+
+_MEDIA = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+_BLOQUE = 64 * 1024
+
+Columnas = Sequence[Tuple[str, str]]
+
+
+def validar_formato(formato: str) -> str:
+    formato = (formato or "").lower()
+    if formato not in FORMATOS:
+        raise HTTPException(status_code=400, detail=f"format debe ser uno de: {', '.join(FORMATOS)}")
+    return formato
+
+
+def _parametros_query(endpoint) -> set:
+    """Nombres (o alias) de los parámetros de query que declara un endpoint."""
+    nombres = set()
+    for nombre, p in inspect.signature(endpoint).parameters.items():
+        if isinstance(p.default, params.Depends) or p.annotation is Request:
+            continue
+        alias = getattr(p.default, "alias", None)
+        nombres.add(alias or nombre)
+    return nombres
+
+
+def parametro_formato(defecto: str):
+    """
+    Dependencia para el formato de una exportación: `?format=` (y `?formato=`,
+    que se mantiene por compatibilidad). Rechaza con 400 los parámetros que el
+    endpoint no declara, para que un `?fromat=csv` no devuelva el formato por
+    defecto sin avisar.
+    """
+    def dependencia(request: Request, formato: Optional[str] = Query(None, alias="format")) -> str:
+        permitidos = _parametros_query(request.scope["endpoint"]) | {"format", "formato"}
+        desconocidos = sorted(set(request.query_params) - permitidos)
+        if desconocidos:
+            raise HTTPException(status_code=400, detail=f"Parámetros desconocidos: {', '.join(desconocidos)}")
+        anterior = request.query_params.get("formato")
+        if formato and anterior and formato.lower() != anterior.lower():
+            raise HTTPException(status_code=400, detail="format y formato no coinciden")
+        return validar_formato(formato or anterior or defecto)
+    return dependencia
+
+
+def _enviar_y_cerrar(archivo) -> Iterator[bytes]:
+    try:
+        archivo.seek(0)
+        for bloque in iter(lambda: archivo.read(_BLOQUE), b""):
+            yield bloque
+    finally:
+        archivo.close()
+
+
+def respuesta_archivo(archivo, media_type: str, nombre_archivo: str) -> StreamingResponse:
+    """Envía un archivo temporal ya escrito por bloques y lo cierra (se borra) al terminar."""
+    archivo.flush()
+    return StreamingResponse(
+        _enviar_y_cerrar(archivo),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={nombre_archivo}"},
+    )
+
+
+def _limpiar(fila: Sequence, columnas: Columnas) -> list:
+    return [None if (v == "" and tipo != "str") else v for v, (_, tipo) in zip(fila, columnas)]
+
+
+# ---------------------
+# Escritores
+# ---------------------
+
+def _xlsx(archivo, titulo: str, columnas: Columnas, filas: Iterable[Sequence]) -> None:
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=titulo)
+    ws.append([nombre for nombre, _ in columnas])
+    for fila in filas:
+        ws.append(list(fila))
+    wb.save(archivo)
+
+
+def _csv(archivo, titulo: str, columnas: Columnas, filas: Iterable[Sequence]) -> None:
+    texto = io.TextIOWrapper(archivo, encoding="utf-8", newline="")
+    w = csv.writer(texto)
+    w.writerow([nombre for nombre, _ in columnas])
+    for fila in filas:
+        w.writerow(_limpiar(fila, columnas))
+    texto.flush()
+    texto.detach()   # el archivo sigue abierto para enviarlo
+
+
+def _json_default(v):
+    if isinstance(v, (date, datetime)):
+        return v.isoformat()
+    return str(v)
+
+
+def _ndjson(archivo, titulo: str, columnas: Columnas, filas: Iterable[Sequence]) -> None:
+    nombres = [nombre for nombre, _ in columnas]
+    for fila in filas:
+        linea = json.dumps(dict(zip(nombres, _limpiar(fila, columnas))), ensure_ascii=False, default=_json_default)
+        archivo.write(linea.encode("utf-8") + b"\n")
+
+
+def _parquet(archivo, titulo: str, columnas: Columnas, filas: Iterable[Sequence]) -> None:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise HTTPException(status_code=400, detail="El formato parquet requiere pyarrow instalado en el servidor")
+
+    tipos = {"int": pa.int64(), "float": pa.float64(), "str": pa.string(), "bool": pa.bool_(), "date": pa.date32()}
+    convertir = {
+        "int": int, "float": float, "str": str, "bool": bool,
+        "date": lambda v: v if isinstance(v, date) else date.fromisoformat(str(v)[:10]),
+    }
+    schema = pa.schema([(nombre, tipos[tipo]) for nombre, tipo in columnas])
+
+    filas = iter(filas)
+    with pq.ParquetWriter(archivo, schema) as writer:
+        primero = True
+        while True:
+            # un row group por vuelta (el primero se escribe aunque venga vacío)
+            grupo = [_limpiar(f, columnas) for f in islice(filas, PARQUET_FILAS_GRUPO)]
+            if not grupo and not primero:
+                break
+            primero = False
+            arrays = [
+                pa.array(
+                    [None if f[i] is None else convertir[tipo](f[i]) for f in grupo],
+                    type=tipos[tipo],
+                )
+                for i, (_, tipo) in enumerate(columnas)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            if len(grupo) < PARQUET_FILAS_GRUPO:
+                break
+
+
+_ESCRITORES = {"xlsx": _xlsx, "csv": _csv, "ndjson": _ndjson, "parquet": _parquet}
+
+
+def exportar(
+    formato: str,
+    titulo: str,
+    columnas: Columnas,
+    filas: Iterable[Sequence],
+    nombre_base: str,
+) -> StreamingResponse:
+    """
+    Escribe las filas en un archivo temporal en `formato` y lo devuelve como
+    descarga `nombre_base.<formato>`. Se escribe entero antes de responder
+    porque las filas salen de la sesión de la request, que se cierra al volver.
+    """
+    formato = validar_formato(formato)
+    archivo = tempfile.TemporaryFile()
+    try:
+        _ESCRITORES[formato](archivo, titulo, columnas, filas)
+    except Exception:
+        archivo.close()
+        raise
+    return respuesta_archivo(archivo, _MEDIA[formato], f"{nombre_base}.{formato}")
@@ -0,0 +1,431 @@
+# app/ingesta.py
+"""
+Ingesta masiva de facturas parseadas (salida de xml_parser) a la BD.
+
+Las facturas se procesan en lotes: por cada lote se juntan las filas de cada
+tabla y se escriben con INSERT multi-fila ... RETURNING, respetando el orden
+de las FK (proveedores -> facturas -> productos -> detalle_factura), en vez de
+un add()+flush() por fila. No hace commit: eso queda para quien llama.
+
+Con INGESTA_REUSAR_PRODUCTOS (activo por defecto) cada línea se asocia al
+Producto canónico de su (proveedor, cod_lec, negocio) y solo se crea uno si no
+existe; con "0" se vuelve al comportamiento antiguo de un Producto por línea.
+El negocio va en la clave porque el listado de cada restaurante sale de sus
+propias facturas: un producto compartido desaparecería del listado del
+restaurante que no lo compró último.
+
+Las resoluciones que se repiten entre documentos (proveedor, negocio, cod_lec,
+cod_admin heredado por código, maestro de cod_admin, producto canónico) viven
+en un ContextoIngesta que dura toda la carga: cada lote precarga en una
+consulta por tabla solo las claves que aún no conoce y el resto son aciertos
+de diccionario.
+"""
+import os
+from datetime import datetime
+from itertools import islice
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import insert, update, tuple_
+from sqlalchemy.orm import Session
+
+from app import models, crud
+from app.rut import normalizar_rut
+
+# documentos por lote (cada lote = un INSERT por tabla)
+TAMANO_LOTE = int(os.getenv("INGESTA_TAMANO_LOTE", "500"))
+REUSAR_PRODUCTOS = os.getenv("INGESTA_REUSAR_PRODUCTOS", "1").lower() not in ("0", "false", "no")
+
+
+def _en_lotes(facturas: Iterable[dict], tamano: int):
+    it = iter(facturas)
+    while True:
+        lote = list(islice(it, tamano))
+        if not lote:
+            return
+        yield lote
+
+
+def _insertar(db: Session, modelo, filas: List[dict]) -> List[int]:
+    """INSERT multi-fila ... RETURNING id, con los ids en el mismo orden que filas."""
+    if not filas:
+        return []
+    stmt = insert(modelo).returning(modelo.id, sort_by_parameter_order=True)
+    return list(db.execute(stmt, filas).scalars())
+
+
+def _parse_fecha(valor):
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    except Exception:
+        return datetime.fromisoformat(str(valor)[:10]).date()
+
+
+class ContextoIngesta:
+    """
+    Memo de resoluciones de una carga completa (todos sus lotes). Guarda solo
+    ids y valores simples, no objetos ORM, para que siga siendo válido aunque
+    quien llama haga commit entre lotes (las tareas en segundo plano lo hacen).
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.proveedores = {}   # rut_norm -> (id, rut)
+        self.negocios = {}      # rut_receptor -> {"id", "razon_social", "correo", "direccion"}
+        self.cod_lec = {}       # valor build_cod_lec -> (id, cod_admin_id)
+        self.heredados = {}     # (proveedor_id, codigo) -> cod_admin_id (None = ya consultado, no hay)
+        self.cod_admin = {}     # cod_admin_id -> (um, porcentaje_adicional)
+        self.canonicos = {}     # (proveedor_id, cod_lec_id, negocio_id) -> [producto_id, cod_admin_id]
+        self.reasignados = set()  # productos existentes a los que se les asignó cod_admin (se recalculan)
+
+    # --- precargas en bloque (una consulta por tabla y lote, solo claves nuevas) ---
+
+    def precargar_proveedores(self, ruts):
+        faltan = {r for r in ruts if r not in self.proveedores}
+        if not faltan:
+            return
+        filas = (
+            self.db.query(models.Proveedor.rut_norm, models.Proveedor.id, models.Proveedor.rut)
+            .filter(models.Proveedor.rut_norm.in_(faltan))
+            .order_by(models.Proveedor.id)
+            .all()
+        )
+        for rut_norm, prov_id, rut in filas:
+            self.proveedores.setdefault(rut_norm, (prov_id, rut))
+
+    def resolver_negocios(self, receptores):
+        """Upsert en bloque (crud.upsert_negocios_lote) de los receptores con RUT aún no vistos."""
+        faltan = [
+            (receptor, hint) for receptor, hint in receptores
+            if normalizar_rut((receptor or {}).get("rut")) not in self.negocios
+        ]
+        if faltan:
+            self.negocios.update(crud.upsert_negocios_lote(self.db, faltan))
+
+    def resolver_cod_lec(self, items):
+        """Upsert en bloque (crud.upsert_cod_lec_lote) de los cod_lec aún no vistos: valor -> (id, cod_admin_id)."""
+        faltan = [(rut, nombre, codigo) for valor, rut, nombre, codigo in items if valor not in self.cod_lec]
+        if faltan:
+            self.cod_lec.update(crud.upsert_cod_lec_lote(self.db, faltan))
+
+    def precargar_heredados(self, pares):
+        """Último cod_admin usado por (proveedor_id, codigo), igual que la consulta producto_anterior."""
+        faltan = {p for p in pares if p not in self.heredados}
+        if not faltan:
+            return
+        P = models.Producto
+        filas = (
+            self.db.query(P.proveedor_id, P.codigo, P.cod_admin_id)
+            .filter(tuple_(P.proveedor_id, P.codigo).in_(list(faltan)), P.cod_admin_id.isnot(None))
+            .order_by(P.proveedor_id, P.codigo, P.id.desc())
+            .distinct(P.proveedor_id, P.codigo)
+            .all()
+        )
+        for par in faltan:
+            self.heredados[par] = None
+        for prov_id, codigo, ca_id in filas:
+            self.heredados[(prov_id, codigo)] = ca_id
+
+    def precargar_cod_admin(self, ids):
+        faltan = {i for i in ids if i and i not in self.cod_admin}
+        if not faltan:
+            return
+        M = models.CodigoAdminMaestro
+        for ca_id, um, porc in self.db.query(M.id, M.um, M.porcentaje_adicional).filter(M.id.in_(faltan)):
+            try:
+                um = float(um) if um is not None else 1.0
+            except Exception:
+                um = 1.0
+            self.cod_admin[ca_id] = (um, float(porc or 0.0))
+
+    # --- resoluciones individuales (acierto de caché o, si no, la ruta de crud) ---
+
+    def negocio_id(self, receptor: dict, cambios: Dict[int, dict]) -> Optional[int]:
+        """Negocio ya resuelto por resolver_negocios; rellena en memoria los campos que falten."""
+        rut = normalizar_rut((receptor or {}).get("rut"))
+        actual = self.negocios.get(rut) if rut else None
+        if actual is None:
+            return None
+        # relleno de campos vacíos con crud.cambios_negocio, la misma regla de crud.upsert_negocios_lote
+        nuevos = crud.cambios_negocio(SimpleNamespace(**actual), receptor)
+        if nuevos:
+            actual.update(nuevos)
+            cambios.setdefault(actual["id"], {}).update(nuevos)
+        return actual["id"]
+
+    def productos_canonicos(self, filas: List[dict]) -> List[int]:
+        """
+        Producto canónico por (proveedor_id, cod_lec_id, negocio_id) para cada fila,
+        en orden. Los existentes salen de una consulta (prefiere el que tiene cod_admin
+        y, entre esos, el más reciente, igual que crud.compactar_productos_duplicados);
+        los que faltan se insertan una sola vez por clave. Las facturas sin negocio no
+        reusan productos de cargas anteriores. Deja en cada fila el cod_admin_id
+        efectivo del canónico para calcular los costos del detalle.
+        """
+        P = models.Producto
+        canonicos = self.canonicos
+        claves = {_clave_canonica(f) for f in filas} - canonicos.keys()
+        claves = [c for c in claves if c[2] is not None]
+        if claves:
+            existentes = (
+                self.db.query(P.proveedor_id, P.cod_lec_id, P.negocio_id, P.id, P.cod_admin_id)
+                .filter(tuple_(P.proveedor_id, P.cod_lec_id, P.negocio_id).in_(claves))
+                .order_by(P.proveedor_id, P.cod_lec_id, P.negocio_id, P.cod_admin_id.is_(None), P.id.desc())
+                .distinct(P.proveedor_id, P.cod_lec_id, P.negocio_id)
+                .all()
+            )
+            for prov_id, cl_id, neg_id, pid, ca_id in existentes:
+                canonicos[(prov_id, cl_id, neg_id)] = [pid, ca_id]
+
+        nuevos = {}      # clave -> fila (la última línea del lote manda, como el "más reciente")
+        asignar = {}     # producto_id -> cod_admin_id, canónicos existentes que aún no tenían
+        for f in filas:
+            clave = _clave_canonica(f)
+            if clave in canonicos:
+                actual = canonicos[clave]
+                if actual[1] is None and f["cod_admin_id"]:
+                    actual[1] = asignar[actual[0]] = f["cod_admin_id"]
+            else:
+                cod_admin_id = f["cod_admin_id"] or (nuevos[clave]["cod_admin_id"] if clave in nuevos else None)
+                nuevos[clave] = dict(f, cod_admin_id=cod_admin_id)
+
+        ids = _insertar(self.db, P, list(nuevos.values()))
+        for (clave, fila), pid in zip(nuevos.items(), ids):
+            canonicos[clave] = [pid, fila["cod_admin_id"]]
+        if asignar:
+            self.db.execute(update(P), [{"id": pid, "cod_admin_id": ca_id} for pid, ca_id in asignar.items()])
+            self.reasignados.update(asignar)
+
+        resultado = []
+        for f in filas:
+            pid, cod_admin_id = canonicos[_clave_canonica(f)]
+            f["cod_admin_id"] = cod_admin_id
+            resultado.append(pid)
+        return resultado
+
+
+def _clave_canonica(fila: dict):
+    return (fila["proveedor_id"], fila["cod_lec_id"], fila["negocio_id"])
+
+
+def ingerir_facturas(
+    db: Session,
+    facturas: Iterable[dict],
+    tamano_lote: int = TAMANO_LOTE,
+    al_terminar_lote: Optional[Callable[[Dict[str, int]], None]] = None,
+    contexto: Optional[ContextoIngesta] = None,
+    claves_por_origen: Optional[Dict[Optional[str], set]] = None,
+) -> Dict[str, int]:
+    """
+    Inserta las facturas (dicts de xml_parser) omitiendo las ya cargadas.
+    Acepta un generador (xml_parser.iterar_xml): cada lote se escribe apenas
+    se completa, sin esperar a que termine el parseo.
+    al_terminar_lote recibe los totales acumulados después de cada lote
+    (las tareas en segundo plano lo usan para reportar progreso y hacer commit).
+
+    Si las facturas traen la clave "origen" (p.ej. el nombre del archivo en una
+    carga por lote), el resultado incluye "por_origen": {origen: {nuevas, duplicadas}}.
+    Si se pasa claves_por_origen, se llena con {origen: {(proveedor_id, folio)}} de
+    todos los documentos, nuevos o duplicados (origen None si no traen), para el
+    registro de cargas (cargas.registrar).
+    """
+    ctx = contexto or ContextoIngesta(db)
+    resultado = {"facturas_nuevas": 0, "facturas_duplicadas": 0}
+    por_origen = {}
+    for lote in _en_lotes(facturas, tamano_lote):
+        nuevas, duplicadas = _ingerir_lote(ctx, lote, por_origen, claves_por_origen)
+        resultado["facturas_nuevas"] += nuevas
+        resultado["facturas_duplicadas"] += duplicadas
+        if al_terminar_lote is not None:
+            al_terminar_lote(dict(resultado))
+    if por_origen:
+        resultado["por_origen"] = por_origen
+    return resultado
+
+
+def _folios_existentes(db: Session, pares) -> set:
+    """De los pares (proveedor_id, folio) dados, cuáles ya están cargados (una consulta)."""
+    if not pares:
+        return set()
+    filas = (
+        db.query(models.Factura.proveedor_id, models.Factura.folio)
+        .filter(tuple_(models.Factura.proveedor_id, models.Factura.folio).in_(list(pares)))
+        .all()
+    )
+    return {(prov_id, folio) for prov_id, folio in filas}
+
+
+def _contar_origen(por_origen: dict, factura_data: dict, clave: str):
+    origen = factura_data.get("origen")
+    if origen is not None:
+        conteo = por_origen.setdefault(origen, {"nuevas": 0, "duplicadas": 0})
+        conteo[clave] += 1
+
+
+def _codigo_linea(p: dict) -> Optional[str]:
+    codigo_raw = (p.get("codigo") or "").strip()
+    return None if (not codigo_raw or codigo_raw.upper() == "N/A") else codigo_raw
+
+
+def _ingerir_lote(ctx: ContextoIngesta, lote: List[dict], por_origen: dict, claves_por_origen: Optional[dict]):
+    db = ctx.db
+
+    # 1) pre-pasada de duplicados: RUT emisores (caché + 1 consulta por los nuevos) y
+    #    1 consulta de folios; los duplicados se descartan antes de cualquier otro trabajo
+    ruts = [normalizar_rut(f["emisor"]["rut"]) or "" for f in lote]
+    ctx.precargar_proveedores(ruts)
+    proveedores = ctx.proveedores    # rut_norm -> (id, rut)
+    existentes = _folios_existentes(
+        db, {(proveedores[r][0], f["folio"]) for f, r in zip(lote, ruts) if r in proveedores}
+    )
+
+    duplicadas = 0
+    pendientes = []
+    for factura_data, rut_norm in zip(lote, ruts):
+        if rut_norm in proveedores:
+            clave = (proveedores[rut_norm][0], factura_data["folio"])
+        else:
+            clave = (rut_norm, factura_data["folio"])  # proveedor nuevo: solo duplicados del lote
+        if clave in existentes:
+            duplicadas += 1
+            _contar_origen(por_origen, factura_data, "duplicadas")
+            continue
+        existentes.add(clave)
+        pendientes.append((factura_data, rut_norm))
+        _contar_origen(por_origen, factura_data, "nuevas")
+
+    # 2) proveedores nuevos en un solo INSERT
+    nuevos_prov = {}     # rut_norm -> fila
+    for factura_data, rut_norm in pendientes:
+        if rut_norm not in proveedores and rut_norm not in nuevos_prov:
+            emisor = factura_data["emisor"]
+            nuevos_prov[rut_norm] = {
+                "rut": emisor.get("rut"),
+                "rut_norm": rut_norm or None,
+                "nombre": emisor.get("razon_social"),
+                "correo_contacto": emisor.get("correo"),
+                "direccion": emisor.get("comuna"),
+            }
+
+    ids = _insertar(db, models.Proveedor, list(nuevos_prov.values()))
+    for (rut_norm, fila), prov_id in zip(nuevos_prov.items(), ids):
+        proveedores[rut_norm] = (prov_id, fila["rut"])
+
+    if claves_por_origen is not None:
+        # ya están todos los proveedores (los duplicados del lote tienen su primera aparición en pendientes)
+        for factura_data, rut_norm in zip(lote, ruts):
+            claves_por_origen.setdefault(factura_data.get("origen"), set()).add(
+                (proveedores[rut_norm][0], factura_data["folio"])
+            )
+
+    # 3) negocio + fila de factura
+    ctx.resolver_negocios((f.get("receptor") or {}, f.get("negocio_hint")) for f, _ in pendientes)
+    cambios_negocio = {}  # negocio_id -> campos que se rellenan (un UPDATE al final)
+    a_insertar = []      # (factura_data, proveedor)
+    filas_factura = []
+    for factura_data, rut_norm in pendientes:
+        proveedor = proveedores[rut_norm]
+        negocio_id = ctx.negocio_id(factura_data.get("receptor") or {}, cambios_negocio)
+
+        a_insertar.append((factura_data, proveedor))
+        filas_factura.append({
+            "folio": factura_data["folio"],
+            "fecha_emision": _parse_fecha(factura_data["fecha_emision"]),
+            "forma_pago": factura_data.get("forma_pago"),
+            "monto_total": factura_data.get("monto_total", 0),
+            "proveedor_id": proveedor[0],
+            "es_nota_credito": bool(factura_data.get("es_nota_credito", False)),
+            "negocio_id": negocio_id,
+        })
+
+    if cambios_negocio:
+        for negocio_id, campos in cambios_negocio.items():
+            db.query(models.NombreNegocio).filter(models.NombreNegocio.id == negocio_id).update(
+                campos, synchronize_session=False
+            )
+
+    factura_ids = _insertar(db, models.Factura, filas_factura)
+
+    # 4) productos (canónico por cod_lec, o uno por línea) y sus detalles
+    lineas_lote = []     # (factura_id, es_nota_credito, proveedor, p, nombre, codigo, valor_cod_lec, negocio_id)
+    for (factura_data, proveedor), fila_factura, factura_id in zip(a_insertar, filas_factura, factura_ids):
+        es_nota_credito = bool(factura_data.get("es_nota_credito", False))
+        for p in factura_data["productos"]:
+            nombre = (p.get("nombre") or "Producto sin nombre").strip()
+            codigo = _codigo_linea(p)
+            valor = crud.build_cod_lec(proveedor[1], nombre, codigo)
+            lineas_lote.append((
+                factura_id, es_nota_credito, proveedor, p, nombre, codigo, valor, fila_factura["negocio_id"]
+            ))
+
+    ctx.resolver_cod_lec((l[6], l[2][1], l[4], l[5]) for l in lineas_lote)
+    ctx.precargar_heredados({(l[2][0], l[5]) for l in lineas_lote if l[5] is not None})
+
+    filas_producto = []
+    lineas = []          # (factura_id, es_nota_credito, p, fila_producto)
+    for factura_id, es_nota_credito, proveedor, p, nombre, codigo, valor, negocio_id in lineas_lote:
+        cantidad = float(p.get("cantidad") or 0)
+        unidad = (p.get("unidad") or "UN").strip()
+
+        cod_admin_id_heredado = ctx.heredados.get((proveedor[0], codigo)) if codigo is not None else None
+        cod_lec_id, cod_lec_cod_admin_id = ctx.cod_lec[valor]
+
+        fila = crud.datos_producto(
+            proveedor[0], nombre, codigo, unidad, cantidad,
+            cod_lec_id, cod_lec_cod_admin_id, cod_admin_id_heredado,
+        )
+        fila["negocio_id"] = negocio_id
+        if fila["cod_admin_id"] and fila["codigo"] is not None:
+            ctx.heredados[(proveedor[0], fila["codigo"])] = fila["cod_admin_id"]
+
+        filas_producto.append(fila)
+        lineas.append((factura_id, es_nota_credito, p, fila))
+
+    if REUSAR_PRODUCTOS:
+        producto_ids = ctx.productos_canonicos(filas_producto)
+    else:
+        producto_ids = _insertar(db, models.Producto, filas_producto)
+
+    ctx.precargar_cod_admin(fila["cod_admin_id"] for *_, fila in lineas)
+
+    filas_detalle = []
+    for (factura_id, es_nota_credito, p, fila), producto_id in zip(lineas, producto_ids):
+        cantidad = float(p.get("cantidad") or 0)
+        precio_unitario = float(p.get("precio_unitario") or 0)
+        sign = -1 if es_nota_credito else 1
+
+        um, porcentaje_adicional = ctx.cod_admin.get(fila["cod_admin_id"], (1.0, 0.0))
+
+        neto = precio_unitario * cantidad * sign
+        imp_adicional = neto * porcentaje_adicional
+        otros = 0.0
+        total_costo = neto + imp_adicional + otros
+        denom = (cantidad * um) if (cantidad and um) else 0.0
+        costo_unitario = (total_costo / denom) if denom else 0.0
+
+        filas_detalle.append({
+            "factura_id": factura_id,
+            "producto_id": producto_id,
+            "cantidad": cantidad,
+            "precio_unitario": precio_unitario,
+            "total": neto,
+            "iva": 0.0,
+            "otros_impuestos": 0.0,
+            "imp_adicional": imp_adicional,
+            "otros": otros,
+            "total_costo": total_costo,
+            "costo_unitario": costo_unitario,
+        })
+
+    if filas_detalle:
+        db.execute(insert(models.DetalleFactura), filas_detalle)
+        crud.avanzar_ultimo_detalle(db, factura_ids)
+        crud.refrescar_nombre_busqueda(db, producto_ids=set(producto_ids))
+        crud.sumar_resumen_mensual(db, factura_ids)
+    if ctx.reasignados:
+        # sus detalles antiguos se calcularon sin cod_admin: se recalculan con el
+        # um / porcentaje nuevos, como en crud.actualizar_producto (también refresca el resumen)
+        reasignados, ctx.reasignados = ctx.reasignados, set()
+        crud.recalcular_detalles(db, producto_ids=list(reasignados))
+
+    return len(factura_ids), duplicadas
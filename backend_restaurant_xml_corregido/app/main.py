@@ -1,24 +1,23 @@
 # app/main.py
 from fastapi import FastAPI, Depends, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func
+from sqlalchemy import func, case
 from datetime import datetime, date
 from typing import List, Optional
-import traceback
-import io
+import logging
 import os
+import zipfile
 from pydantic import BaseModel
 from fastapi import Body
 from jose import jwt, JWTError
-from openpyxl import Workbook
 
-from app.database import SessionLocal
-from app import models, crud, xml_parser
+from app.database import SessionLocal, engine
+from app import models, crud, xml_parser, ingesta, migraciones, tareas, cargas, paginacion, cache_dashboard, exportar
+from app.rut import normalizar_rut
 from app.models import Usuario
 from app.schemas.schemas import (
     Factura, ProductoConPrecio, Producto, Proveedor,
@@ -27,12 +26,14 @@ from app.schemas.schemas import (
     PorcentajeAdicionalUpdate, CodigoAdminMaestro, ProductoUpdate,
     CodLecSugerirRequest, CodigoLecturaResponse,
     CodLecAsignacionRequest, UsuarioOut, UsuarioUpdate, UsuarioMe,
-    OtrosUpdate,
+    OtrosUpdate, TareaOut, CodigoAdminMaestroUpdate,
 )
 from app.auth import get_db, get_current_user, solo_superadmin, require_perm, es_superadmin
 
 from app.schemas.schemas import DetalleFactura as DetalleFacturaOut
 
+logger = logging.getLogger(__name__)
+
 # -----------------------
 # App + CORS
 # -----------------------
@@ -53,6 +54,17 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+def aplicar_migraciones():
+    migraciones.aplicar(engine)
+    tareas.iniciar()
+
+
+@app.on_event("shutdown")
+def detener_tareas():
+    tareas.detener()
+    xml_parser.cerrar_pool()
+
 
 @app.get("/auth/me", response_model=UsuarioMe)
 def auth_me(usuario: Usuario = Depends(get_current_user)):
@@ -111,230 +123,57 @@ def actualizar_usuario(
     return usuario
 
 
+@app.post("/productos/compactar")
+def compactar_productos(
+    db: Session = Depends(get_db),
+    _: Usuario = Depends(solo_superadmin),
+):
+    """Fusiona productos duplicados por (proveedor, cod_lec, negocio) y reasigna sus detalles."""
+    resultado = crud.compactar_productos_duplicados(db)
+    db.commit()
+    return resultado
+
+
+@app.post("/productos/reindexar-busqueda")
+def reindexar_busqueda_productos(
+    db: Session = Depends(get_db),
+    _: Usuario = Depends(solo_superadmin),
+):
+    """Recalcula nombre_busqueda de todos los productos (p.ej. tras cargar nombres de cod_admin por fuera)."""
+    actualizados = crud.refrescar_nombre_busqueda(db)
+    db.commit()
+    return {"productos_actualizados": actualizados}
+
+
 # ---------------------
 # RUTA: Cargar XML (PROTEGIDA)
 # ---------------------
 @app.post("/subir-xml/")
 def subir_xml(
     file: UploadFile = File(...),
+    forzar: bool = False,
     db: Session = Depends(get_db),
     user: models.Usuario = Depends(require_perm("puede_subir_xml")),
 ):
-    # Nota: esta ruta NO usa current_user dentro, pero queda protegida por JWT.
     if not file.filename.lower().endswith(".xml"):
         raise HTTPException(status_code=400, detail="Solo se permiten archivos XML. Selecciona un archivo .xml válido.")
 
-    contenido = file.file.read()
-    try:
-        facturas = xml_parser.procesar_xml(contenido, db)
-
-        nuevas = 0
-        duplicadas = 0
-
-        for factura_data in facturas:
-            emisor = factura_data["emisor"]
-            rut_limpio = (emisor["rut"] or "").strip().upper().replace(".", "")
-
-            proveedor = (
-                db.query(models.Proveedor)
-                .filter(func.replace(func.upper(models.Proveedor.rut), ".", "") == rut_limpio)
-                .first()
-            )
-
-            if not proveedor:
-                proveedor = models.Proveedor(
-                    rut=emisor.get("rut"),
-                    nombre=emisor.get("razon_social"),
-                    correo_contacto=emisor.get("correo"),
-                    direccion=emisor.get("comuna"),
-                )
-                db.add(proveedor)
-                db.flush()
-
-            existe = (
-                db.query(models.Factura)
-                .filter_by(folio=factura_data["folio"], proveedor_id=proveedor.id)
-                .first()
-            )
-            if existe:
-                duplicadas += 1
-                continue
-
-            es_nota_credito = bool(factura_data.get("es_nota_credito", False))
-            sign = -1 if es_nota_credito else 1
-
-            receptor = factura_data.get("receptor") or {}
-            negocio = None
-
-            resolver = getattr(crud, "upsert_negocio_by_receptor", None)
-            if callable(resolver):
-                negocio = resolver(
-                    db=db,
-                    receptor=receptor,
-                    negocio_hint=factura_data.get("negocio_hint"),
-                )
-            else:
-                import re as _re
-                from sqlalchemy import func as _func
-
-                def _rut_norm_basic(r):
-                    if not r:
-                        return None
-                    s = r.replace(".", "").strip().replace("K", "k")
-                    m = _re.match(r"^(\d+)-([0-9k])$", s)
-                    if m:
-                        return f"{m.group(1)}-{m.group(2)}"
-                    m2 = _re.match(r"^(\d+)([0-9k])$", s)
-                    if m2:
-                        return f"{m2.group(1)}-{m2.group(2)}"
-                    s = _re.sub(r"[^0-9k]", "", s)
-                    return f"{s[:-1]}-{s[-1]}" if len(s) >= 2 else None
-
-                rut_n = _rut_norm_basic(receptor.get("rut"))
-                if rut_n:
-                    existente = (
-                        db.query(models.NombreNegocio)
-                        .filter(models.NombreNegocio.rut_receptor == rut_n)
-                        .one_or_none()
-                    )
-                    if existente:
-                        changed = False
-                        rs = (receptor.get("razon_social") or "").strip() or None
-                        co = (receptor.get("correo") or "").strip() or None
-                        di = (receptor.get("direccion") or "").strip() or None
-                        if (not existente.razon_social) and rs:
-                            existente.razon_social = rs
-                            changed = True
-                        if (not existente.correo) and co:
-                            existente.correo = co
-                            changed = True
-                        if (not existente.direccion) and di:
-                            existente.direccion = di
-                            changed = True
-                        if (not existente.nombre):
-                            hint = (factura_data.get("negocio_hint") or "").strip()
-                            if rs or hint:
-                                existente.nombre = (rs or hint)
-                                changed = True
-                        if changed:
-                            db.add(existente)
-                            db.flush()
-                        negocio = existente
-                    else:
-                        nombre_calc = (receptor.get("razon_social") or factura_data.get("negocio_hint") or rut_n).strip()
-                        por_nombre = (
-                            db.query(models.NombreNegocio)
-                            .filter(_func.lower(models.NombreNegocio.nombre) == nombre_calc.lower())
-                            .one_or_none()
-                        )
-                        if por_nombre and not por_nombre.rut_receptor:
-                            por_nombre.rut_receptor = rut_n
-                            por_nombre.razon_social = por_nombre.razon_social or (receptor.get("razon_social") or "").strip() or None
-                            por_nombre.correo = por_nombre.correo or (receptor.get("correo") or "").strip() or None
-                            por_nombre.direccion = por_nombre.direccion or (receptor.get("direccion") or "").strip() or None
-                            db.add(por_nombre)
-                            db.flush()
-                            negocio = por_nombre
-                        else:
-                            nuevo = models.NombreNegocio(
-                                nombre=nombre_calc,
-                                rut_receptor=rut_n,
-                                razon_social=(receptor.get("razon_social") or "").strip() or None,
-                                correo=(receptor.get("correo") or "").strip() or None,
-                                direccion=(receptor.get("direccion") or "").strip() or None,
-                            )
-                            db.add(nuevo)
-                            db.flush()
-                            negocio = nuevo
-
-            try:
-                fecha_emision = datetime.strptime(factura_data["fecha_emision"], "%Y-%m-%d").date()
-            except Exception:
-                fecha_emision = datetime.fromisoformat(str(factura_data["fecha_emision"])[:10]).date()
-
-            factura = models.Factura(
-                folio=factura_data["folio"],
-                fecha_emision=fecha_emision,
-                forma_pago=factura_data.get("forma_pago"),
-                monto_total=factura_data.get("monto_total", 0),
-                proveedor_id=proveedor.id,
-                es_nota_credito=es_nota_credito,
-                negocio_id=(negocio.id if negocio else None),
-            )
-            db.add(factura)
-            db.flush()
-
-            for p in factura_data["productos"]:
-                cantidad = float(p.get("cantidad") or 0)
-                precio_unitario = float(p.get("precio_unitario") or 0)
-                nombre = (p.get("nombre") or "Producto sin nombre").strip()
-                unidad = (p.get("unidad") or "UN").strip()
-
-                codigo_raw = (p.get("codigo") or "").strip()
-                codigo_norm_up = codigo_raw.upper()
-                codigo = None if (not codigo_raw or codigo_norm_up == "N/A") else codigo_raw
-
-                cod_admin_id_heredado = None
-
-                if cod_admin_id_heredado is None and codigo is not None:
-                    producto_anterior = (
-                        db.query(models.Producto)
-                        .filter(
-                            models.Producto.codigo == codigo,
-                            models.Producto.proveedor_id == proveedor.id,
-                            models.Producto.cod_admin_id.isnot(None),
-                        )
-                        .order_by(models.Producto.id.desc())
-                        .first()
-                    )
-                    if producto_anterior:
-                        cod_admin_id_heredado = producto_anterior.cod_admin_id
-
-                producto = crud.crear_producto_con_cod_lec(
-                    db=db,
-                    proveedor=proveedor,
-                    nombre=nombre,
-                    codigo=codigo,
-                    unidad=unidad,
-                    cantidad=cantidad,
-                    cod_admin_id_heredado=cod_admin_id_heredado,
-                )
-
-                porcentaje_adicional = 0.0
-                um = 1.0
-                if producto.cod_admin_id:
-                    ca = db.query(models.CodigoAdminMaestro).get(producto.cod_admin_id)
-                    if ca:
-                        try:
-                            um = float(ca.um) if ca.um is not None else 1.0
-                        except Exception:
-                            um = 1.0
-                        porcentaje_adicional = float(ca.porcentaje_adicional or 0.0)
-
-                neto = precio_unitario * cantidad * sign
-                imp_adicional = neto * porcentaje_adicional
-                otros = 0.0
-                total_costo = neto + imp_adicional + otros
-                denom = (cantidad * um) if (cantidad and um) else 0.0
-                costo_unitario = (total_costo / denom) if denom else 0.0
-
-                detalle = models.DetalleFactura(
-                    factura_id=factura.id,
-                    producto_id=producto.id,
-                    cantidad=cantidad,
-                    precio_unitario=precio_unitario,
-                    total=neto,
-                    iva=0.0,
-                    otros_impuestos=0.0,
-                    imp_adicional=imp_adicional,
-                    otros=otros,
-                    total_costo=total_costo,
-                    costo_unitario=costo_unitario,
-                )
-                db.add(detalle)
-
-            nuevas += 1
+    # archivo idéntico a uno ya cargado: se responde con el resultado guardado, sin parsear
+    sha256, tamano = cargas.hash_archivo(file.file)
+    if not forzar:
+        carga = cargas.buscar(db, sha256)
+        if carga:
+            return cargas.respuesta_previa(carga)
 
+    try:
+        # streaming: las facturas se insertan por lotes mientras se sigue leyendo el XML
+        facturas = xml_parser.iterar_xml(file.file)
+        claves = {}
+        resultado = ingesta.ingerir_facturas(db, facturas, claves_por_origen=claves)
+        nuevas = resultado["facturas_nuevas"]
+        duplicadas = resultado["facturas_duplicadas"]
+
+        cargas.registrar(db, sha256, file.filename, tamano, resultado, user.id, facturas=claves.get(None))
         db.commit()
 
         if nuevas == 0:
@@ -355,10 +194,177 @@ def subir_xml(
         raise HTTPException(status_code=400, detail="Factura duplicada en base de datos.")
     except Exception:
         db.rollback()
-        print("❌ Error procesando XML:", traceback.format_exc())
+        logger.exception("Error procesando XML")
         raise HTTPException(status_code=500, detail="Error interno procesando el archivo XML.")
 
 
+# tope de bytes (descomprimidos) por carga en /subir-xml/lote
+LOTE_MAX_BYTES = int(os.getenv("LOTE_MAX_MB", "200")) * 1024 * 1024
+
+
+def _nombre_unico(nombre: str, usados: dict) -> str:
+    """
+    Los navegadores mandan solo el nombre base: dos archivos de carpetas distintas
+    pueden llegar con el mismo nombre. Los repetidos pasan a "nombre#2", "nombre#3"...
+    para que cada uno tenga su resultado (y su hash / tamaño en el registro de cargas).
+    """
+    n = usados.get(nombre, 0) + 1
+    usados[nombre] = n
+    return nombre if n == 1 else f"{nombre}#{n}"
+
+
+def _expandir_archivos(files: List[UploadFile]):
+    """(nombre, bytes) de cada .xml subido o contenido en un .zip; los nombres no se repiten."""
+    archivos, rechazados, total = [], [], 0
+    usados = {}
+    for f in files:
+        nombre = f.filename or "sin_nombre"
+        if nombre.lower().endswith(".zip"):
+            nombre_zip = _nombre_unico(nombre, usados)
+            try:
+                with zipfile.ZipFile(f.file) as zf:
+                    for info in zf.infolist():
+                        if info.is_dir() or not info.filename.lower().endswith(".xml") or "__MACOSX" in info.filename:
+                            continue
+                        total += info.file_size
+                        if total > LOTE_MAX_BYTES:
+                            raise HTTPException(status_code=413, detail="La carga supera el tamaño máximo permitido.")
+                        archivos.append((_nombre_unico(f"{nombre_zip}/{info.filename}", usados), zf.read(info)))
+            except zipfile.BadZipFile:
+                rechazados.append((nombre_zip, "ZIP inválido"))
+        elif nombre.lower().endswith(".xml"):
+            contenido = f.file.read()
+            total += len(contenido)
+            if total > LOTE_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="La carga supera el tamaño máximo permitido.")
+            archivos.append((_nombre_unico(nombre, usados), contenido))
+        else:
+            rechazados.append((_nombre_unico(nombre, usados), "Solo se permiten archivos .xml o .zip"))
+    return archivos, rechazados
+
+
+@app.post("/subir-xml/lote")
+def subir_xml_lote(
+    files: List[UploadFile] = File(...),
+    forzar: bool = False,
+    db: Session = Depends(get_db),
+    user: models.Usuario = Depends(require_perm("puede_subir_xml")),
+):
+    """
+    Varios XML (o .zip con XML) en una sola carga. El parseo corre en paralelo
+    en un pool de procesos y todas las facturas se escriben en una sola
+    ingesta por lotes con un commit. Devuelve el resultado por archivo.
+    """
+    archivos, rechazados = _expandir_archivos(files)
+    if not archivos and not rechazados:
+        raise HTTPException(status_code=400, detail="No se recibieron archivos XML.")
+
+    resultados = {nombre: {"archivo": nombre, "estado": "error", "detalle": motivo} for nombre, motivo in rechazados}
+
+    # archivos ya cargados (mismo SHA-256): no se parsean
+    hashes = {nombre: cargas.hash_bytes(contenido) for nombre, contenido in archivos}
+    if not forzar:
+        previas = {
+            c.sha256: c
+            for c in db.query(models.CargaArchivo).filter(models.CargaArchivo.sha256.in_(set(hashes.values())))
+        }
+        for nombre, _ in archivos:
+            carga = previas.get(hashes[nombre])
+            if carga:
+                resultados[nombre] = {
+                    "archivo": nombre,
+                    "estado": "duplicado",
+                    "facturas_nuevas": 0,
+                    "facturas_duplicadas": (carga.facturas_nuevas or 0) + (carga.facturas_duplicadas or 0),
+                    "detalle": "Archivo ya cargado",
+                }
+        archivos = [(nombre, contenido) for nombre, contenido in archivos if nombre not in resultados]
+
+    def _facturas():
+        for nombre, facturas, error in xml_parser.procesar_archivos(archivos):
+            if error or not facturas:
+                resultados[nombre] = {"archivo": nombre, "estado": "error", "detalle": error or "Sin documentos"}
+                continue
+            resultados[nombre] = {"archivo": nombre, "estado": "duplicado", "facturas_nuevas": 0, "facturas_duplicadas": 0}
+            for factura in facturas:
+                factura["origen"] = nombre
+                yield factura
+
+    try:
+        claves = {}
+        resultado = ingesta.ingerir_facturas(db, _facturas(), claves_por_origen=claves)
+        tamanos = {nombre: len(contenido) for nombre, contenido in archivos}
+        for nombre, conteo in resultado.get("por_origen", {}).items():
+            r = resultados[nombre]
+            r["facturas_nuevas"] = conteo["nuevas"]
+            r["facturas_duplicadas"] = conteo["duplicadas"]
+            r["estado"] = "nuevo" if conteo["nuevas"] else "duplicado"
+            cargas.registrar(
+                db, hashes[nombre], nombre, tamanos[nombre],
+                {"facturas_nuevas": conteo["nuevas"], "facturas_duplicadas": conteo["duplicadas"]}, user.id,
+                facturas=claves.get(nombre),
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("Error procesando lote XML")
+        raise HTTPException(status_code=500, detail="Error interno procesando los archivos XML.")
+
+    return {
+        "facturas_nuevas": resultado["facturas_nuevas"],
+        "facturas_duplicadas": sum(r.get("facturas_duplicadas", 0) for r in resultados.values()),
+        "archivos_con_error": sum(1 for r in resultados.values() if r["estado"] == "error"),
+        "archivos": list(resultados.values()),
+    }
+
+
+@app.post("/subir-xml/async", response_model=TareaOut, status_code=202)
+def subir_xml_async(
+    file: UploadFile = File(...),
+    forzar: bool = False,
+    db: Session = Depends(get_db),
+    user: models.Usuario = Depends(require_perm("puede_subir_xml")),
+):
+    """
+    Guarda el XML como tarea y responde de inmediato; el progreso se consulta en
+    /tareas/{id}. Si el archivo ya se cargó, la tarea nace completada con el
+    resultado guardado.
+    """
+    if not file.filename.lower().endswith(".xml"):
+        raise HTTPException(status_code=400, detail="Solo se permiten archivos XML. Selecciona un archivo .xml válido.")
+
+    contenido = file.file.read()
+    sha256 = cargas.hash_bytes(contenido)
+    if not forzar:
+        carga = cargas.buscar(db, sha256)
+        if carga:
+            return tareas.registrar_completada(
+                db, "ingesta_xml", cargas.respuesta_previa(carga),
+                nombre_archivo=file.filename, usuario_id=user.id,
+            )
+
+    return tareas.encolar(
+        db,
+        "ingesta_xml",
+        archivo=contenido,
+        nombre_archivo=file.filename,
+        parametros={"sha256": sha256, "tamano": len(contenido)},
+        usuario_id=user.id,
+    )
+
+
+@app.get("/tareas/{tarea_id}", response_model=TareaOut)
+def obtener_tarea(
+    tarea_id: int,
+    db: Session = Depends(get_db),
+    user: models.Usuario = Depends(get_current_user),
+):
+    tarea = db.query(models.Tarea).filter(models.Tarea.id == tarea_id).first()
+    if not tarea or (tarea.usuario_id != user.id and not es_superadmin(user)):
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    return tarea
+
+
 # -----------------------
 # FACTURAS (filtra por negocio si no es superadmin)
 # -----------------------
@@ -373,8 +379,11 @@ def obtener_facturas(
     folio: Optional[str] = None,
     limit: int = 25,
     offset: int = 0,
+    cursor: Optional[str] = None,
+    total: str = "exacto",
     current_user: Usuario = Depends(get_current_user),
 ):
+    paginacion.validar_modo_total(total)
     q = (
         db.query(models.Factura)
         .options(joinedload(models.Factura.proveedor), joinedload(models.Factura.negocio))
@@ -384,7 +393,7 @@ def obtener_facturas(
 
     if not es_superadmin(current_user):
         if not current_user.negocio_id:
-            return {"items": [], "total": 0}
+            return {"items": [], "total": 0, "next_cursor": None, "has_more": False}
         negocio_id = current_user.negocio_id
         negocio_nombre = None
 
@@ -401,18 +410,24 @@ def obtener_facturas(
         q = q.filter(models.NombreNegocio.nombre.ilike(f"%{negocio_nombre}%"))
 
     if proveedor_rut:
-        rut = proveedor_rut.replace(".", "").upper()
-        q = q.filter(func.replace(func.upper(models.Proveedor.rut), ".", "") == rut)
+        q = q.filter(models.Proveedor.rut_norm == normalizar_rut(proveedor_rut))
 
     if folio:
         q = q.filter(models.Factura.folio.ilike(f"%{folio}%"))
 
-    total = q.order_by(None).with_entities(func.count(models.Factura.id)).scalar() or 0
-    items = (
-        q.order_by(models.Factura.fecha_emision.desc(), models.Factura.id.desc())
-        .offset(offset).limit(limit).all()
+    conteo = paginacion.contar(q, total, models.Factura.id)
+    if cursor:
+        # fecha_emision.desc() deja las facturas sin fecha primero
+        q = q.filter(paginacion.despues_de(models.Factura.fecha_emision, models.Factura.id, cursor, nulos_primero=True))
+        offset = 0
+    items, next_cursor, has_more = paginacion.paginar(
+        q,
+        (models.Factura.fecha_emision.desc(), models.Factura.id.desc()),
+        limit,
+        lambda f: (f.fecha_emision, f.id),
+        offset=offset,
     )
-    return {"items": items, "total": total}
+    return {"items": items, "total": conteo, "next_cursor": next_cursor, "has_more": has_more}
 
 
 # -----------------------
@@ -432,11 +447,14 @@ def obtener_productos(
     offset: int = 0,
     negocio_id: Optional[int] = None,
     negocio_nombre: Optional[str] = None,
+    cursor: Optional[str] = None,
+    total: str = "exacto",
     current_user: Usuario = Depends(get_current_user),
 ):
+    paginacion.validar_modo_total(total)
     if not es_superadmin(current_user):
         if not current_user.negocio_id:
-            return {"productos": [], "total": 0}
+            return {"productos": [], "total": 0, "next_cursor": None, "has_more": False}
         negocio_id = current_user.negocio_id
         negocio_nombre = None
 
@@ -453,8 +471,15 @@ def obtener_productos(
         offset=offset,
         negocio_id=negocio_id,
         negocio_nombre=negocio_nombre,
+        cursor=cursor,
+        total_modo=total,
     )
-    return {"productos": res["items"], "total": res["total"]}
+    return {
+        "productos": res["items"],
+        "total": res["total"],
+        "next_cursor": res["next_cursor"],
+        "has_more": res["has_more"],
+    }
 
 
 # -----------------------
@@ -469,58 +494,34 @@ def obtener_datos_dashboard(
     codigo_producto: Optional[str] = None,
     current_user: models.Usuario = Depends(require_perm("puede_ver_dashboard")),
 ):
-    base = (
-        db.query(models.DetalleFactura)
-        .join(models.Factura, models.Factura.id == models.DetalleFactura.factura_id)
-        .join(models.Producto, models.Producto.id == models.DetalleFactura.producto_id)
-        .join(models.Proveedor, models.Proveedor.id == models.Producto.proveedor_id)
-        .outerjoin(models.NombreNegocio, models.Factura.negocio_id == models.NombreNegocio.id)
-    )
-
+    negocio_id = None
     if not es_superadmin(current_user):
         if not current_user.negocio_id:
             return {"historial_precios": [], "facturas_mensuales": [], "promedios_proveedor": []}
-        base = base.filter(models.Factura.negocio_id == current_user.negocio_id)
-
-    # filtros fecha
-    if fecha_inicio and fecha_fin:
-        base = base.filter(models.Factura.fecha_emision.between(fecha_inicio, fecha_fin))
-    elif fecha_inicio:
-        base = base.filter(models.Factura.fecha_emision >= fecha_inicio)
-    elif fecha_fin:
-        base = base.filter(models.Factura.fecha_emision <= fecha_fin)
-
-    if cod_admin_id:
-        base = base.filter(models.Producto.cod_admin_id == cod_admin_id)
-
-    if codigo_producto:
-        base = base.filter(models.Producto.codigo.ilike(f"%{codigo_producto}%"))
-
-    mes_expr = func.date_trunc("month", models.Factura.fecha_emision).label("mes")
+        negocio_id = current_user.negocio_id
 
-    historial = (
-        base.with_entities(mes_expr, func.avg(models.DetalleFactura.costo_unitario).label("costo_promedio"))
-        .group_by(mes_expr).order_by(mes_expr).all()
-    )
-    facturas_mensuales = (
-        base.with_entities(mes_expr, func.sum(models.DetalleFactura.total_costo).label("total"))
-        .group_by(mes_expr).order_by(mes_expr).all()
-    )
-    promedios_proveedor = (
-        base.with_entities(models.Proveedor.nombre.label("proveedor"), func.avg(models.DetalleFactura.costo_unitario).label("costo_promedio"))
-        .group_by(models.Proveedor.nombre).order_by(models.Proveedor.nombre).all()
+    return cache_dashboard.obtener(
+        db,
+        negocio_id,
+        (fecha_inicio, fecha_fin, cod_admin_id, codigo_producto),
+        lambda: crud.datos_dashboard(
+            db,
+            negocio_id=negocio_id,
+            fecha_inicio=fecha_inicio,
+            fecha_fin=fecha_fin,
+            cod_admin_id=cod_admin_id,
+            codigo_producto=codigo_producto,
+        ),
     )
 
-    def mes_to_str(m):
-        return (m.strftime("%Y-%m") if hasattr(m, "strftime") else str(m)[:7])
 
-    return {
-        "historial_precios": [{"mes": mes_to_str(mes), "costo_promedio": float(costo or 0.0)} for mes, costo in historial],
-        "facturas_mensuales": [{"mes": mes_to_str(mes), "total": float(total or 0.0)} for mes, total in facturas_mensuales],
-        "promedios_proveedor": [{"proveedor": prov, "costo_promedio": float(costo or 0.0)} for prov, costo in promedios_proveedor],
-    }
+@app.get("/dashboard/cache")
+def estadisticas_cache_dashboard(_: Usuario = Depends(solo_superadmin)):
+    """Aciertos / fallos del caché del dashboard en este proceso."""
+    return cache_dashboard.estadisticas()
 
 
+@app.get("/exportar/productos")
 @app.get("/exportar/productos/excel")
 def exportar_productos_excel(
     db: Session = Depends(get_db),
@@ -533,62 +534,63 @@ def exportar_productos_excel(
     folio: Optional[str] = None,
     negocio_id: Optional[int] = None,
     negocio_nombre: Optional[str] = None,
+    formato: str = Depends(exportar.parametro_formato("xlsx")),
+    current_user: Usuario = Depends(get_current_user),
 ):
-    res = crud.obtener_productos_filtrados(
-        db=db,
+    if not es_superadmin(current_user):
+        if not current_user.negocio_id:
+            raise HTTPException(status_code=403, detail="Usuario sin negocio asignado")
+        negocio_id = current_user.negocio_id
+        negocio_nombre = None
+
+    productos = crud.iterar_productos_filtrados(
+        db,
         nombre=nombre, cod_admin_id=cod_admin_id, categoria_id=categoria_id,
         fecha_inicio=fecha_inicio, fecha_fin=fecha_fin,
         codigo=codigo, folio=folio,
-        limit=100000, offset=0,            
         negocio_id=negocio_id, negocio_nombre=negocio_nombre,
     )
-    productos = res["items"]
-
-    wb = Workbook(); ws = wb.active; ws.title = "Productos"
-    headers = [
-        "Folio","Negocio","FchEmis",
-        "ID","Nombre","Nombre Maestro","Código",
-        "Cod Admin","UM","Familia","Área",
-        "Cantidad","Unidad",
-        "Precio Unitario","Neto","% Adic","Imp. Adic","Otros",
-        "Total Costo","Costo Unitario","Cod Lectura"
-    ]
-    ws.append(headers)
-
-    for p in productos:
-        ca = p.get("cod_admin") or {}
-        ws.append([
-            p.get("folio",""),
-            p.get("negocio_nombre",""),
-            str(p.get("fecha_emision") or "")[:10],
-            p["id"],
-            p["nombre"],
-            p.get("nombre_maestro") or "",
-            p.get("codigo") or "",
-            ca.get("cod_admin",""),
-            ca.get("um",""),
-            ca.get("familia",""),
-            ca.get("area",""),
-            p.get("cantidad",0),
-            p.get("unidad",""),
-            p.get("precio_unitario",0),
-            p.get("total_neto",0),
-            (ca.get("porcentaje_adicional") or 0),
-            p.get("imp_adicional",0),
-            p.get("otros",0),
-            p.get("total_costo",0),
-            p.get("costo_unitario",0),
-            p.get("cod_lectura",""),
-        ])
-
-    stream = io.BytesIO(); wb.save(stream); stream.seek(0)
-    return StreamingResponse(
-        stream,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=productos_filtrados.xlsx"}
-    )
 
+    columnas = [
+        ("Folio", "str"), ("Negocio", "str"), ("FchEmis", "date"),
+        ("ID", "int"), ("Nombre", "str"), ("Nombre Maestro", "str"), ("Código", "str"),
+        ("Cod Admin", "str"), ("UM", "float"), ("Familia", "str"), ("Área", "str"),
+        ("Cantidad", "float"), ("Unidad", "str"),
+        ("Precio Unitario", "float"), ("Neto", "float"), ("% Adic", "float"), ("Imp. Adic", "float"), ("Otros", "float"),
+        ("Total Costo", "float"), ("Costo Unitario", "float"), ("Cod Lectura", "str"),
+    ]
 
+    def filas():
+        for p in productos:
+            ca = p.get("cod_admin") or {}
+            yield [
+                p.get("folio",""),
+                p.get("negocio_nombre",""),
+                str(p.get("fecha_emision") or "")[:10],
+                p["id"],
+                p["nombre"],
+                p.get("nombre_maestro") or "",
+                p.get("codigo") or "",
+                ca.get("cod_admin",""),
+                ca.get("um",""),
+                ca.get("familia",""),
+                ca.get("area",""),
+                p.get("cantidad",0),
+                p.get("unidad",""),
+                p.get("precio_unitario",0),
+                p.get("total_neto",0),
+                (ca.get("porcentaje_adicional") or 0),
+                p.get("imp_adicional",0),
+                p.get("otros",0),
+                p.get("total_costo",0),
+                p.get("costo_unitario",0),
+                p.get("cod_lectura",""),
+            ]
+
+    return exportar.exportar(formato, "Productos", columnas, filas(), "productos_filtrados")
+
+
+@app.get("/exportar/facturas")
 @app.get("/exportar/facturas/excel")
 def exportar_facturas_excel(
     db: Session = Depends(get_db),
@@ -598,11 +600,30 @@ def exportar_facturas_excel(
     negocio_nombre: Optional[str] = None,
     proveedor_rut: Optional[str] = None,
     folio: Optional[str] = None,
+    formato: str = Depends(exportar.parametro_formato("xlsx")),
+    current_user: Usuario = Depends(get_current_user),
 ):
+    if not es_superadmin(current_user):
+        if not current_user.negocio_id:
+            raise HTTPException(status_code=403, detail="Usuario sin negocio asignado")
+        negocio_id = current_user.negocio_id
+        negocio_nombre = None
+
+    F, D = models.Factura, models.DetalleFactura
+    signo = case((F.es_nota_credito.is_(True), -1.0), else_=1.0)
+    # totales por factura en la misma consulta (GROUP BY) en vez de recorrer f.detalles
     q = (
-        db.query(models.Factura)
-        .outerjoin(models.NombreNegocio, models.Factura.negocio_id == models.NombreNegocio.id)
-        .outerjoin(models.Proveedor, models.Proveedor.id == models.Factura.proveedor_id)
+        db.query(
+            F.id, F.folio, F.fecha_emision, F.monto_total, F.es_nota_credito,
+            models.Proveedor.id, models.Proveedor.nombre, models.Proveedor.rut,
+            models.NombreNegocio.id, models.NombreNegocio.nombre,
+            func.coalesce(func.sum(D.precio_unitario * D.cantidad), 0) * signo,
+            func.coalesce(func.sum(D.iva), 0),
+            func.coalesce(func.sum(D.otros_impuestos), 0),
+        )
+        .outerjoin(D, D.factura_id == F.id)
+        .outerjoin(models.NombreNegocio, F.negocio_id == models.NombreNegocio.id)
+        .outerjoin(models.Proveedor, models.Proveedor.id == F.proveedor_id)
     )
     if fecha_inicio and fecha_fin:
         q = q.filter(models.Factura.fecha_emision.between(fecha_inicio, fecha_fin))
@@ -617,43 +638,101 @@ def exportar_facturas_excel(
         q = q.filter(models.NombreNegocio.nombre.ilike(f"%{negocio_nombre}%"))
 
     if proveedor_rut:
-        rut = proveedor_rut.replace(".","").upper()
-        q = q.filter(func.replace(func.upper(models.Proveedor.rut), ".", "") == rut)
+        q = q.filter(models.Proveedor.rut_norm == normalizar_rut(proveedor_rut))
 
     if folio:
         q = q.filter(models.Factura.folio.ilike(f"%{folio}%"))
 
-    facturas = q.order_by(models.Factura.fecha_emision.asc(), models.Factura.id.asc()).all()
+    facturas = (
+        q.group_by(F.id, models.Proveedor.id, models.NombreNegocio.id)
+        .order_by(F.fecha_emision.asc(), F.id.asc())
+        .yield_per(1000)
+    )
 
-    wb = Workbook(); ws = wb.active; ws.title = "Facturas"
-    headers = [
-        "ID","Folio","FchEmis","Proveedor","RUT Proveedor",
-        "Negocio","RUT Receptor (si lo guardas)","Total Neto (calc)","IVA","Otros Impuestos","Total (XML)",
-        "Es Nota de Crédito"
+    columnas = [
+        ("ID", "int"), ("Folio", "str"), ("FchEmis", "date"), ("Proveedor", "str"), ("RUT Proveedor", "str"),
+        ("Negocio", "str"), ("RUT Receptor (si lo guardas)", "str"), ("Total Neto (calc)", "float"),
+        ("IVA", "float"), ("Otros Impuestos", "float"), ("Total (XML)", "float"),
+        ("Es Nota de Crédito", "bool"),
     ]
-    ws.append(headers)
-
-    for f in facturas:
-        total_neto = sum(det.precio_unitario * det.cantidad * (-1 if f.es_nota_credito else 1) for det in f.detalles)
-        iva = sum(det.iva for det in f.detalles)
-        otros = sum(det.otros_impuestos for det in f.detalles)
-        total = f.monto_total or 0
-        ws.append([
-            f.id, f.folio, f.fecha_emision.isoformat() if f.fecha_emision else "",
-            (f.proveedor.nombre if f.proveedor else ""),
-            (f.proveedor.rut if f.proveedor else ""),
-            (f.negocio.nombre if f.negocio else ""),
-            getattr(f, "rut_receptor", ""), 
-            total_neto, iva, otros, total, bool(f.es_nota_credito),
-        ])
-
-    stream = io.BytesIO(); wb.save(stream); stream.seek(0)
-    return StreamingResponse(
-        stream,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=facturas_filtradas.xlsx"}
+
+    def filas():
+        for (id_, folio_, fecha, monto_total, es_nc, prov_id, prov_nombre, prov_rut,
+             neg_id, neg_nombre, total_neto, iva, otros) in facturas:
+            yield [
+                id_, folio_, fecha.isoformat() if fecha else "",
+                (prov_nombre if prov_id is not None else ""),
+                (prov_rut if prov_id is not None else ""),
+                (neg_nombre if neg_id is not None else ""),
+                "",
+                total_neto, iva, otros, monto_total or 0, bool(es_nc),
+            ]
+
+    return exportar.exportar(formato, "Facturas", columnas, filas(), "facturas_filtradas")
+
+
+@app.get("/exportar/detalles")
+def exportar_detalles(
+    db: Session = Depends(get_db),
+    fecha_inicio: Optional[date] = None,
+    fecha_fin: Optional[date] = None,
+    negocio_id: Optional[int] = None,
+    proveedor_rut: Optional[str] = None,
+    cod_admin_id: Optional[int] = None,
+    folio: Optional[str] = None,
+    formato: str = Depends(exportar.parametro_formato("csv")),
+    current_user: Usuario = Depends(get_current_user),
+):
+    """Una fila por línea de factura (detalle) con su factura, proveedor, negocio y producto."""
+    F, D, P = models.Factura, models.DetalleFactura, models.Producto
+    q = (
+        db.query(
+            D.id, F.id, F.folio, F.fecha_emision, F.es_nota_credito,
+            models.Proveedor.rut, models.Proveedor.nombre,
+            F.negocio_id, models.NombreNegocio.nombre,
+            P.id, P.nombre, P.codigo, P.cod_admin_id, models.CodigoLectura.valor,
+            D.cantidad, D.precio_unitario, D.total, D.iva, D.otros_impuestos,
+            D.imp_adicional, D.otros, D.total_costo, D.costo_unitario,
+        )
+        .join(F, F.id == D.factura_id)
+        .outerjoin(P, P.id == D.producto_id)
+        .outerjoin(models.CodigoLectura, models.CodigoLectura.id == P.cod_lec_id)
+        .outerjoin(models.Proveedor, models.Proveedor.id == F.proveedor_id)
+        .outerjoin(models.NombreNegocio, models.NombreNegocio.id == F.negocio_id)
     )
 
+    if not es_superadmin(current_user):
+        if not current_user.negocio_id:
+            raise HTTPException(status_code=403, detail="Usuario sin negocio asignado")
+        negocio_id = current_user.negocio_id
+
+    if fecha_inicio and fecha_fin:
+        q = q.filter(F.fecha_emision.between(fecha_inicio, fecha_fin))
+    elif fecha_inicio:
+        q = q.filter(F.fecha_emision >= fecha_inicio)
+    elif fecha_fin:
+        q = q.filter(F.fecha_emision <= fecha_fin)
+    if negocio_id:
+        q = q.filter(F.negocio_id == negocio_id)
+    if proveedor_rut:
+        q = q.filter(models.Proveedor.rut_norm == normalizar_rut(proveedor_rut))
+    if cod_admin_id:
+        q = q.filter(P.cod_admin_id == cod_admin_id)
+    if folio:
+        q = q.filter(F.folio.ilike(f"%{folio}%"))
+
+    columnas = [
+        ("Detalle ID", "int"), ("Factura ID", "int"), ("Folio", "str"), ("FchEmis", "date"),
+        ("Es Nota de Crédito", "bool"), ("RUT Proveedor", "str"), ("Proveedor", "str"),
+        ("Negocio ID", "int"), ("Negocio", "str"),
+        ("Producto ID", "int"), ("Producto", "str"), ("Código", "str"), ("Cod Admin ID", "int"), ("Cod Lectura", "str"),
+        ("Cantidad", "float"), ("Precio Unitario", "float"), ("Neto", "float"), ("IVA", "float"),
+        ("Otros Impuestos", "float"), ("Imp. Adic", "float"), ("Otros", "float"),
+        ("Total Costo", "float"), ("Costo Unitario", "float"),
+    ]
+    filas = q.order_by(F.fecha_emision.asc(), F.id.asc(), D.id.asc()).yield_per(2000)
+    return exportar.exportar(formato, "Detalles", columnas, (list(f) for f in filas), "detalles_facturas")
+
 @app.get("/productos/order-ids")
 def productos_order_ids(
     db: Session = Depends(get_db),
@@ -667,79 +746,67 @@ def productos_order_ids(
     negocio_id: Optional[int] = None,
     negocio_nombre: Optional[str] = None,
     max_ids: int = 5000,  # seguridad
+    vecino_de: Optional[int] = None,
+    total: str = "exacto",
 ):
-    
-    res = crud.obtener_productos_filtrados(
-        db=db,
+    """
+    Ids ordenados del listado (para navegar anterior / siguiente). Con vecino_de
+    devuelve solo {"id", "prev", "next", "posicion", "total"} de ese producto.
+    """
+    paginacion.validar_modo_total(total)
+    return crud.obtener_ids_productos_filtrados(
+        db,
+        max_ids=max_ids, total_modo=total, vecino_de=vecino_de,
         nombre=nombre, cod_admin_id=cod_admin_id, categoria_id=categoria_id,
         fecha_inicio=fecha_inicio, fecha_fin=fecha_fin,
         codigo=codigo, folio=folio,
-        limit=max_ids, offset=0,
         negocio_id=negocio_id, negocio_nombre=negocio_nombre,
     )
-    ids = [item["id"] for item in res["items"]]
-    return {"ids": ids, "total": res["total"]}
 
 
 @app.get("/productos/{id}", response_model=ProductoConPrecio)
 def obtener_producto_por_id(id: int, db: Session = Depends(get_db)):
-    producto = db.query(models.Producto).filter(models.Producto.id == id).first()
-    if not producto:
-        raise HTTPException(status_code=404, detail="Producto no encontrado")
-
-    detalle = (
-        db.query(models.DetalleFactura)
-        .join(models.Factura, models.Factura.id == models.DetalleFactura.factura_id)
-        .filter(models.DetalleFactura.producto_id == id)
-        .order_by(models.Factura.fecha_emision.desc(), models.DetalleFactura.id.desc())
-        .first()
-    )
+    return crud.obtener_ficha_producto(db, id)
 
-    if not detalle:
-        return {
-            "id": producto.id, "nombre": producto.nombre, "codigo": producto.codigo,
-            "unidad": producto.unidad, "cantidad": 0, "proveedor": producto.proveedor,
-            "proveedor_id": producto.proveedor_id, "categoria_id": producto.categoria_id,
-            "cod_admin_id": producto.cod_admin_id, "precio_unitario": 0, "iva": 0,
-            "otros_impuestos": 0, "total": 0, "porcentaje_adicional": (producto.cod_admin.porcentaje_adicional if producto.cod_admin else 0.0),
-            "imp_adicional": 0, "categoria": producto.categoria, "cod_admin": producto.cod_admin,
-            "total_neto": 0, "costo_unitario": 0, "total_costo": 0, "otros": 0
-        }
-
-    porcentaje_adicional = producto.cod_admin.porcentaje_adicional if producto.cod_admin else 0.0
-    total_costo = detalle.total + detalle.imp_adicional + (detalle.otros or 0)
-    um_factor = 1.0
-    if producto.cod_admin and producto.cod_admin.um:
-        try:
-            um_factor = float(producto.cod_admin.um)
-        except Exception:
-            um_factor = 1.0
-
-    denom = (detalle.cantidad or 0) * um_factor
-    costo_unitario = (total_costo / denom) if denom else 0
 
+@app.get("/productos/{id}/ficha")
+def obtener_ficha_producto(
+    id: int,
+    db: Session = Depends(get_db),
+    nombre: Optional[str] = None,
+    cod_admin_id: Optional[int] = None,
+    categoria_id: Optional[int] = None,
+    fecha_inicio: Optional[date] = None,
+    fecha_fin: Optional[date] = None,
+    codigo: Optional[str] = None,
+    folio: Optional[str] = None,
+    negocio_id: Optional[int] = None,
+    negocio_nombre: Optional[str] = None,
+    total: str = "ninguno",
+):
+    """
+    Todo lo que necesita la edición de un producto en una request: el producto con
+    su último costo (igual que /productos/{id}) y su anterior / siguiente en el
+    listado con estos filtros (igual que /productos/order-ids?vecino_de=id).
+    Sin total= no se cuenta el listado en cada paso (posicion / total vienen
+    en None); con total=exacto o estimado sí.
+    """
+    paginacion.validar_modo_total(total)
+    producto = ProductoConPrecio.model_validate(crud.obtener_ficha_producto(db, id))
+    vecinos = crud.obtener_ids_productos_filtrados(
+        db,
+        total_modo=total, vecino_de=id,
+        nombre=nombre, cod_admin_id=cod_admin_id, categoria_id=categoria_id,
+        fecha_inicio=fecha_inicio, fecha_fin=fecha_fin,
+        codigo=codigo, folio=folio,
+        negocio_id=negocio_id, negocio_nombre=negocio_nombre,
+    )
     return {
-        "id": producto.id,
-        "nombre": producto.nombre,
-        "codigo": producto.codigo,
-        "unidad": producto.unidad,
-        "cantidad": detalle.cantidad,
-        "proveedor": producto.proveedor,
-        "proveedor_id": producto.proveedor_id,
-        "categoria_id": producto.categoria_id,
-        "cod_admin_id": producto.cod_admin_id,
-        "precio_unitario": detalle.precio_unitario,
-        "iva": detalle.iva,
-        "otros_impuestos": detalle.otros_impuestos,
-        "total": detalle.total,                      
-        "porcentaje_adicional": porcentaje_adicional,
-        "imp_adicional": detalle.imp_adicional,
-        "categoria": producto.categoria,
-        "cod_admin": producto.cod_admin,
-        "total_neto": detalle.total,
-        "costo_unitario": costo_unitario,
-        "total_costo": total_costo,
-        "otros": detalle.otros,                       
+        "producto": producto,
+        "prev": vecinos["prev"],
+        "next": vecinos["next"],
+        "posicion": vecinos["posicion"],
+        "total": vecinos["total"],
     }
 
 
@@ -767,6 +834,40 @@ def listar_codigos_admin(db: Session = Depends(get_db)):
         .all()
     )
 
+@app.put("/codigos_admin_maestro/{cod_admin_id}", status_code=202)
+def actualizar_codigo_admin_maestro(
+    cod_admin_id: int,
+    body: CodigoAdminMaestroUpdate,
+    db: Session = Depends(get_db),
+    user: models.Usuario = Depends(require_perm("puede_ver_tablas")),
+):
+    """
+    Cambia porcentaje_adicional / um (y encola el recálculo de los detalles de
+    todos los productos con ese cod_admin; responde al tiro con la tarea) y/o
+    nombre_producto (refresca la búsqueda de sus productos, sin tarea).
+    """
+    cod, cambio = crud.actualizar_cod_admin_maestro(
+        db, cod_admin_id, porcentaje_adicional=body.porcentaje_adicional, um=body.um,
+        nombre_producto=body.nombre_producto,
+    )
+    tarea = tareas.encolar_recalculo_cod_admin(db, [cod.id], usuario_id=user.id) if cambio else None
+    return {
+        "cod_admin": CodigoAdminMaestro.model_validate(cod),
+        "tarea": TareaOut.model_validate(tarea) if tarea else None,
+    }
+
+
+@app.post("/codigos_admin_maestro/{cod_admin_id}/recalcular", response_model=TareaOut, status_code=202)
+def recalcular_codigo_admin_maestro(
+    cod_admin_id: int,
+    db: Session = Depends(get_db),
+    user: models.Usuario = Depends(require_perm("puede_ver_tablas")),
+):
+    if not db.query(models.CodigoAdminMaestro.id).filter(models.CodigoAdminMaestro.id == cod_admin_id).first():
+        raise HTTPException(status_code=404, detail="Código admin no encontrado")
+    return tareas.encolar_recalculo_cod_admin(db, [cod_admin_id], usuario_id=user.id)
+
+
 @app.put("/productos/{producto_id}/asignar-cod-admin")
 def asignar_cod_admin(producto_id: int, cod_admin_id: int, db: Session = Depends(get_db)):
     producto = crud.actualizar_producto(db, producto_id, ProductoUpdate(cod_admin_id=cod_admin_id))
@@ -782,6 +883,7 @@ def sugerir_cod_lec(req: CodLecSugerirRequest, db: Session = Depends(get_db)):
 @app.post("/cod-lec/asignar")
 def asignar_cod_lec(req: CodLecAsignacionRequest, db: Session = Depends(get_db)):
     cod_lec = crud.asignar_cod_lec_a_cod_admin(db, req.cod_lec, req.cod_admin_id)
+    db.commit()
     return {"ok": True, "cod_lec": cod_lec.valor, "cod_admin_id": cod_lec.cod_admin_id}
 
 
@@ -958,6 +1060,18 @@ def actualizar_porcentaje_adicional_producto(
         raise HTTPException(status_code=404, detail="Producto no encontrado")
 
     pct = float(body.porcentaje_adicional or 0.0)
+
+    if prod.cod_admin_id:
+        # el porcentaje vive en el cod_admin: este producto se recalcula al tiro y
+        # los demás que lo comparten quedan en una tarea en segundo plano
+        # (si el porcentaje no cambió no hay nada que recalcular)
+        _, cambio = crud.actualizar_porcentaje_adicional(db, producto_id, pct)
+        tarea = tareas.encolar_recalculo_cod_admin(db, [prod.cod_admin_id]) if cambio else None
+        return {
+            "ok": True, "producto_id": producto_id, "porcentaje_adicional": pct,
+            "tarea_id": tarea.id if tarea else None,
+        }
+
     prod.porcentaje_adicional = pct
 
     # recalcular detalles (imp_adicional / total_costo / costo_unitario)
@@ -973,6 +1087,8 @@ def actualizar_porcentaje_adicional_producto(
         d.total_costo = base + d.imp_adicional + (d.otros or 0)
         d.costo_unitario = (d.total_costo / d.cantidad) if d.cantidad else 0
 
+    db.flush()
+    crud.refrescar_resumen_mensual(db, crud.claves_resumen(db, producto_ids=[producto_id]))
     db.commit()
     return {"ok": True, "producto_id": producto_id, "porcentaje_adicional": pct}
 
@@ -998,7 +1114,18 @@ def eliminar_factura(
     if not f:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
 
+    producto_ids = [
+        pid for (pid,) in db.query(models.DetalleFactura.producto_id)
+        .filter(models.DetalleFactura.factura_id == factura_id)
+        .distinct()
+    ]
+    claves = crud.claves_resumen(db, factura_ids=[factura_id])
+    documento = (f.proveedor_id, f.folio)
     db.query(models.DetalleFactura).filter(models.DetalleFactura.factura_id == factura_id).delete()
     db.delete(f)
+    db.flush()
+    crud.refrescar_ultimo_detalle(db, producto_ids)
+    crud.refrescar_resumen_mensual(db, claves)
+    cargas.invalidar(db, [documento])
     db.commit()
     return {"ok": True}
@@ -0,0 +1,131 @@
+# app/migraciones.py
+"""
+Cambios de esquema idempotentes que se aplican al iniciar la app.
+
+No usamos Alembic: las tablas nuevas salen de los modelos (create_all, que no
+toca las existentes) y las columnas / índices nuevos sobre tablas existentes
+van como SQL con IF NOT EXISTS en SENTENCIAS. Todo corre en una transacción
+con un advisory lock, así varios workers de uvicorn pueden arrancar a la vez.
+"""
+import logging
+
+from sqlalchemy import text
+
+from app.database import Base
+from app.rut import normalizar_rut
+from app.crud import texto_busqueda
+from app import models  # noqa: F401  (registra los modelos en Base.metadata)
+
+logger = logging.getLogger(__name__)
+
+_LOCK_ID = 748201  # arbitrario, solo identifica este lock
+
+SENTENCIAS = [
+    # RUT normalizado de proveedores (búsquedas por índice en vez de replace(upper(rut)))
+    "ALTER TABLE proveedores ADD COLUMN IF NOT EXISTS rut_norm VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_proveedores_rut_norm ON proveedores (rut_norm)",
+    # nombre visible normalizado para la búsqueda de productos
+    "ALTER TABLE productos ADD COLUMN IF NOT EXISTS nombre_busqueda VARCHAR",
+    # negocio del producto (clave del producto canónico junto a proveedor y cod_lec)
+    "ALTER TABLE productos ADD COLUMN IF NOT EXISTS negocio_id INTEGER REFERENCES nombre_negocio (id)",
+    "CREATE INDEX IF NOT EXISTS ix_productos_cod_lec_negocio ON productos (cod_lec_id, negocio_id)",
+    # carga inicial: el negocio de sus detalles, solo si es uno solo (los que ya
+    # mezclan negocios quedan sin negocio y no se reusan ni se compactan)
+    """
+    UPDATE productos p SET negocio_id = x.negocio_id
+    FROM (
+        SELECT d.producto_id, min(f.negocio_id) AS negocio_id
+        FROM detalle_factura d JOIN facturas f ON f.id = d.factura_id
+        GROUP BY d.producto_id
+        HAVING count(DISTINCT coalesce(f.negocio_id, 0)) = 1 AND min(f.negocio_id) IS NOT NULL
+    ) x
+    WHERE p.id = x.producto_id AND p.negocio_id IS NULL
+      AND NOT EXISTS (SELECT 1 FROM productos WHERE negocio_id IS NOT NULL)
+    """,
+    # índices para los recálculos / proyección por producto y los borrados por factura
+    "CREATE INDEX IF NOT EXISTS ix_detalle_factura_producto_id ON detalle_factura (producto_id)",
+    "CREATE INDEX IF NOT EXISTS ix_detalle_factura_factura_id ON detalle_factura (factura_id)",
+    # carga inicial de ultimo_detalle (solo si está vacía)
+    """
+    INSERT INTO ultimo_detalle (producto_id, detalle_id, factura_id, fecha_emision, folio, negocio_id)
+    SELECT DISTINCT ON (d.producto_id) d.producto_id, d.id, d.factura_id, f.fecha_emision, f.folio, f.negocio_id
+    FROM detalle_factura d JOIN facturas f ON f.id = d.factura_id
+    WHERE d.producto_id IS NOT NULL AND f.fecha_emision IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM ultimo_detalle)
+    ORDER BY d.producto_id, f.fecha_emision DESC, d.id DESC
+    """,
+    # carga inicial de resumen_mensual (solo si está vacía)
+    """
+    INSERT INTO resumen_mensual (negocio_id, mes, proveedor_id, cod_admin_id,
+                                 detalles, suma_costo_unitario, con_costo_unitario, suma_total_costo)
+    SELECT coalesce(f.negocio_id, 0), date_trunc('month', f.fecha_emision)::date, p.proveedor_id,
+           coalesce(p.cod_admin_id, 0), count(d.id), coalesce(sum(d.costo_unitario), 0),
+           count(d.costo_unitario), coalesce(sum(d.total_costo), 0)
+    FROM detalle_factura d
+    JOIN facturas f ON f.id = d.factura_id
+    JOIN productos p ON p.id = d.producto_id
+    WHERE f.fecha_emision IS NOT NULL AND p.proveedor_id IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM resumen_mensual)
+    GROUP BY 1, 2, 3, 4
+    """,
+    # rut_receptor se guardaba con k minúscula; la forma canónica es con K
+    """
+    UPDATE nombre_negocio n SET rut_receptor = upper(n.rut_receptor)
+    WHERE n.rut_receptor <> upper(n.rut_receptor)
+      AND NOT EXISTS (SELECT 1 FROM nombre_negocio o WHERE o.rut_receptor = upper(n.rut_receptor))
+    """,
+]
+
+# Búsquedas por subcadena (LIKE '%x%'): índices trigram. Necesitan la extensión
+# pg_trgm; si el usuario de la BD no puede crearla se sigue sin índices (las
+# consultas funcionan igual, solo que con seq scan).
+SENTENCIAS_TRGM = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_productos_nombre_busqueda_trgm ON productos USING gin (nombre_busqueda gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_productos_codigo_trgm ON productos USING gin (codigo gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_facturas_folio_trgm ON facturas USING gin (folio gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_ultimo_detalle_folio_trgm ON ultimo_detalle USING gin (folio gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_nombre_negocio_nombre_trgm ON nombre_negocio USING gin (nombre gin_trgm_ops)",
+]
+
+
+def _backfill_rut_norm(conn):
+    filas = conn.execute(text("SELECT id, rut FROM proveedores WHERE rut_norm IS NULL AND rut IS NOT NULL")).all()
+    if filas:
+        conn.execute(
+            text("UPDATE proveedores SET rut_norm = :rut_norm WHERE id = :id"),
+            [{"id": i, "rut_norm": normalizar_rut(rut)} for i, rut in filas],
+        )
+
+
+def _backfill_nombre_busqueda(conn):
+    filas = conn.execute(text("""
+        SELECT p.id, coalesce(c.nombre_producto, p.nombre)
+        FROM productos p LEFT JOIN codigos_admin_maestro c ON c.id = p.cod_admin_id
+        WHERE p.nombre_busqueda IS NULL
+    """)).all()
+    if filas:
+        conn.execute(
+            text("UPDATE productos SET nombre_busqueda = :nombre_busqueda WHERE id = :id"),
+            [{"id": i, "nombre_busqueda": texto_busqueda(nombre)} for i, nombre in filas],
+        )
+
+
+def _indices_trgm(conn):
+    try:
+        with conn.begin_nested():
+            for sentencia in SENTENCIAS_TRGM:
+                conn.execute(text(sentencia))
+    except Exception as e:
+        logger.warning("Sin índices trigram (pg_trgm no disponible): %s", str(e).splitlines()[0])
+
+
+def aplicar(engine):
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _LOCK_ID})
+        Base.metadata.create_all(bind=conn)
+        for sentencia in SENTENCIAS:
+            conn.execute(text(sentencia))
+        _backfill_rut_norm(conn)
+        _backfill_nombre_busqueda(conn)
+        _indices_trgm(conn)
@@ -1,9 +1,12 @@
 # app/models.py
 
-from sqlalchemy import Column, Integer, String, Float, Date, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, BigInteger, String, Float, Date, DateTime, ForeignKey, Boolean, LargeBinary, JSON
+from sqlalchemy.orm import relationship, validates, deferred
 from app.database import Base
-from sqlalchemy import UniqueConstraint
+from app.rut import normalizar_rut
+from sqlalchemy import UniqueConstraint, Index
 # -----------------------------
 # MODELOS SQLAlchemy (Tablas)
 # -----------------------------
@@ -13,6 +16,7 @@ class Proveedor(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     rut = Column(String, unique=True, index=True)
+    rut_norm = Column(String, index=True, nullable=True)   # normalizar_rut(rut); todas las búsquedas van por aquí
     nombre = Column(String)
     tipo_pago = Column(String, nullable=True)
     direccion = Column(String, nullable=True)
@@ -21,6 +25,11 @@ class Proveedor(Base):
     facturas = relationship("Factura", back_populates="proveedor")
     productos = relationship("Producto", back_populates="proveedor")
 
+    @validates("rut")
+    def _sync_rut_norm(self, key, rut):
+        self.rut_norm = normalizar_rut(rut)
+        return rut
+
 
 class Categoria(Base):
     __tablename__ = "categorias"
@@ -57,6 +66,12 @@ class Producto(Base):
     imp_adicional = Column(Float, default=0.0)  
     
     cod_lec_id = Column(Integer, ForeignKey("codigos_lectura.id"), nullable=True)
+    # negocio cuyas facturas trae este producto; con cod_lec y proveedor es la clave
+    # del producto canónico de la ingesta (cada restaurante tiene los suyos)
+    negocio_id = Column(Integer, ForeignKey("nombre_negocio.id"), nullable=True)
+    # coalesce(cod_admin.nombre_producto, nombre) en minúsculas y sin tildes (crud.texto_busqueda);
+    # lo mantiene crud.refrescar_nombre_busqueda y tiene índice trigram (migraciones)
+    nombre_busqueda = Column(String, nullable=True)
     cod_lec = relationship("CodigoLectura", back_populates="productos")
   
 
@@ -177,5 +192,101 @@ class Usuario(Base):
     negocio = relationship("NombreNegocio", back_populates="usuarios")
 
 
+class UltimoDetalle(Base):
+    """
+    Proyección: el último detalle (fecha de emisión, id) de cada producto.
+    La mantienen crud.avanzar_ultimo_detalle / crud.refrescar_ultimo_detalle;
+    los listados la leen en vez de un DISTINCT ON sobre todo el historial.
+    """
+    __tablename__ = "ultimo_detalle"
+
+    producto_id = Column(Integer, ForeignKey("productos.id", ondelete="CASCADE"), primary_key=True)
+    detalle_id = Column(Integer, ForeignKey("detalle_factura.id", ondelete="CASCADE"), nullable=False)
+    factura_id = Column(Integer, nullable=False, index=True)
+    fecha_emision = Column(Date, index=True)
+    folio = Column(String)
+    negocio_id = Column(Integer, index=True)
+
+
+class ResumenMensual(Base):
+    """
+    Agregado mensual de detalle_factura para el dashboard, por
+    (negocio, mes, proveedor, cod_admin); 0 = sin negocio / sin cod_admin.
+    Guarda sumas y conteos (no promedios) para poder sumarlo por cualquier eje.
+    Lo mantienen crud.sumar_resumen_mensual (ingesta) y crud.refrescar_resumen_mensual.
+    """
+    __tablename__ = "resumen_mensual"
+
+    negocio_id = Column(Integer, primary_key=True)
+    mes = Column(Date, primary_key=True)
+    proveedor_id = Column(Integer, primary_key=True)
+    cod_admin_id = Column(Integer, primary_key=True)
+    detalles = Column(Integer, nullable=False, default=0)
+    suma_costo_unitario = Column(Float, nullable=False, default=0.0)
+    con_costo_unitario = Column(Integer, nullable=False, default=0)   # detalles con costo_unitario no nulo
+    suma_total_costo = Column(Float, nullable=False, default=0.0)
+
+
+class VersionDatos(Base):
+    """Contador por negocio (0 = sin negocio) que invalida el caché del dashboard (app/cache_dashboard.py)."""
+    __tablename__ = "versiones_datos"
+
+    negocio_id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+
+class Tarea(Base):
+    """Trabajo en segundo plano (ver app/tareas.py). La cola es esta misma tabla."""
+    __tablename__ = "tareas"
+
+    id = Column(Integer, primary_key=True, index=True)
+    tipo = Column(String, nullable=False)                       # "ingesta_xml", ...
+    estado = Column(String, nullable=False, default="pendiente", index=True)  # pendiente|procesando|completada|error
+    nombre_archivo = Column(String, nullable=True)
+    archivo = deferred(Column(LargeBinary, nullable=True))      # se libera al completar
+    parametros = Column(JSON, nullable=True)
+    usuario_id = Column(Integer, ForeignKey("usuarios.id"), nullable=True)
+
+    # progreso (ingesta): documentos leídos, facturas insertadas / duplicadas, errores
+    documentos = Column(Integer, default=0)
+    insertadas = Column(Integer, default=0)
+    duplicadas = Column(Integer, default=0)
+    errores = Column(Integer, default=0)
+    mensaje_error = Column(String, nullable=True)
+    resultado = Column(JSON, nullable=True)
+    intentos = Column(Integer, default=0)
+
+    creada_en = Column(DateTime, default=datetime.utcnow)
+    iniciada_en = Column(DateTime, nullable=True)
+    actualizada_en = Column(DateTime, default=datetime.utcnow)   # latido: lo renueva cada lote
+    terminada_en = Column(DateTime, nullable=True)
+
+
+class CargaArchivo(Base):
+    """Registro de archivos XML ya cargados, por SHA-256 del contenido (ver app/cargas.py)."""
+    __tablename__ = "cargas_archivo"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), unique=True, index=True, nullable=False)
+    nombre_archivo = Column(String, nullable=True)
+    tamano = Column(Integer, nullable=True)
+    facturas_nuevas = Column(Integer, default=0)
+    facturas_duplicadas = Column(Integer, default=0)
+    usuario_id = Column(Integer, ForeignKey("usuarios.id"), nullable=True)
+    creada_en = Column(DateTime, default=datetime.utcnow)
+
+
+class CargaFactura(Base):
+    """
+    Documentos (proveedor, folio) que traía cada archivo de cargas_archivo, nuevos
+    o duplicados: al eliminar una factura se olvidan solo las cargas que la traían.
+    """
+    __tablename__ = "cargas_facturas"
+    __table_args__ = (
+        Index("ix_cargas_facturas_proveedor_folio", "proveedor_id", "folio"),
+    )
+
+    carga_id = Column(Integer, ForeignKey("cargas_archivo.id", ondelete="CASCADE"), primary_key=True)
+    proveedor_id = Column(Integer, primary_key=True)
+    folio = Column(String, primary_key=True)
 
-    
\ No newline at end of file
@@ -0,0 +1,101 @@
+# app/paginacion.py
+"""
+Paginación por cursor (keyset) sobre (fecha_emision DESC, id DESC).
+
+En vez de OFFSET, el cliente devuelve el `next_cursor` de la página anterior y
+la consulta arranca justo después de esa fila, así que la página 500 cuesta lo
+mismo que la primera. El cursor es opaco (base64 de fecha|id).
+
+El total es opcional (`total=`):
+  exacto   -> COUNT(*) sobre la consulta filtrada (lo de siempre)
+  estimado -> filas estimadas por el planner (EXPLAIN), sin recorrer nada
+  ninguno  -> no se calcula; el cliente se guía por `has_more`
+"""
+import base64
+import json
+from datetime import date
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, func, or_, tuple_
+
+MODOS_TOTAL = ("exacto", "estimado", "ninguno")
+
+
+def codificar_cursor(fecha: Optional[date], id_: int) -> str:
+    crudo = f"{fecha.isoformat() if fecha else ''}|{int(id_)}"
+    return base64.urlsafe_b64encode(crudo.encode()).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor: str) -> Tuple[Optional[date], int]:
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        fecha, id_ = crudo.split("|")
+        return (date.fromisoformat(fecha) if fecha else None), int(id_)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def validar_modo_total(modo: str) -> str:
+    if modo not in MODOS_TOTAL:
+        raise HTTPException(status_code=400, detail=f"total debe ser uno de: {', '.join(MODOS_TOTAL)}")
+    return modo
+
+
+def despues_de_fila(fecha_col, id_col, fecha: Optional[date], id_: int, nulos_primero: bool = False):
+    """
+    Condición "viene después de la fila (fecha, id)" para ORDER BY fecha DESC, id DESC.
+    nulos_primero indica dónde quedan las filas sin fecha (DESC en Postgres las
+    pone primero salvo NULLS LAST).
+    """
+    if fecha is None:
+        en_nulos = and_(fecha_col.is_(None), id_col < id_)
+        return or_(en_nulos, fecha_col.isnot(None)) if nulos_primero else en_nulos
+    con_fecha = tuple_(fecha_col, id_col) < tuple_(fecha, id_)
+    return con_fecha if nulos_primero else or_(con_fecha, fecha_col.is_(None))
+
+
+def antes_de_fila(fecha_col, id_col, fecha: Optional[date], id_: int, nulos_primero: bool = False):
+    """Lo contrario de despues_de_fila: las filas que van antes de (fecha, id) en ese orden."""
+    if fecha is None:
+        en_nulos = and_(fecha_col.is_(None), id_col > id_)
+        return en_nulos if nulos_primero else or_(en_nulos, fecha_col.isnot(None))
+    con_fecha = and_(fecha_col.isnot(None), tuple_(fecha_col, id_col) > tuple_(fecha, id_))
+    return or_(con_fecha, fecha_col.is_(None)) if nulos_primero else con_fecha
+
+
+def despues_de(fecha_col, id_col, cursor: str, nulos_primero: bool = False):
+    """despues_de_fila a partir de un cursor de codificar_cursor."""
+    fecha, id_ = decodificar_cursor(cursor)
+    return despues_de_fila(fecha_col, id_col, fecha, id_, nulos_primero=nulos_primero)
+
+
+def contar(query, modo: str, columna) -> Optional[int]:
+    """Total según el modo; `query` es la consulta ya filtrada (sin orden ni límite)."""
+    if modo == "ninguno":
+        return None
+    if modo == "exacto":
+        return query.order_by(None).with_entities(func.count(columna)).scalar() or 0
+    stmt = query.order_by(None).with_entities(columna).statement
+    compilado = stmt.compile(
+        dialect=query.session.bind.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    plan = query.session.connection().exec_driver_sql(
+        "EXPLAIN (FORMAT JSON) " + str(compilado), compilado.params
+    ).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def paginar(query, orden, limit: int, clave, offset: int = 0) -> Tuple[list, Optional[str], bool]:
+    """
+    Trae limit+1 filas para saber si hay más. `clave(fila)` devuelve (fecha, id)
+    de la fila para armar el next_cursor. offset queda por compatibilidad con
+    los clientes que todavía paginan por número de página.
+    """
+    filas = query.order_by(*orden).offset(offset or None).limit(limit + 1).all()
+    has_more = len(filas) > limit
+    filas = filas[:limit]
+    next_cursor = codificar_cursor(*clave(filas[-1])) if has_more and filas else None
+    return filas, next_cursor, has_more
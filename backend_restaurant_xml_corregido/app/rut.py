@@ -0,0 +1,19 @@
+# app/rut.py
+import re
+from typing import Optional
+
+
+def normalizar_rut(rut: Optional[str]) -> Optional[str]:
+    """
+    Forma canónica de un RUT: "CUERPO-DV" sin puntos ni espacios y con K mayúscula
+    (ej: "76.123.456-k" -> "76123456-K"). Es la que se guarda en Proveedor.rut_norm,
+    NombreNegocio.rut_receptor y dentro de los cod_lec. Devuelve None si viene vacío.
+    """
+    if not rut:
+        return None
+    s = re.sub(r"[\s.]", "", str(rut)).upper()
+    m = re.match(r"^(\d+)-?([0-9K])$", s)
+    if m:
+        return f"{m.group(1)}-{m.group(2)}"
+    s = re.sub(r"[^0-9K]", "", s)
+    return f"{s[:-1]}-{s[-1]}" if len(s) >= 2 else (s or None)
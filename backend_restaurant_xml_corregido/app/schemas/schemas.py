@@ -2,7 +2,7 @@
 
 from pydantic import BaseModel, model_validator, validator, EmailStr
 from typing import Optional, List, Union
-from datetime import date
+from datetime import date, datetime
 from decimal import Decimal, InvalidOperation
 
 
@@ -82,6 +82,11 @@ class CodigoAdminMaestro(CodigoAdminMaestroCreate):
     class Config:
         from_attributes = True
 
+class CodigoAdminMaestroUpdate(BaseModel):
+    porcentaje_adicional: Optional[float] = None
+    um: Optional[float] = None
+    nombre_producto: Optional[str] = None
+
 
 # -------- PRODUCTO --------
 class ProductoBase(BaseModel):
@@ -299,3 +304,22 @@ class CodLecAsignacionRequest(BaseModel):
     cod_admin_id: int
 
 
+# -------- TAREAS (segundo plano) --------
+class TareaOut(BaseModel):
+    id: int
+    tipo: str
+    estado: str
+    nombre_archivo: Optional[str] = None
+    documentos: int = 0
+    insertadas: int = 0
+    duplicadas: int = 0
+    errores: int = 0
+    mensaje_error: Optional[str] = None
+    resultado: Optional[dict] = None
+    creada_en: Optional[datetime] = None
+    iniciada_en: Optional[datetime] = None
+    actualizada_en: Optional[datetime] = None
+    terminada_en: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
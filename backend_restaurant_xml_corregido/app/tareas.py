@@ -0,0 +1,318 @@
+# app/tareas.py
+"""
+Trabajos en segundo plano con la tabla `tareas` como cola.
+
+El endpoint guarda la tarea (con el archivo) y responde al tiro con su id; un
+pool de hilos locales la toma con SELECT ... FOR UPDATE SKIP LOCKED, así que
+varios procesos de uvicorn (o un worker aparte: `python -m app.tareas`) pueden
+compartir la misma cola sin pisarse. Mientras corre, un hilo de latido toca
+actualizada_en cada TAREAS_LATIDO_SEG; una tarea que quedó "procesando" sin
+latido por más de TAREAS_TIMEOUT_MIN (proceso caído) se vuelve a tomar.
+
+Cada worker ocupa una de las conexiones del pool del proceso (pool_size=3,
+max_overflow=0) mientras procesa: con el worker aparte corriendo, los procesos
+web pueden usar TAREAS_WORKERS=0 y no levantar ninguno.
+
+Cada tipo de tarea tiene su manejador en MANEJADORES: recibe (db, tarea) y
+devuelve el dict que queda en tarea.resultado.
+"""
+import io
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session, undefer
+
+from app import models, crud, xml_parser, ingesta, cargas, migraciones
+from app.database import SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+# cada worker ocupa una conexión mientras procesa (el pool es de 3 por proceso)
+TAREAS_WORKERS = int(os.getenv("TAREAS_WORKERS", "1"))
+TAREAS_POLL_SEG = float(os.getenv("TAREAS_POLL_SEG", "2"))
+TAREAS_TIMEOUT_MIN = int(os.getenv("TAREAS_TIMEOUT_MIN", "30"))
+TAREAS_LATIDO_SEG = float(os.getenv("TAREAS_LATIDO_SEG", "60"))
+# productos por UPDATE (y por commit) en el recálculo por cod_admin
+RECALCULO_LOTE = int(os.getenv("RECALCULO_LOTE", "500"))
+
+_despertar = threading.Event()
+_detener = threading.Event()
+_hilos = []
+
+
+# ---------------------
+# Manejadores
+# ---------------------
+
+def _ingesta_xml(db: Session, tarea: models.Tarea) -> Dict[str, int]:
+    """
+    Ingesta de un XML subido. Cada lote se confirma junto con el progreso: si la
+    tarea falla a mitad, lo ya insertado queda y un reintento lo salta como duplicado.
+    """
+    def _progreso(r):
+        tarea.documentos = r["facturas_nuevas"] + r["facturas_duplicadas"]
+        tarea.insertadas = r["facturas_nuevas"]
+        tarea.duplicadas = r["facturas_duplicadas"]
+        tarea.actualizada_en = datetime.utcnow()
+        db.commit()
+
+    facturas = xml_parser.iterar_xml(io.BytesIO(tarea.archivo))
+    claves = {}
+    resultado = ingesta.ingerir_facturas(db, facturas, al_terminar_lote=_progreso, claves_por_origen=claves)
+    parametros = tarea.parametros or {}
+    if parametros.get("sha256"):
+        cargas.registrar(
+            db, parametros["sha256"], tarea.nombre_archivo, parametros.get("tamano"), resultado, tarea.usuario_id,
+            facturas=claves.get(None),
+        )
+    return resultado
+
+
+def _recalculo_cod_admin(db: Session, tarea: models.Tarea) -> Dict[str, int]:
+    """
+    Recalcula los detalles de todos los productos de los cod_admin dados, por
+    bloques de RECALCULO_LOTE productos (un UPDATE set-based y un commit por
+    bloque). documentos = productos procesados.
+    """
+    cod_admin_ids = (tarea.parametros or {}).get("cod_admin_ids") or []
+    producto_ids = [
+        pid for (pid,) in db.query(models.Producto.id)
+        .filter(models.Producto.cod_admin_id.in_(cod_admin_ids))
+        .order_by(models.Producto.id)
+    ]
+
+    resultado = {"productos": len(producto_ids), "detalles_actualizados": 0}
+    for i in range(0, len(producto_ids), RECALCULO_LOTE):
+        bloque = producto_ids[i:i + RECALCULO_LOTE]
+        resultado["detalles_actualizados"] += crud.recalcular_detalles(db, producto_ids=bloque)
+        tarea.documentos = i + len(bloque)
+        tarea.resultado = dict(resultado)
+        tarea.actualizada_en = datetime.utcnow()
+        db.commit()
+    return resultado
+
+
+MANEJADORES: Dict[str, Callable[[Session, models.Tarea], Optional[dict]]] = {
+    "ingesta_xml": _ingesta_xml,
+    "recalculo_cod_admin": _recalculo_cod_admin,
+}
+
+
+# ---------------------
+# Cola
+# ---------------------
+
+def encolar(
+    db: Session,
+    tipo: str,
+    archivo: Optional[bytes] = None,
+    nombre_archivo: Optional[str] = None,
+    parametros: Optional[dict] = None,
+    usuario_id: Optional[int] = None,
+) -> models.Tarea:
+    if tipo not in MANEJADORES:
+        raise ValueError(f"Tipo de tarea desconocido: {tipo}")
+    tarea = models.Tarea(
+        tipo=tipo,
+        estado="pendiente",
+        archivo=archivo,
+        nombre_archivo=nombre_archivo,
+        parametros=parametros,
+        usuario_id=usuario_id,
+    )
+    db.add(tarea)
+    db.commit()
+    db.refresh(tarea)
+    _despertar.set()
+    return tarea
+
+
+def encolar_recalculo_cod_admin(db: Session, cod_admin_ids, usuario_id: Optional[int] = None) -> models.Tarea:
+    """Encola el recálculo en cascada; si ya hay uno pendiente para los mismos cod_admin, devuelve ese."""
+    ids = sorted({int(i) for i in cod_admin_ids})
+    pendientes = (
+        db.query(models.Tarea)
+        .filter(models.Tarea.tipo == "recalculo_cod_admin", models.Tarea.estado == "pendiente")
+        .all()
+    )
+    for tarea in pendientes:
+        if (tarea.parametros or {}).get("cod_admin_ids") == ids:
+            return tarea
+    return encolar(db, "recalculo_cod_admin", parametros={"cod_admin_ids": ids}, usuario_id=usuario_id)
+
+
+def registrar_completada(
+    db: Session,
+    tipo: str,
+    resultado: dict,
+    nombre_archivo: Optional[str] = None,
+    usuario_id: Optional[int] = None,
+) -> models.Tarea:
+    """Tarea que no necesita procesarse (p.ej. archivo ya cargado): nace completada."""
+    ahora = datetime.utcnow()
+    tarea = models.Tarea(
+        tipo=tipo,
+        estado="completada",
+        nombre_archivo=nombre_archivo,
+        usuario_id=usuario_id,
+        duplicadas=resultado.get("facturas_duplicadas", 0),
+        documentos=resultado.get("facturas_duplicadas", 0),
+        resultado=jsonable_encoder(resultado),
+        iniciada_en=ahora,
+        terminada_en=ahora,
+    )
+    db.add(tarea)
+    db.commit()
+    db.refresh(tarea)
+    return tarea
+
+
+def _reclamar(db: Session) -> Optional[int]:
+    """Toma la tarea pendiente más antigua (o una abandonada) y la marca como procesando."""
+    ahora = datetime.utcnow()
+    limite = ahora - timedelta(minutes=TAREAS_TIMEOUT_MIN)
+    tarea = (
+        db.query(models.Tarea)
+        .filter(or_(
+            models.Tarea.estado == "pendiente",
+            and_(models.Tarea.estado == "procesando", models.Tarea.actualizada_en < limite),
+        ))
+        .order_by(models.Tarea.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if tarea is None:
+        db.rollback()
+        return None
+
+    tarea.estado = "procesando"
+    tarea.intentos = (tarea.intentos or 0) + 1
+    tarea.iniciada_en = ahora
+    tarea.actualizada_en = ahora
+    tarea.mensaje_error = None
+    db.commit()
+    return tarea.id
+
+
+def _latir(tarea_id: int, fin: threading.Event) -> None:
+    """
+    Toca actualizada_en cada TAREAS_LATIDO_SEG hasta que la tarea termine, con
+    su propia sesión (un lote lento de la tarea no alcanza a confirmar progreso
+    antes de TAREAS_TIMEOUT_MIN y otro worker la volvería a tomar).
+    """
+    while not fin.wait(TAREAS_LATIDO_SEG):
+        db = SessionLocal()
+        try:
+            (
+                db.query(models.Tarea)
+                .filter(models.Tarea.id == tarea_id, models.Tarea.estado == "procesando")
+                .update({models.Tarea.actualizada_en: datetime.utcnow()}, synchronize_session=False)
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("Error en latido de tarea %s", tarea_id)
+        finally:
+            db.close()
+
+
+def ejecutar(tarea_id: int) -> None:
+    fin = threading.Event()
+    latido = threading.Thread(target=_latir, args=(tarea_id, fin), name=f"latido-{tarea_id}", daemon=True)
+    latido.start()
+    db = SessionLocal()
+    try:
+        tarea = (
+            db.query(models.Tarea)
+            .options(undefer(models.Tarea.archivo))
+            .filter(models.Tarea.id == tarea_id)
+            .one()
+        )
+        try:
+            resultado = MANEJADORES[tarea.tipo](db, tarea)
+            tarea.estado = "completada"
+            tarea.resultado = resultado
+            tarea.archivo = None
+            tarea.terminada_en = datetime.utcnow()
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.exception("Error en tarea %s", tarea_id)
+            tarea = db.get(models.Tarea, tarea_id)
+            tarea.estado = "error"
+            tarea.errores = (tarea.errores or 0) + 1
+            tarea.mensaje_error = str(e)[:1000]
+            tarea.terminada_en = datetime.utcnow()
+            db.commit()
+    finally:
+        fin.set()
+        latido.join()
+        db.close()
+
+
+def procesar_pendientes() -> int:
+    """Procesa tareas hasta vaciar la cola. Devuelve cuántas tomó."""
+    procesadas = 0
+    while not _detener.is_set():
+        db = SessionLocal()
+        try:
+            tarea_id = _reclamar(db)
+        finally:
+            db.close()
+        if tarea_id is None:
+            return procesadas
+        ejecutar(tarea_id)
+        procesadas += 1
+    return procesadas
+
+
+def _bucle():
+    while not _detener.is_set():
+        try:
+            procesar_pendientes()
+        except Exception:
+            logger.exception("Error en worker de tareas")
+        _despertar.wait(TAREAS_POLL_SEG)
+        _despertar.clear()
+
+
+# ---------------------
+# Pool de workers
+# ---------------------
+
+def iniciar(workers: int = TAREAS_WORKERS) -> None:
+    """Levanta `workers` hilos; con 0 (TAREAS_WORKERS=0) este proceso solo encola."""
+    if _hilos or workers <= 0:
+        return
+    _detener.clear()
+    for i in range(workers):
+        h = threading.Thread(target=_bucle, name=f"tareas-{i}", daemon=True)
+        h.start()
+        _hilos.append(h)
+
+
+def detener(timeout: float = 10.0) -> None:
+    _detener.set()
+    _despertar.set()
+    for h in _hilos:
+        h.join(timeout)
+    _hilos.clear()
+
+
+if __name__ == "__main__":
+    # worker dedicado, sin API (p.ej. con TAREAS_WORKERS=0 en los procesos web);
+    # aplica las migraciones igual que el startup de la API, por si parte primero
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    migraciones.aplicar(engine)
+    iniciar(max(1, TAREAS_WORKERS))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        detener()
@@ -1,6 +1,34 @@
 # app/xml_parser.py
+import multiprocessing as mp
+import os
+import threading
 import xml.etree.ElementTree as ET
-from app.crud import obtener_cod_admin_y_maestro
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+try:
+    from lxml import etree as LET
+except ImportError:  # lxml viene en requirements; sin él queda solo el motor etree
+    LET = None
+
+# Parser puro: no toca la BD. El cod_admin de cada línea y sus costos los
+# resuelve la ingesta, en lote (app/ingesta.py).
+
+# "lxml" (XPath precompiladas) o "etree" (xml.etree, el parser original)
+MOTOR_POR_DEFECTO = os.getenv("XML_PARSER_MOTOR") or ("lxml" if LET is not None else "etree")
+
+# huge_tree quita los límites de profundidad / tamaño de texto de libxml2; los DTE
+# no lo necesitan y el XML viene de usuarios, así que queda apagado salvo XML_HUGE_TREE=1
+HUGE_TREE = os.getenv("XML_HUGE_TREE", "0").lower() not in ("0", "false", "no")
+
+_LXML_PARSER = LET.XMLParser(huge_tree=HUGE_TREE) if LET is not None else None
+
+# procesos para parsear lotes de archivos (procesar_archivos); 0/1 = en el mismo proceso.
+# Son por worker de uvicorn y cada uno carga la app: pocos por defecto (instancias de 512 MB)
+PROCESOS = int(os.getenv("XML_PARSER_PROCESOS") or 2)
+_POOL = None
+_POOL_LOCK = threading.Lock()
 
 def _text(node, path, default=""):
     el = node.find(path)
@@ -16,86 +44,253 @@ def _find_documentos(root):
     docs = [n for n in root.iter() if n.tag.endswith("Documento")]
     return docs if docs else [root] 
 
-def procesar_xml(contenido_xml, db):
-    root = ET.fromstring(contenido_xml)
-    facturas = []
-
-    for doc in _find_documentos(root):
-        tipo_dte = _text(doc, ".//Encabezado/IdDoc/TipoDTE")
-        es_nota_credito = (tipo_dte == "61")
-
-        emisor = {
-            "rut":          _text(doc, ".//Encabezado/Emisor/RUTEmisor"),
-            "razon_social": _text(doc, ".//Encabezado/Emisor/RznSoc"),
-            "correo":       _text(doc, ".//Encabezado/Receptor/Contacto", ""),
-            "comuna":       _text(doc, ".//Encabezado/Emisor/CdgSIISucur", ""),
-        }
-        receptor = {
-            "rut":           _text(doc, ".//Encabezado/Receptor/RUTRecep"),     
-            "razon_social":  _text(doc, ".//Encabezado/Receptor/RznSocRecep"),
-            "direccion":     _text(doc, ".//Encabezado/Receptor/DirRecep"),
-            "correo":        (_text(doc, ".//Encabezado/Receptor/CorreoRecep") or
-                            _text(doc, ".//Encabezado/Receptor/Contacto", "")),
-            "cdgint":        _text(doc, ".//Encabezado/Receptor/CdgIntRecep", ""),
-        }
-        negocio_hint = (
-            receptor["correo"] or receptor["direccion"] or receptor["razon_social"] or receptor["cdgint"] or ""
-        ).strip()
-
-        folio         = _text(doc, ".//Encabezado/IdDoc/Folio")
-        fecha_emision = _text(doc, ".//Encabezado/IdDoc/FchEmis")
-        forma_pago    = _text(doc, ".//Encabezado/IdDoc/FmaPago", "Contado")
-
-        monto_total = _as_float(_text(doc, ".//Totales/MntTotal", "0"))
-        if es_nota_credito:
-            monto_total *= -1
-
-        productos = []
-        detalles = [n for n in doc.findall(".//Detalle") if n.tag.endswith("Detalle")]
-        for item in detalles:
-            cantidad = _as_float(
-                _text(item, "Cantidad") or _text(item, "QtyItem") or "0"
-            )
-            precio_unitario = _as_float(
-                _text(item, "PrecioUnitario") or _text(item, "PrcItem") or "0"
-            )
-            nombre = _text(item, "NmbItem", "Producto sin nombre")
-            codigo = (_text(item, "CdgItem/VlrCodigo")
-                      or _text(item, "CdgItem/TpoCodigo")
-                      or "N/A")
-            unidad = _text(item, "UnmdItem", "UN")
-
-    
-            cod_admin_id, maestro = obtener_cod_admin_y_maestro(db, codigo)
-            porcentaje_adicional = (maestro.porcentaje_adicional if maestro else 0.0)
-
-            sign = -1 if es_nota_credito else 1
-            neto = precio_unitario * cantidad * sign       
-            imp_adicional = neto * porcentaje_adicional
-
-            productos.append({
-                "nombre": nombre,
-                "codigo": codigo,
-                "unidad": unidad,
-                "cantidad": cantidad,
-                "precio_unitario": precio_unitario,
-                "total": neto,            
-                "iva": 0.0,
-                "otros_impuestos": 0.0,
-                "imp_adicional": imp_adicional,
-                "cod_admin_id": cod_admin_id,
-            })
-
-        facturas.append({
-            "folio": folio,
-            "fecha_emision": fecha_emision,
-            "forma_pago": forma_pago,
-            "monto_total": monto_total,
-            "emisor": emisor,
-            "receptor": receptor,            
-            "negocio_hint": negocio_hint,  
-            "productos": productos,
-            "es_nota_credito": es_nota_credito,
+def _armar_factura(campo, items):
+    """
+    Arma el dict de factura a partir de accesores de texto, para que ambos
+    motores (etree / lxml) produzcan exactamente la misma salida.
+    - campo(ruta, default): texto del encabezado, ruta relativa al Documento.
+    - items: un accesor item(ruta, default) por cada <Detalle>.
+    """
+    tipo_dte = campo("Encabezado/IdDoc/TipoDTE")
+    es_nota_credito = (tipo_dte == "61")
+
+    emisor = {
+        "rut":          campo("Encabezado/Emisor/RUTEmisor"),
+        "razon_social": campo("Encabezado/Emisor/RznSoc"),
+        "correo":       campo("Encabezado/Receptor/Contacto", ""),
+        "comuna":       campo("Encabezado/Emisor/CdgSIISucur", ""),
+    }
+    receptor = {
+        "rut":           campo("Encabezado/Receptor/RUTRecep"),     
+        "razon_social":  campo("Encabezado/Receptor/RznSocRecep"),
+        "direccion":     campo("Encabezado/Receptor/DirRecep"),
+        "correo":        (campo("Encabezado/Receptor/CorreoRecep") or
+                        campo("Encabezado/Receptor/Contacto", "")),
+        "cdgint":        campo("Encabezado/Receptor/CdgIntRecep", ""),
+    }
+    negocio_hint = (
+        receptor["correo"] or receptor["direccion"] or receptor["razon_social"] or receptor["cdgint"] or ""
+    ).strip()
+
+    folio         = campo("Encabezado/IdDoc/Folio")
+    fecha_emision = campo("Encabezado/IdDoc/FchEmis")
+    forma_pago    = campo("Encabezado/IdDoc/FmaPago", "Contado")
+
+    monto_total = _as_float(campo("Totales/MntTotal", "0"))
+    if es_nota_credito:
+        monto_total *= -1
+
+    productos = []
+    for item in items:
+        cantidad = _as_float(
+            item("Cantidad") or item("QtyItem") or "0"
+        )
+        precio_unitario = _as_float(
+            item("PrecioUnitario") or item("PrcItem") or "0"
+        )
+        nombre = item("NmbItem", "Producto sin nombre")
+        codigo = (item("CdgItem/VlrCodigo")
+                  or item("CdgItem/TpoCodigo")
+                  or "N/A")
+        unidad = item("UnmdItem", "UN")
+
+        sign = -1 if es_nota_credito else 1
+        neto = precio_unitario * cantidad * sign       
+
+        productos.append({
+            "nombre": nombre,
+            "codigo": codigo,
+            "unidad": unidad,
+            "cantidad": cantidad,
+            "precio_unitario": precio_unitario,
+            "total": neto,            
+            "iva": 0.0,
+            "otros_impuestos": 0.0,
+            "imp_adicional": 0.0,     # lo calcula app/ingesta.py con el cod_admin del producto
+            "cod_admin_id": None,
         })
 
-    return facturas
+    return {
+        "folio": folio,
+        "fecha_emision": fecha_emision,
+        "forma_pago": forma_pago,
+        "monto_total": monto_total,
+        "emisor": emisor,
+        "receptor": receptor,            
+        "negocio_hint": negocio_hint,  
+        "productos": productos,
+        "es_nota_credito": es_nota_credito,
+    }
+
+
+def _parse_documento(doc):
+    detalles = [n for n in doc.findall(".//Detalle") if n.tag.endswith("Detalle")]
+    return _armar_factura(
+        lambda ruta, default="": _text(doc, ".//" + ruta, default),
+        [(lambda ruta, default="", item=item: _text(item, ruta, default)) for item in detalles],
+    )
+
+
+# ---------------------
+# Motor lxml: XPath precompiladas, una pasada por Documento
+# ---------------------
+
+if LET is not None:
+    _XP_ENCABEZADO = LET.XPath(
+        ".//Encabezado/IdDoc/* | .//Encabezado/Emisor/* | .//Encabezado/Receptor/* | .//Totales/MntTotal"
+    )
+    _XP_DETALLES = LET.XPath(".//Detalle")
+    _XP_CAMPOS_DETALLE = LET.XPath(
+        "Cantidad | QtyItem | PrecioUnitario | PrcItem | NmbItem | UnmdItem | CdgItem/VlrCodigo | CdgItem/TpoCodigo"
+    )
+
+
+def _accesor(nodos):
+    # mismo contrato que _text: primer nodo en orden de documento, .text strip
+    def campo(ruta, default=""):
+        el = nodos.get(ruta)
+        return (el.text or default).strip() if el is not None else default
+    return campo
+
+
+def _parse_documento_lxml(doc):
+    encabezado = {}
+    for el in _XP_ENCABEZADO(doc):
+        padre = el.getparent()
+        if padre.tag == "Totales":
+            clave = "Totales/" + el.tag
+        else:
+            clave = "Encabezado/" + padre.tag + "/" + el.tag
+        encabezado.setdefault(clave, el)
+
+    items = []
+    for item in _XP_DETALLES(doc):
+        nodos = {}
+        for el in _XP_CAMPOS_DETALLE(item):
+            padre = el.getparent()
+            nodos.setdefault(el.tag if padre is item else padre.tag + "/" + el.tag, el)
+        items.append(_accesor(nodos))
+
+    return _armar_factura(_accesor(encabezado), items)
+
+
+def _find_documentos_lxml(root):
+    docs = [n for n in root.iter(LET.Element) if n.tag.endswith("Documento")]
+    return docs if docs else [root]
+
+
+def _motor(motor):
+    motor = (motor or MOTOR_POR_DEFECTO).lower()
+    if motor not in ("etree", "lxml"):
+        raise ValueError(f"Motor XML desconocido: {motor}")
+    if motor == "lxml" and LET is None:
+        raise ValueError("El motor lxml no está disponible (falta el paquete lxml)")
+    return motor
+
+
+def procesar_xml(contenido_xml, motor=None):
+    if _motor(motor) == "lxml" and not isinstance(contenido_xml, str):
+        root = LET.fromstring(contenido_xml, _LXML_PARSER)
+        return [_parse_documento_lxml(doc) for doc in _find_documentos_lxml(root)]
+
+    root = ET.fromstring(contenido_xml)
+    return [_parse_documento(doc) for doc in _find_documentos(root)]
+
+
+def iterar_xml(fuente, motor=None):
+    """
+    Versión streaming de procesar_xml: recibe un archivo (o ruta) y va
+    entregando un dict de factura por cada <Documento> a medida que se cierra.
+    Cada Documento ya leído se limpia y se saca del árbol, así la memoria
+    no crece con el tamaño del EnvioDTE.
+    """
+    if _motor(motor) == "lxml":
+        eventos = LET.iterparse(fuente, events=("start", "end"), huge_tree=HUGE_TREE)
+        parse_documento = _parse_documento_lxml
+    else:
+        eventos = ET.iterparse(fuente, events=("start", "end"))
+        parse_documento = _parse_documento
+
+    pila = []
+    root = None
+    abiertos = 0
+    vistos = 0
+
+    for evento, elem in eventos:
+        es_documento = elem.tag.endswith("Documento")
+        if evento == "start":
+            if root is None:
+                root = elem
+            pila.append(elem)
+            if es_documento:
+                abiertos += 1
+            continue
+
+        pila.pop()
+        if es_documento:
+            abiertos -= 1
+            yield parse_documento(elem)
+            vistos += 1
+            elem.clear()
+
+        # Antes del primer Documento no soltamos nada: si el archivo no trae
+        # ninguno, se procesa la raíz completa (igual que procesar_xml).
+        if vistos and not abiertos and pila:
+            pila[-1].remove(elem)
+
+    if not vistos and root is not None:
+        yield parse_documento(root)
+
+
+def _parsear_archivo(contenido):
+    # corre en el proceso hijo: los errores vuelven como texto para no cortar el map
+    try:
+        return procesar_xml(contenido), None
+    except Exception as e:
+        return None, f"XML inválido: {e}"
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: el proceso web tiene hilos (uvicorn, workers de tareas) y fork no es seguro
+            _POOL = ProcessPoolExecutor(max_workers=PROCESOS, mp_context=mp.get_context("spawn"))
+        return _POOL
+
+
+def cerrar_pool():
+    """Apaga el pool de procesos (shutdown de la app); se vuelve a crear si se usa."""
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def procesar_archivos(archivos, procesos=None):
+    """
+    Parsea varios XML en paralelo (un archivo por tarea del pool de procesos).
+    archivos: lista de (nombre, bytes). Entrega (nombre, facturas, error) en el
+    mismo orden, a medida que van estando, para que la escritura en BD pueda
+    empezar sin esperar al último archivo. Hay a lo más procesos * 2 archivos
+    en vuelo: si la BD va más lenta que el parseo, los resultados no se acumulan.
+    """
+    procesos = PROCESOS if procesos is None else procesos
+    if procesos <= 1 or len(archivos) <= 1:
+        for nombre, contenido in archivos:
+            facturas, error = _parsear_archivo(contenido)
+            yield nombre, facturas, error
+        return
+
+    pool = _pool()
+    pendientes = deque()
+    siguientes = iter(archivos)
+    for nombre, contenido in islice(siguientes, procesos * 2):
+        pendientes.append((nombre, pool.submit(_parsear_archivo, contenido)))
+    while pendientes:
+        nombre, futuro = pendientes.popleft()
+        facturas, error = futuro.result()
+        for nombre_sig, contenido in islice(siguientes, 1):
+            pendientes.append((nombre_sig, pool.submit(_parsear_archivo, contenido)))
+        yield nombre, facturas, error
@@ -0,0 +1,59 @@
+# bench/bench_ingesta.py
+"""
+Benchmark de la ingesta (ingesta.ingerir_facturas) contra la BD de DATABASE_URL.
+Todo corre dentro de una transacción que se revierte al final: no deja datos.
+
+Uso (desde backend_restaurant_xml_corregido/):
+    python -m bench.bench_ingesta --documentos 500 --lineas 5-40
+    python -m bench.bench_ingesta --documentos 500 --repetir   # 2da pasada = re-subida (duplicados)
+"""
+import argparse
+import io
+import time
+
+from sqlalchemy import event
+
+from bench.generar_dte import generar_envio, _parse_lineas
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark de ingesta XML -> BD")
+    ap.add_argument("--documentos", type=int, default=300)
+    ap.add_argument("--lineas", type=_parse_lineas, default="5-40")
+    ap.add_argument("--ratio-nc", type=float, default=0.05)
+    ap.add_argument("--ratio-sin-cdg", type=float, default=0.1)
+    ap.add_argument("--repetir", action="store_true", help="vuelve a subir el mismo archivo")
+    args = ap.parse_args(argv)
+
+    from app import xml_parser, ingesta
+    from app.database import SessionLocal, engine
+
+    contenido = generar_envio(args.documentos, args.lineas, args.ratio_nc, args.ratio_sin_cdg)
+    sentencias = [0]
+
+    def _contar(*_):
+        sentencias[0] += 1
+
+    event.listen(engine, "before_cursor_execute", _contar)
+    db = SessionLocal()
+    try:
+        pasadas = ["carga", "re-carga"] if args.repetir else ["carga"]
+        print(f"{'pasada':<10}{'seg':>8}{'nuevas':>8}{'dup':>6}{'docs/s':>9}{'sentencias':>12}")
+        for nombre in pasadas:
+            sentencias[0] = 0
+            t0 = time.perf_counter()
+            r = ingesta.ingerir_facturas(db, xml_parser.iterar_xml(io.BytesIO(contenido)))
+            db.flush()
+            dt = time.perf_counter() - t0
+            print(
+                f"{nombre:<10}{dt:>8.2f}{r['facturas_nuevas']:>8}{r['facturas_duplicadas']:>6}"
+                f"{args.documentos / dt:>9.0f}{sentencias[0]:>12}"
+            )
+    finally:
+        db.rollback()
+        db.close()
+        event.remove(engine, "before_cursor_execute", _contar)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# bench/bench_parser.py
+"""
+Benchmark de xml_parser: throughput (documentos/s, líneas/s) y memoria pico
+por modo de parseo. Cada modo corre en un proceso aparte para que la memoria
+de uno no contamine al siguiente.
+
+Uso (desde backend_restaurant_xml_corregido/):
+    python -m bench.bench_parser --documentos 5000 --lineas 5-40
+    python -m bench.bench_parser --archivo /ruta/envio_real.xml
+"""
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from bench.generar_dte import iterar_envio, _parse_lineas
+
+# (nombre, motor, streaming)
+MODOS = [
+    ("etree", "etree", False),
+    ("etree-stream", "etree", True),
+    ("lxml", "lxml", False),
+    ("lxml-stream", "lxml", True),
+]
+
+
+def _rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _parsear(ruta, motor, streaming):
+    from app import xml_parser
+
+    documentos = lineas = 0
+    with open(ruta, "rb") as fh:
+        if streaming:
+            for f in xml_parser.iterar_xml(fh, motor=motor):
+                documentos += 1
+                lineas += len(f["productos"])
+        else:
+            facturas = xml_parser.procesar_xml(fh.read(), motor=motor)
+            documentos = len(facturas)
+            lineas = sum(len(f["productos"]) for f in facturas)
+    return documentos, lineas
+
+
+def _correr_modo(ruta, motor, streaming, repeticiones, cola):
+    # la memoria se mide primero, con el proceso limpio
+    rss_base = _rss_kb()
+    _parsear(ruta, motor, streaming)
+    pico_rss = max(0, _rss_kb() - rss_base)
+
+    mejor = None
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        documentos, lineas = _parsear(ruta, motor, streaming)
+        dt = time.perf_counter() - t0
+        mejor = dt if mejor is None else min(mejor, dt)
+
+    # tracemalloc aparte: su overhead distorsiona los tiempos
+    tracemalloc.start()
+    _parsear(ruta, motor, streaming)
+    _, pico_py = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    cola.put({
+        "segundos": mejor,
+        "documentos": documentos,
+        "lineas": lineas,
+        "pico_python_mb": pico_py / 1024 / 1024,
+        # ru_maxrss viene en KB en Linux; incluye memoria de lxml que tracemalloc no ve
+        "pico_rss_mb": pico_rss / 1024,
+    })
+
+
+def medir(ruta, modos=MODOS, repeticiones=3):
+    ctx = mp.get_context("spawn")
+    resultados = []
+    for nombre, motor, streaming in modos:
+        cola = ctx.Queue()
+        p = ctx.Process(target=_correr_modo, args=(ruta, motor, streaming, repeticiones, cola))
+        p.start()
+        r = cola.get()
+        p.join()
+        r["modo"] = nombre
+        resultados.append(r)
+    return resultados
+
+
+def imprimir(resultados, tam_mb):
+    print(f"\narchivo: {tam_mb:.1f} MB")
+    print(f"{'modo':<14}{'seg':>8}{'docs':>8}{'líneas':>9}{'docs/s':>10}{'líneas/s':>11}{'MB/s':>8}{'py MB':>8}{'rss MB':>8}")
+    for r in resultados:
+        s = r["segundos"] or 1e-9
+        print(
+            f"{r['modo']:<14}{s:>8.3f}{r['documentos']:>8}{r['lineas']:>9}"
+            f"{r['documentos'] / s:>10.0f}{r['lineas'] / s:>11.0f}{tam_mb / s:>8.1f}"
+            f"{r['pico_python_mb']:>8.1f}{r['pico_rss_mb']:>8.1f}"
+        )
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark de xml_parser")
+    ap.add_argument("--archivo", help="XML existente; si no se indica se genera uno sintético")
+    ap.add_argument("--documentos", type=int, default=2000)
+    ap.add_argument("--lineas", type=_parse_lineas, default="5-40")
+    ap.add_argument("--ratio-nc", type=float, default=0.05)
+    ap.add_argument("--ratio-sin-cdg", type=float, default=0.1)
+    ap.add_argument("--namespace", action="store_true")
+    ap.add_argument("--repeticiones", type=int, default=3)
+    ap.add_argument("--modos", default=",".join(m[0] for m in MODOS), help="lista separada por comas")
+    args = ap.parse_args(argv)
+
+    modos = [m for m in MODOS if m[0] in args.modos.split(",")]
+
+    ruta = args.archivo
+    temporal = None
+    if not ruta:
+        temporal = tempfile.NamedTemporaryFile(suffix=".xml", delete=False)
+        with temporal as fh:
+            for trozo in iterar_envio(
+                args.documentos, args.lineas, args.ratio_nc, args.ratio_sin_cdg, args.namespace
+            ):
+                fh.write(trozo)
+        ruta = temporal.name
+
+    try:
+        tam_mb = os.path.getsize(ruta) / 1024 / 1024
+        imprimir(medir(ruta, modos, args.repeticiones), tam_mb)
+    finally:
+        if temporal is not None:
+            os.unlink(ruta)
+
+
+if __name__ == "__main__":
+    main()
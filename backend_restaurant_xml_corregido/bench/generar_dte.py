@@ -0,0 +1,164 @@
+# bench/generar_dte.py
+"""
+Generador de EnvioDTE sintéticos (formato SII) para benchmarks del parser.
+
+Uso:
+    python -m bench.generar_dte --documentos 2000 --lineas 25 -o /tmp/envio.xml
+"""
+import argparse
+import random
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+NS_SII = "http://www.sii.cl/SiiDte"
+
+PRODUCTOS = [
+    ("PAPA LAVADA SACO 25KG", "SC"), ("CEBOLLA MORADA", "KG"), ("TOMATE LARGA VIDA", "KG"),
+    ("ACEITE VEGETAL 5LT", "UN"), ("HARINA SIN POLVOS 25KG", "SC"), ("AZUCAR GRANULADA 1KG", "UN"),
+    ("POLLO ENTERO CONGELADO", "KG"), ("POSTA NEGRA VACUNO", "KG"), ("QUESO MANTECOSO LAMINADO", "KG"),
+    ("JAMÓN PIERNA ACARAMELADO", "KG"), ("LECHE ENTERA 1LT", "UN"), ("CREMA DE LECHE 1LT", "UN"),
+    ("PALTA HASS", "KG"), ("LIMÓN SUTIL", "KG"), ("CERVEZA LAGER 330CC", "UN"), ("BEBIDA COLA 3LT", "UN"),
+    ("SERVILLETA COCTEL 300U", "PQ"), ("DETERGENTE INDUSTRIAL 5LT", "UN"), ("ARROZ GRADO 1 5KG", "UN"),
+    ("SAL DE MAR FINA 1KG", "UN"),
+]
+
+PROVEEDORES = [
+    ("76.123.456-7", "DISTRIBUIDORA CENTRAL SPA"), ("77.888.120-K", "AGRICOLA LOS ANDES LTDA"),
+    ("96.555.010-2", "COMERCIAL FRIOSUR S.A."), ("78.456.789-1", "LACTEOS DEL SUR SPA"),
+    ("79.010.203-5", "BEBIDAS UNIDAS S.A."),
+]
+
+RECEPTORES = [
+    ("76.999.001-3", "RESTAURANT EL FOGON SPA", "AV. PROVIDENCIA 1234"),
+    ("76.999.002-1", "CAFETERIA LA ESQUINA LTDA", "MERCED 456"),
+    ("76.999.003-K", "SUSHI BAR NIPPON SPA", "ISIDORA GOYENECHEA 3000"),
+]
+
+# bloque fijo que imita el tamaño del timbre + firma de cada DTE real
+_FIRMA = "A" * 1200
+
+
+def _detalle(rnd, nro, sin_cdg):
+    nombre, unidad = rnd.choice(PRODUCTOS)
+    qty = rnd.choice([1, 2, 3, 5, 10, 12, 24, 0.5, 1.25])
+    prc = rnd.randint(300, 45000)
+    cdg = ""
+    if not sin_cdg:
+        cdg = (
+            "<CdgItem><TpoCodigo>INT1</TpoCodigo>"
+            f"<VlrCodigo>{PRODUCTOS.index((nombre, unidad)) + 1000}</VlrCodigo></CdgItem>"
+        )
+    return (
+        f"<Detalle><NroLinDet>{nro}</NroLinDet>{cdg}"
+        f"<NmbItem>{escape(nombre)}</NmbItem><QtyItem>{qty}</QtyItem>"
+        f"<UnmdItem>{unidad}</UnmdItem><PrcItem>{prc}</PrcItem>"
+        f"<MontoItem>{round(qty * prc)}</MontoItem></Detalle>"
+    ), round(qty * prc)
+
+
+def _documento(rnd, folio, fecha, lineas, es_nc, ratio_sin_cdg):
+    rut_emisor, rzn_emisor = rnd.choice(PROVEEDORES)
+    rut_recep, rzn_recep, dir_recep = rnd.choice(RECEPTORES)
+    detalles = []
+    neto = 0
+    for nro in range(1, lineas + 1):
+        xml_det, monto = _detalle(rnd, nro, rnd.random() < ratio_sin_cdg)
+        detalles.append(xml_det)
+        neto += monto
+    iva = round(neto * 0.19)
+    tipo = 61 if es_nc else 33
+    return (
+        f'<DTE version="1.0"><Documento ID="F{folio}T{tipo}"><Encabezado>'
+        f"<IdDoc><TipoDTE>{tipo}</TipoDTE><Folio>{folio}</Folio><FchEmis>{fecha.isoformat()}</FchEmis>"
+        f"<FmaPago>{rnd.choice([1, 2])}</FmaPago><FchVenc>{(fecha + timedelta(days=30)).isoformat()}</FchVenc></IdDoc>"
+        f"<Emisor><RUTEmisor>{rut_emisor}</RUTEmisor><RznSoc>{escape(rzn_emisor)}</RznSoc>"
+        f"<GiroEmis>VENTA AL POR MAYOR DE ALIMENTOS</GiroEmis><Acteco>463020</Acteco>"
+        f"<DirOrigen>CAMINO A MELIPILLA 8000</DirOrigen><CmnaOrigen>MAIPU</CmnaOrigen>"
+        f"<CdgSIISucur>{rnd.randint(10000, 99999)}</CdgSIISucur></Emisor>"
+        f"<Receptor><RUTRecep>{rut_recep}</RUTRecep><RznSocRecep>{escape(rzn_recep)}</RznSocRecep>"
+        f"<GiroRecep>RESTAURANTES</GiroRecep><Contacto>compras@example.cl</Contacto>"
+        f"<DirRecep>{escape(dir_recep)}</DirRecep><CmnaRecep>SANTIAGO</CmnaRecep></Receptor>"
+        f"<Totales><MntNeto>{neto}</MntNeto><TasaIVA>19</TasaIVA><IVA>{iva}</IVA>"
+        f"<MntTotal>{neto + iva}</MntTotal></Totales></Encabezado>"
+        + "".join(detalles)
+        + f"<TED version=\"1.0\"><DD><RE>{rut_emisor}</RE><TD>{tipo}</TD><F>{folio}</F></DD>"
+        f"<FRMT algoritmo=\"SHA1withRSA\">{_FIRMA[:172]}</FRMT></TED>"
+        f"<TmstFirma>{fecha.isoformat()}T10:00:00</TmstFirma></Documento>"
+        f"<Signature><SignatureValue>{_FIRMA}</SignatureValue></Signature></DTE>"
+    )
+
+
+def generar_envio(
+    documentos=100,
+    lineas=20,
+    ratio_nota_credito=0.05,
+    ratio_sin_cdg=0.1,
+    namespace=False,
+    semilla=42,
+):
+    """
+    Devuelve un EnvioDTE completo (bytes ISO-8859-1).
+    - lineas: int fijo o tupla (min, max) de líneas por documento.
+    - ratio_nota_credito: fracción de documentos TipoDTE 61.
+    - ratio_sin_cdg: fracción de líneas sin <CdgItem>.
+    - namespace: agrega xmlns del SII como en los archivos reales.
+    """
+    return b"".join(iterar_envio(documentos, lineas, ratio_nota_credito, ratio_sin_cdg, namespace, semilla))
+
+
+def iterar_envio(
+    documentos=100,
+    lineas=20,
+    ratio_nota_credito=0.05,
+    ratio_sin_cdg=0.1,
+    namespace=False,
+    semilla=42,
+):
+    """Igual que generar_envio, pero en trozos (para escribir archivos grandes)."""
+    rnd = random.Random(semilla)
+    xmlns = f' xmlns="{NS_SII}"' if namespace else ""
+    yield (
+        '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+        f'<EnvioDTE{xmlns} version="1.0"><SetDTE ID="SetDoc">'
+        "<Caratula version=\"1.0\"><RutEmisor>76.123.456-7</RutEmisor><RutEnvia>11.111.111-1</RutEnvia>"
+        "<RutReceptor>60.803.000-K</RutReceptor><FchResol>2014-08-22</FchResol><NroResol>80</NroResol>"
+        "<TmstFirmaEnv>2024-01-31T23:59:59</TmstFirmaEnv></Caratula>"
+    ).encode("iso-8859-1")
+
+    inicio = date(2024, 1, 1)
+    for i in range(documentos):
+        n = rnd.randint(*lineas) if isinstance(lineas, (tuple, list)) else lineas
+        fecha = inicio + timedelta(days=rnd.randint(0, 364))
+        es_nc = rnd.random() < ratio_nota_credito
+        yield _documento(rnd, 100000 + i, fecha, n, es_nc, ratio_sin_cdg).encode("iso-8859-1")
+
+    yield b"</SetDTE></EnvioDTE>"
+
+
+def _parse_lineas(valor):
+    if "-" in valor:
+        a, b = valor.split("-", 1)
+        return (int(a), int(b))
+    return int(valor)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Genera un EnvioDTE sintético")
+    ap.add_argument("--documentos", type=int, default=1000)
+    ap.add_argument("--lineas", type=_parse_lineas, default="5-40", help="fijo (20) o rango (5-40)")
+    ap.add_argument("--ratio-nc", type=float, default=0.05)
+    ap.add_argument("--ratio-sin-cdg", type=float, default=0.1)
+    ap.add_argument("--namespace", action="store_true")
+    ap.add_argument("--semilla", type=int, default=42)
+    ap.add_argument("-o", "--salida", required=True)
+    args = ap.parse_args(argv)
+
+    with open(args.salida, "wb") as fh:
+        for trozo in iterar_envio(
+            args.documentos, args.lineas, args.ratio_nc, args.ratio_sin_cdg, args.namespace, args.semilla
+        ):
+            fh.write(trozo)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# tests/test_paginacion.py
+from datetime import date
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import Column, Date, Integer, MetaData, Table, create_engine, insert, select
+
+from app import paginacion
+
+
+@pytest.mark.parametrize("fecha, id_", [(date(2024, 5, 31), 123), (None, 7), (date(1999, 1, 1), 0)])
+def test_cursor_ida_y_vuelta(fecha, id_):
+    cursor = paginacion.codificar_cursor(fecha, id_)
+    assert "=" not in cursor
+    assert paginacion.decodificar_cursor(cursor) == (fecha, id_)
+
+
+@pytest.mark.parametrize("cursor", ["", "no-es-base64!", "MjAyNC0wMS0wMQ"])  # el último es "2024-01-01" sin id
+def test_cursor_invalido(cursor):
+    with pytest.raises(HTTPException) as e:
+        paginacion.decodificar_cursor(cursor)
+    assert e.value.status_code == 400
+
+
+def test_modo_total():
+    for modo in paginacion.MODOS_TOTAL:
+        assert paginacion.validar_modo_total(modo) == modo
+    with pytest.raises(HTTPException):
+        paginacion.validar_modo_total("aprox")
+
+
+@pytest.fixture
+def filas():
+    """Tabla (fecha, id) en SQLite con fechas repetidas y nulas."""
+    engine = create_engine("sqlite://")
+    meta = MetaData()
+    t = Table("t", meta, Column("id", Integer, primary_key=True), Column("fecha", Date, nullable=True))
+    meta.create_all(engine)
+    fechas = [date(2024, 1, 1), date(2024, 1, 1), None, date(2023, 6, 1), None, date(2024, 3, 1), date(2023, 6, 1)]
+    with engine.begin() as conn:
+        conn.execute(insert(t), [{"id": i + 1, "fecha": f} for i, f in enumerate(fechas)])
+    return engine, t
+
+
+@pytest.mark.parametrize("nulos_primero", [False, True])
+def test_keyset_recorre_todo_en_orden(filas, nulos_primero):
+    engine, t = filas
+    fecha_desc = t.c.fecha.desc().nullsfirst() if nulos_primero else t.c.fecha.desc().nullslast()
+    orden = (fecha_desc, t.c.id.desc())
+    with engine.connect() as conn:
+        completo = [tuple(r) for r in conn.execute(select(t.c.fecha, t.c.id).order_by(*orden))]
+
+        # página de 2 en 2 con el cursor de la última fila
+        recorrido, cursor = [], None
+        while True:
+            q = select(t.c.fecha, t.c.id).order_by(*orden).limit(2)
+            if cursor:
+                q = q.where(paginacion.despues_de(t.c.fecha, t.c.id, cursor, nulos_primero=nulos_primero))
+            pagina = [tuple(r) for r in conn.execute(q)]
+            if not pagina:
+                break
+            recorrido += pagina
+            cursor = paginacion.codificar_cursor(*pagina[-1])
+        assert recorrido == completo
+
+        # antes_de_fila es el complemento de despues_de_fila
+        for i, (fecha, id_) in enumerate(completo):
+            antes = select(t.c.fecha, t.c.id).where(
+                paginacion.antes_de_fila(t.c.fecha, t.c.id, fecha, id_, nulos_primero=nulos_primero)
+            ).order_by(*orden)
+            assert [tuple(r) for r in conn.execute(antes)] == completo[:i]
@@ -0,0 +1,75 @@
+# tests/test_xml_parser.py
+"""
+Los cuatro caminos del parser (etree / lxml, documento completo / streaming)
+deben entregar exactamente los mismos dicts.
+"""
+import io
+import re
+
+import pytest
+
+from app import xml_parser
+from bench.generar_dte import generar_envio
+
+lxml = pytest.importorskip("lxml")
+
+
+def _todos_los_motores(contenido: bytes) -> dict:
+    return {
+        "etree": xml_parser.procesar_xml(contenido, motor="etree"),
+        "lxml": xml_parser.procesar_xml(contenido, motor="lxml"),
+        "etree-stream": list(xml_parser.iterar_xml(io.BytesIO(contenido), motor="etree")),
+        "lxml-stream": list(xml_parser.iterar_xml(io.BytesIO(contenido), motor="lxml")),
+    }
+
+
+def _sin_documento(contenido: bytes) -> bytes:
+    """Un solo DTE sin el nodo <Documento>: Encabezado y Detalle cuelgan de la raíz."""
+    texto = contenido.decode("iso-8859-1")
+    interior = re.search(r"<Documento[^>]*>(.*?)</Documento>", texto, re.S).group(1)
+    return f'<?xml version="1.0" encoding="ISO-8859-1"?>\n<Factura>{interior}</Factura>'.encode("iso-8859-1")
+
+
+def _assert_iguales(resultados: dict):
+    referencia = resultados["etree"]
+    for motor, facturas in resultados.items():
+        assert facturas == referencia, motor
+
+
+def test_envio_con_notas_de_credito_y_lineas_sin_codigo():
+    contenido = generar_envio(40, lineas=(1, 8), ratio_nota_credito=0.3, ratio_sin_cdg=0.4, semilla=7)
+    resultados = _todos_los_motores(contenido)
+    _assert_iguales(resultados)
+
+    facturas = resultados["etree"]
+    assert len(facturas) == 40
+    assert any(f["es_nota_credito"] for f in facturas)
+    productos = [p for f in facturas for p in f["productos"]]
+    assert any(not p["codigo"] or p["codigo"] == "N/A" for p in productos)
+    assert any(p["codigo"] and p["codigo"] != "N/A" for p in productos)
+
+
+def test_envio_con_namespace():
+    # las rutas del parser no llevan namespace: lo que importa aquí es que los
+    # cuatro caminos encuentren los mismos Documento y entreguen lo mismo
+    contenido = generar_envio(15, lineas=3, namespace=True, semilla=3)
+    resultados = _todos_los_motores(contenido)
+    _assert_iguales(resultados)
+    assert len(resultados["etree"]) == 15
+
+
+def test_todas_las_lineas_sin_cdgitem():
+    contenido = generar_envio(5, lineas=4, ratio_sin_cdg=1.0, semilla=11)
+    resultados = _todos_los_motores(contenido)
+    _assert_iguales(resultados)
+    assert "CdgItem" not in contenido.decode("iso-8859-1")
+
+
+def test_sin_nodo_documento_procesa_la_raiz():
+    contenido = _sin_documento(generar_envio(1, lineas=5, semilla=5))
+    resultados = _todos_los_motores(contenido)
+    _assert_iguales(resultados)
+
+    (factura,) = resultados["etree"]
+    assert factura["folio"]
+    assert len(factura["productos"]) == 5